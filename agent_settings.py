@@ -0,0 +1,21 @@
+import os
+
+
+"""
+Model and sampling settings shared by the LangGraph agent and the things keyed
+on them (stages.py's artifact configs, batch.py's requests). Kept free of heavy
+imports so a stage cache lookup or a dry run can read them without loading the
+agent stack or constructing the gateway.
+
+SWEBENCH_MODEL picks the model; the gateway is built with the same value.
+"""
+DEFAULT_MODEL = "gpt-4o"
+
+TEMPERATURE = 0.8
+ENSEMBLE_SIZE = 3
+FILE_CONTEXT_BUDGET = 12000
+JUDGE_CONTEXT_BUDGET = 4000
+
+
+def model_name() -> str:
+    return os.environ.get("SWEBENCH_MODEL") or DEFAULT_MODEL
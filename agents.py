@@ -0,0 +1,32 @@
+import importlib
+import threading
+from typing import Callable
+
+
+"""
+Lazy agent registry.
+
+Each agent is named by the module and entry point that run one instance. The
+module (and with it LangGraph, the OpenAI client, docker, ...) is only imported
+the first time get_agent() asks for it, and each module builds its compiled graph
+on first use, so a run that only needs the RAG agent never pays for the LangGraph
+one and `import eval` stays cheap.
+"""
+AGENTS = {
+    "langgraph": ("langgraph_agent", "test_single_example"),
+    "rag": ("rag_agent", "test_single_example_rag"),
+    "basic": ("basic_agent", "test_single_example"),
+}
+
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+
+def get_agent(name: str) -> Callable:
+    if name not in AGENTS:
+        raise KeyError(f"unknown agent {name!r}, expected one of {', '.join(AGENTS)}")
+    with _loaded_lock:
+        if name not in _loaded:
+            module_name, attr = AGENTS[name]
+            _loaded[name] = getattr(importlib.import_module(module_name), attr)
+        return _loaded[name]
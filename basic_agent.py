@@ -3,14 +3,19 @@
 import os 
 import subprocess 
 import argparse
+import threading
 from pathlib import Path
 import shutil
 
-import openai
 import utils
 from dataset import load_swe_bench_lite
+from llm_gateway import get_gateway
+from pytest_results import parse_junit_xml, first_source_frame
+from symbol_index import symbol_index_for
+from git_mirror import ensure_checkout
+from context_packer import Snippet, budget_for, file_reader, pack
 
-openai.api_key = os.getenv("OPENAI_API_KEY")
+CONTEXT_BUDGET = 8000
 
 def run_agent(problem_statement: str, test_patch: str, code_context: str):
     system_prompt = (
@@ -22,27 +27,64 @@ def run_agent(problem_statement: str, test_patch: str, code_context: str):
     user_prompt = (
         f"### Bug Description:\n{problem_statement}\n\n"
         f"### Failing Test (apply to see failure):\n```\n{test_patch}\n```\n\n"
-        f"### Code Context (truncated to ~30k chars):\n```\n{code_context}\n```\n\n"
+        f"### Code Context:\n```\n{code_context}\n```\n\n"
         "### Output (unified diff):\n"
     )
 
-    response = openai.chat.completions.create(
-        model="gpt-4o",
-        messages=[
+    response = get_gateway().invoke(
+        [
             {"role": "system", "content": system_prompt},
             {"role": "user",   "content": user_prompt}
         ],
         temperature=0.2,
         max_tokens=1500,
+        namespace="basic",
     )
-    return response.choices[0].message.content.strip()
+    return response.strip()
+
+"""
+Packs the code around the failure into CONTEXT_BUDGET tokens: hints first, then
+the lines right around the failing line, the function or class enclosing it and a
+wider window.
+"""
+def failure_context(repo_dir: Path, failure_path: str, line_no: int, hints_text: str | None = None,
+                    repo: str = "", commit: str = "") -> str:
+    snippets = []
+    if hints_text:
+        snippets.append(Snippet(4.0, text=hints_text, label="Hints"))
+    try:
+        rel_path = str(Path(failure_path).relative_to(repo_dir))
+    except ValueError:
+        rel_path = failure_path
+    if line_no:
+        snippets += [
+            Snippet(3.0, path=rel_path, start=line_no - 10, end=line_no + 10),
+            Snippet(1.0, path=rel_path, start=line_no - 50, end=line_no + 50),
+        ]
+        # the index is built once per commit, over the shared checkout
+        index = symbol_index_for(str(ensure_checkout(repo, commit)))
+        if rel_path in index.files:
+            symbol = index.enclosing_symbol(rel_path, line_no)
+            if symbol.kind != "module":
+                snippets.append(Snippet(2.0, path=rel_path, start=symbol.start, end=symbol.end))
+    model = get_gateway().model
+    return pack(snippets, budget=min(CONTEXT_BUDGET, budget_for(model)), model=model, read_lines=file_reader(repo_dir))
+
+"""
+The basic agent pip-installs each checkout into the host venv, which every basic
+instance shares, so instances run one at a time even inside the concurrent
+scheduler; each gets its own workspace checkout (workspaces.py).
+"""
+_host_lock = threading.Lock()
 
 def test_single_example(datapoint):
-    example = datapoint
+    from workspaces import workspace
+
+    with _host_lock, workspace(datapoint["repo"], datapoint["base_commit"], datapoint["instance_id"]) as root:
+        return _run_example(datapoint, root / "repo")
 
-    base_dir = Path("repos")
-    base_dir.mkdir(exist_ok=True)
 
+def _run_example(example, repo_dir: Path):
     repo = example["repo"]
     commit = example["base_commit"]
     problem_desc = example["problem_statement"]
@@ -61,53 +103,47 @@ def test_single_example(datapoint):
         "failure_line": None,
     }
 
-    try: 
-        repo_dir = utils.clone_and_checkout(repo, commit, base_dir)
-    except Exception as e:
-        print(f"Error: {str(e)}")
-
     ok_install = utils.install_clone_into_venv(repo_dir)
     print(ok_install)
 
     ok_patch = utils.apply_test_patch(repo_dir, test_patch)  
     print(ok_patch)
 
-    exit_code, stdout_lines, stderr_lines = utils.run_pytest_in_repo(repo_dir)
+    report_path = repo_dir / ".pytest_report.xml"
+    report_path.unlink(missing_ok=True)
+    exit_code, stdout_lines, stderr_lines = utils.run_pytest_in_repo(repo_dir, test_patch, junitxml=report_path)
     result["test_exit_code"] = exit_code
     result["test_stdout"] = stdout_lines
     result["test_stderr"] = stderr_lines
 
     print(exit_code, stderr_lines, stdout_lines)
 
-    fail_loc = utils.extract_failure_location(stdout_lines)
+    frame = first_source_frame(parse_junit_xml(report_path) or [])
+    if frame is not None:
+        fail_loc = (str(repo_dir / frame.path), frame.line)
+    else:
+        fail_loc = utils.extract_failure_location(stdout_lines)
 
     failure_path, failure_line = fail_loc
     result["failure_file"] = failure_path
     result["failure_line"] = failure_line
 
-    code_context = utils.load_relevant_code(repo_dir, failure_path, failure_line, context_radius=50)
+    code_context = failure_context(repo_dir, failure_path, failure_line, hints_text, repo, commit)
     if not code_context:
         print("FAILED TO GET CONTEXT")
-    if hints_text:
-        code_context = hints_text + "\n\n" + code_context
 
+    llm_patch, error = None, None
     try:
         llm_patch = run_agent(problem_desc, test_patch, code_context)
     except Exception as e:
         print(f"Error: {str(e)}")
-
-    """
-    try:
-        shutil.rmtree(repo_dir)
-    except Exception as cleanup_err:
-        print(f"Warning: could not remove {repo_dir}: {cleanup_err}")
-    """
+        error = str(e)
 
     return {
         "repo": repo,
         "commit": commit,
         "llm_patch": llm_patch,
-        "error": None
+        "error": error
     }
 
 if __name__ == '__main__':
@@ -0,0 +1,395 @@
+import json
+import os
+import time
+import uuid
+from pathlib import Path
+
+from llm_cache import CacheMiss, get_llm_cache
+from utils import strip_code_fence
+
+
+"""
+Batch-mode generation for whole-split runs.
+
+The diff prompts of the stateless stages (the RAG agent's llm_call and the
+LangGraph ensemble's samples) don't depend on each other's answers, so instead
+of sending them one by one through the gateway a run can collect them all into
+one JSONL file in the OpenAI Batch API format, submit it, and join the answers
+back by instance_id once the batch is done:
+
+    collect   build every prompt (retrieval for rag; setup/reproduce/localize
+              through stages.py for langgraph) into <batch_dir>/requests.jsonl
+    submit    upload the file and start the batch
+    wait      poll until the batch finishes and download <batch_dir>/results.jsonl
+    join      write the answers into the LLM cache and predictions.json
+
+Progress lives in <batch_dir>/manifest.json, so every step can be run (or
+re-run) on its own and `all` picks up where the last one stopped. Requests are
+keyed exactly like the gateway's (llm_gateway.request_key): answers already in
+the LLM cache are not submitted again, and once joined, a synchronous run over
+the same instances is answered from the cache. The ensemble's judge runs after
+the join, through the stage pipeline, since it needs the samples.
+
+LocalBatchClient answers a batch file in-process with the same interface, for
+tests and dry runs without the Batch API.
+"""
+ENDPOINT = "/v1/chat/completions"
+BATCH_AGENTS = ("rag", "langgraph")
+TERMINAL = ("completed", "failed", "expired", "cancelled")
+
+_ROLES = {"system": "system", "human": "user", "ai": "assistant"}
+
+
+def manifest_path(batch_dir: str | Path) -> Path:
+    return Path(batch_dir) / "manifest.json"
+
+
+def load_manifest(batch_dir: str | Path) -> dict | None:
+    path = manifest_path(batch_dir)
+    return json.loads(path.read_text()) if path.exists() else None
+
+
+def save_manifest(batch_dir: str | Path, manifest: dict):
+    path = manifest_path(batch_dir)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".json.tmp")
+    tmp_path.write_text(json.dumps(manifest, indent=2))
+    os.replace(tmp_path, path)
+
+
+def _cached(namespace: str, key: str) -> str | None:
+    try:
+        cached = get_llm_cache().get(namespace, key)
+    except CacheMiss:
+        return None
+    return json.loads(cached) if cached is not None else None
+
+
+"""
+One batch line for a gateway call: the same messages, sampling parameters and
+cache key the gateway would have used for invoke(..., sample=sample).
+"""
+def batch_request(instance_id: str, namespace: str, messages, temperature=None, max_tokens=None,
+                  sample: int = 0) -> dict:
+    from llm_gateway import get_gateway, request_key, to_messages
+
+    model = get_gateway().model
+    messages = to_messages(messages)
+    body = {"model": model, "messages": [{"role": _ROLES.get(m.type, "user"), "content": m.content}
+                                         for m in messages]}
+    if temperature is not None:
+        body["temperature"] = temperature
+    if max_tokens is not None:
+        body["max_tokens"] = max_tokens
+    return {
+        "custom_id": f"{namespace}:{instance_id}:{sample}",
+        "instance_id": instance_id,
+        "namespace": namespace,
+        "key": request_key(model, temperature, max_tokens, None, messages, sample),
+        "sample": sample,
+        "body": body,
+    }
+
+
+def rag_requests(datapoint, stage_dir, rank_mode: str) -> list[dict]:
+    import rag_agent
+
+    state = {"problem_statement": datapoint["problem_statement"], "context": rag_agent.retrieve_context(datapoint)}
+    return [batch_request(datapoint["instance_id"], "rag", rag_agent.rag_messages(state))]
+
+
+def ensemble_requests(datapoint, stage_dir, rank_mode: str) -> list[dict]:
+    import langgraph_agent
+    from agent_settings import ENSEMBLE_SIZE, TEMPERATURE
+    from stages import _state, stage_inputs
+
+    prev = stage_inputs("localize", datapoint, stage_dir, rank_mode=rank_mode)
+    messages = langgraph_agent.ensemble_messages(_state(datapoint, prev, rank_mode))
+    return [
+        batch_request(datapoint["instance_id"], "ensemble", messages, TEMPERATURE, sample=i)
+        for i in range(ENSEMBLE_SIZE)
+    ]
+
+
+COLLECTORS = {
+    "rag": rag_requests,
+    "langgraph": ensemble_requests,
+}
+
+
+"""
+Builds the prompts of every instance in dataset (with the agent choose_agent
+picks for it) and writes the ones not already cached to requests.jsonl. Returns
+the manifest, which records every request and where its answer will come from.
+"""
+def collect(dataset, batch_dir: str | Path, choose_agent, stage_dir="runs/stages", rank_mode: str = "judge",
+            max_workers: int = 8, instance_timeout: float | None = None) -> dict:
+    from scheduler import run_instances
+
+    batch_dir = Path(batch_dir)
+    batch_dir.mkdir(parents=True, exist_ok=True)
+    manifest = {"created": time.time(), "batch_id": None, "client": None, "status": "collected",
+                "instances": {}, "requests": {}}
+    bodies = []
+
+    def worker(_, datapoint):
+        agent = choose_agent(datapoint)
+        if agent not in COLLECTORS:
+            raise ValueError(f"agent {agent!r} can't run in batch mode, expected one of {', '.join(BATCH_AGENTS)}")
+        return agent, COLLECTORS[agent](datapoint, stage_dir, rank_mode)
+
+    def on_result(_, datapoint, result, error):
+        instance_id = datapoint["instance_id"]
+        if error is not None:
+            print(f"{instance_id} failed while collecting: {error!r}")
+            manifest["instances"][instance_id] = {"agent": choose_agent(datapoint), "requests": [],
+                                                  "error": repr(error)}
+            return
+        agent, requests = result
+        manifest["instances"][instance_id] = {"agent": agent, "requests": [r["custom_id"] for r in requests],
+                                              "error": None}
+        for request in requests:
+            cached = _cached(request["namespace"], request["key"]) is not None
+            manifest["requests"][request["custom_id"]] = {
+                k: request[k] for k in ("instance_id", "namespace", "key", "sample")
+            } | {"cached": cached}
+            if not cached:
+                bodies.append({"custom_id": request["custom_id"], "method": "POST", "url": ENDPOINT,
+                               "body": request["body"]})
+
+    run_instances(dataset, worker, on_result, max_workers=max_workers, instance_timeout=instance_timeout)
+    with open(batch_dir / "requests.jsonl", "w", encoding="utf-8") as f:
+        for line in sorted(bodies, key=lambda line: line["custom_id"]):
+            f.write(json.dumps(line) + "\n")
+    if not bodies:
+        manifest["status"] = "completed"
+    save_manifest(batch_dir, manifest)
+    cached = sum(r["cached"] for r in manifest["requests"].values())
+    print(f"    • Collected {len(manifest['requests'])} requests for {len(manifest['instances'])} instances "
+          f"({cached} already cached, {len(bodies)} to submit)")
+    return manifest
+
+
+"""
+Client for the OpenAI Batch API: the requests file is uploaded with
+purpose="batch" and run against the chat completions endpoint within 24h.
+"""
+class OpenAIBatchClient:
+    name = "openai"
+
+    def __init__(self, batch_dir: str | Path | None = None):
+        from openai import OpenAI
+
+        self._client = OpenAI()
+
+    def submit(self, path: Path) -> str:
+        with open(path, "rb") as f:
+            upload = self._client.files.create(file=f, purpose="batch")
+        batch = self._client.batches.create(input_file_id=upload.id, endpoint=ENDPOINT, completion_window="24h")
+        return batch.id
+
+    def status(self, batch_id: str) -> dict:
+        batch = self._client.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        return {
+            "status": batch.status,
+            "completed": counts.completed if counts else 0,
+            "failed": counts.failed if counts else 0,
+            "total": counts.total if counts else 0,
+        }
+
+    def results(self, batch_id: str) -> list[dict]:
+        batch = self._client.batches.retrieve(batch_id)
+        lines = []
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                text = self._client.files.content(file_id).text
+                lines += [json.loads(line) for line in text.splitlines() if line.strip()]
+        return lines
+
+
+"""
+In-process stand-in for the Batch API: answers every line of the file with
+responder(body) at submit time and keeps the output next to the manifest, so
+later steps (in another process too) read it like a finished batch. The default
+responder returns an empty answer.
+"""
+class LocalBatchClient:
+    name = "local"
+
+    def __init__(self, batch_dir: str | Path, responder=None):
+        self.batch_dir = Path(batch_dir)
+        self.responder = responder or (lambda body: "")
+
+    def _output(self, batch_id: str) -> Path:
+        return self.batch_dir / f"{batch_id}.output.jsonl"
+
+    def submit(self, path: Path) -> str:
+        batch_id = f"local-{uuid.uuid4().hex[:12]}"
+        with open(path, encoding="utf-8") as src, open(self._output(batch_id), "w", encoding="utf-8") as out:
+            for line in src:
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                try:
+                    content = self.responder(request["body"])
+                    response = {"status_code": 200, "body": {
+                        "model": request["body"]["model"],
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}}],
+                    }}
+                    error = None
+                except Exception as e:
+                    response, error = None, {"message": repr(e)}
+                out.write(json.dumps({"custom_id": request["custom_id"], "response": response,
+                                      "error": error}) + "\n")
+        return batch_id
+
+    def status(self, batch_id: str) -> dict:
+        path = self._output(batch_id)
+        total = sum(1 for line in open(path, encoding="utf-8") if line.strip()) if path.exists() else 0
+        return {"status": "completed" if path.exists() else "failed", "completed": total, "failed": 0,
+                "total": total}
+
+    def results(self, batch_id: str) -> list[dict]:
+        with open(self._output(batch_id), encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+
+CLIENTS = {
+    "openai": OpenAIBatchClient,
+    "local": LocalBatchClient,
+}
+
+
+def get_client(name: str, batch_dir: str | Path):
+    if name not in CLIENTS:
+        raise KeyError(f"unknown batch client {name!r}, expected one of {', '.join(CLIENTS)}")
+    return CLIENTS[name](batch_dir)
+
+
+def submit(client, batch_dir: str | Path, manifest: dict) -> dict:
+    requests_file = Path(batch_dir) / "requests.jsonl"
+    manifest["batch_id"] = client.submit(requests_file)
+    manifest["client"] = client.name
+    manifest["status"] = "submitted"
+    manifest["submitted"] = time.time()
+    save_manifest(batch_dir, manifest)
+    print(f"    • Submitted {requests_file} as batch {manifest['batch_id']} ({client.name})")
+    return manifest
+
+
+"""
+Polls the batch every poll_interval seconds until it reaches a terminal status,
+then downloads its output (answers and per-request errors) to results.jsonl.
+"""
+def wait(client, batch_dir: str | Path, manifest: dict, poll_interval: float = 60.0,
+         timeout: float | None = None) -> dict:
+    started = time.time()
+    last = None
+    while True:
+        status = client.status(manifest["batch_id"])
+        progress = (status["status"], status["completed"], status["failed"])
+        if progress != last:
+            print(f"    • Batch {manifest['batch_id']}: {status['status']} "
+                  f"({status['completed']}/{status['total']} done, {status['failed']} failed)")
+            last = progress
+        if status["status"] in TERMINAL:
+            break
+        if timeout is not None and time.time() - started > timeout:
+            raise TimeoutError(f"batch {manifest['batch_id']} still {status['status']} after {timeout:.0f}s")
+        time.sleep(poll_interval)
+
+    with open(Path(batch_dir) / "results.jsonl", "w", encoding="utf-8") as f:
+        for line in client.results(manifest["batch_id"]):
+            f.write(json.dumps(line) + "\n")
+    manifest["status"] = status["status"]
+    manifest["finished"] = time.time()
+    save_manifest(batch_dir, manifest)
+    return manifest
+
+
+"""
+Reads results.jsonl into {custom_id: answer} and writes every answer into the
+LLM cache under its gateway key; requests that were cached at collect time are
+read from there. Failed requests are missing from the result.
+"""
+def ingest(batch_dir: str | Path, manifest: dict) -> dict:
+    cache = get_llm_cache()
+    answers = {}
+    failed = 0
+    results_file = Path(batch_dir) / "results.jsonl"
+    lines = results_file.read_text(encoding="utf-8").splitlines() if results_file.exists() else []
+    for line in lines:
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        request = manifest["requests"].get(result["custom_id"])
+        response = result.get("response") or {}
+        if request is None:
+            continue
+        if result.get("error") or response.get("status_code") != 200:
+            failed += 1
+            print(f"    • {result['custom_id']} failed: {result.get('error') or response.get('body')}")
+            continue
+        body = response["body"]
+        content = body["choices"][0]["message"]["content"] or ""
+        cache.put(request["namespace"], request["key"], body.get("model", ""), json.dumps(content))
+        answers[result["custom_id"]] = content
+    for custom_id, request in manifest["requests"].items():
+        if custom_id not in answers and request["cached"]:
+            cached = _cached(request["namespace"], request["key"])
+            if cached is not None:
+                answers[custom_id] = cached
+    print(f"    • {len(answers)}/{len(manifest['requests'])} answers ({failed} failed)")
+    return answers
+
+
+"""
+Joins the answers back by instance_id into the results journal and
+predictions.json. RAG answers are the patch; ensemble samples become the
+instance's `generate` artifact and go through validate/predict as usual.
+"""
+def join(dataset, batch_dir: str | Path, manifest: dict, output_path: str | Path = "predictions.json",
+         journal_path: str | Path | None = None, stage_dir="runs/stages", rank_mode: str = "judge",
+         max_workers: int = 8, instance_timeout: float | None = None) -> list[str]:
+    from journal import ResultJournal
+    from scheduler import run_instances
+    from stages import drop_artifacts_after, run_stage, save_artifact, stage_config
+
+    answers = ingest(batch_dir, manifest)
+    journal = ResultJournal(journal_path or Path(output_path).with_suffix(".jsonl"))
+    failures = []
+
+    def worker(_, datapoint):
+        instance_id = datapoint["instance_id"]
+        entry = manifest["instances"].get(instance_id)
+        if entry is None:
+            raise KeyError(f"{instance_id} is not in batch {manifest['batch_id']}")
+        if entry["error"] is not None:
+            raise RuntimeError(f"collect failed: {entry['error']}")
+        missing = [cid for cid in entry["requests"] if cid not in answers]
+        if len(missing) == len(entry["requests"]):
+            raise RuntimeError(f"no answers for {', '.join(missing)}")
+        outputs = [answers[cid] for cid in entry["requests"] if cid in answers]
+        if entry["agent"] == "rag":
+            return strip_code_fence(outputs[0])
+        save_artifact(stage_dir, "generate", instance_id, {"candidates": outputs},
+                      stage_config("generate", rank_mode))
+        drop_artifacts_after(stage_dir, "generate", instance_id)
+        return run_stage("predict", datapoint, stage_dir, rank_mode=rank_mode)["model_patch"]
+
+    def on_result(_, datapoint, result, error):
+        if error is not None:
+            failures.append(datapoint["instance_id"])
+            print(f"{datapoint['instance_id']} failed: {error!r}")
+        else:
+            print(f"✔ {datapoint['instance_id']}")
+        journal.append(datapoint["instance_id"], result or "", error=None if error is None else repr(error))
+
+    run_instances(dataset, worker, on_result, max_workers=max_workers, instance_timeout=instance_timeout)
+    journal.materialize(output_path, dataset["instance_id"])
+    journal.close()
+    manifest["status"] = "joined"
+    save_manifest(batch_dir, manifest)
+    print(f"Predictions written to {output_path}")
+    return failures
@@ -0,0 +1,410 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+
+
+"""
+Benchmark for the harness itself, runnable with no network, OpenAI or GitHub.
+
+Stand-ins:
+    - a local fixture repo (a tiny src/ package with a bug and a test_patch that
+      exposes it), seeded as the repo's mirror so every clone/checkout/index path
+      runs for real with SWEBENCH_OFFLINE=1
+    - a recorded-LLM gateway: requests still go through LLMGateway (limits,
+      coalescing, tracing), only the OpenAI call is replaced by canned responses
+      played back in order, after an optional simulated latency
+    - without --docker, the langgraph path reproduces the failure with pytest on
+      the host instead of in a container
+
+Everything runs in a throwaway SWEBENCH_CACHE_DIR with the LLM cache off, so two
+runs do the same work. Each agent path reports instances/hour, p50/p95 latency
+per traced stage, peak RSS and container pool reuse, written as JSON to
+runs/bench/<commit>.json. --baseline compares against an earlier result and
+exits non-zero when something regressed by more than --threshold.
+
+Startup cost is measured too: each module in STARTUP_MODULES is imported in a
+fresh interpreter under `-X importtime`, and an import slower than
+--import-budget seconds counts as a regression even without a baseline.
+"""
+BENCH_REPO = "bench/calc"
+PATHS = ("basic", "langgraph", "rag")
+STARTUP_MODULES = ("eval", "agents")
+
+OPS_SOURCE = '''def divide(a, b):
+    return a / b
+
+
+def mean(values):
+    return sum(values) / len(values)
+'''
+
+TESTS_SOURCE = '''from calc.ops import divide
+
+
+def test_divide():
+    assert divide(6, 3) == 2
+'''
+
+TESTS_PATCHED = TESTS_SOURCE.replace("from calc.ops import divide", "from calc.ops import divide, mean") + '''
+
+def test_mean_empty():
+    assert mean([]) == 0.0
+'''
+
+FIX_DIFF = '''--- a/src/calc/ops.py
++++ b/src/calc/ops.py
+@@ -5,2 +5,4 @@ def divide(a, b):
+ def mean(values):
++    if not values:
++        return 0.0
+     return sum(values) / len(values)
+'''
+
+# the same fix with the hunk counts an LLM typically gets wrong, and one that doesn't compile
+MISCOUNTED_DIFF = FIX_DIFF.replace("@@ -5,2 +5,4 @@", "@@ -5,3 +5,9 @@")
+BROKEN_DIFF = FIX_DIFF.replace("return 0.0", "return 0.0 +")
+
+
+def _git(cwd: Path, *args: str) -> str:
+    return subprocess.run(["git", *args], cwd=cwd, check=True, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, text=True).stdout
+
+
+"""
+Creates the fixture repo, mirrors it where git_mirror looks for BENCH_REPO and
+returns (base_commit, test_patch).
+"""
+def build_fixture(root: Path) -> tuple[str, str]:
+    from git_mirror import mirror_path
+
+    repo = root / "fixture"
+    (repo / "src" / "calc").mkdir(parents=True)
+    (repo / "tests").mkdir()
+    (repo / "src" / "calc" / "__init__.py").write_text("")
+    (repo / "src" / "calc" / "ops.py").write_text(OPS_SOURCE)
+    (repo / "tests" / "test_ops.py").write_text(TESTS_SOURCE)
+    _git(repo, "init", "-q")
+    _git(repo, "add", ".")
+    _git(repo, "-c", "user.name=bench", "-c", "user.email=bench@localhost", "commit", "-qm", "fixture")
+    commit = _git(repo, "rev-parse", "HEAD").strip()
+
+    (repo / "tests" / "test_ops.py").write_text(TESTS_PATCHED)
+    test_patch = _git(repo, "diff")
+    _git(repo, "checkout", "-q", "--", ".")
+
+    subprocess.run(["git", "clone", "-q", "--mirror", str(repo), str(mirror_path(BENCH_REPO))], check=True)
+    return commit, test_patch
+
+
+def datapoints(commit: str, test_patch: str, n: int, path: str) -> list[dict]:
+    return [
+        {
+            "instance_id": f"bench__calc-{path}-{i}",
+            "repo": BENCH_REPO,
+            "base_commit": commit,
+            "environment_setup_commit": commit,
+            "version": "0.1",
+            "test_patch": test_patch,
+            "problem_statement": "calc.ops.mean raises ZeroDivisionError for an empty list; it should return 0.0.",
+            "hints_text": "mean() is defined in src/calc/ops.py.",
+            "text": OPS_SOURCE,
+        }
+        for i in range(n)
+    ]
+
+
+"""
+Recorded responses, played back per schema (or "text") in order and cycled.
+"""
+def recording() -> dict:
+    from langgraph_agent import ChosenDiff, FindFile
+
+    return {
+        "FindFile": [FindFile(file_name="calc/ops.py", file_line="return sum(values) / len(values)",
+                              error="mean divides by len(values), which is 0 for an empty list")],
+        "ChosenDiff": [ChosenDiff(best_diff=1)],
+        "text": [FIX_DIFF, MISCOUNTED_DIFF, BROKEN_DIFF],
+    }
+
+
+def recorded_gateway(responses: dict, latency: float):
+    from llm_gateway import LLMGateway
+
+    class RecordedGateway(LLMGateway):
+        def __init__(self):
+            super().__init__(requests_per_minute=1e6, tokens_per_minute=1e9)
+            self._played = defaultdict(int)
+
+        async def _send(self, messages, temperature, max_tokens, schema):
+            await asyncio.sleep(latency)
+            kind = schema.__name__ if schema is not None else "text"
+            played = responses[kind]
+            response = played[self._played[kind] % len(played)]
+            self._played[kind] += 1
+            self.stats["requests"] += 1
+            return response
+
+    return RecordedGateway()
+
+
+"""
+Host-side stand-in for run_patch_and_tests_in_docker: same results keys, pytest
+runs in a --shared clone on the host.
+"""
+def local_reproduce(repo: str, commit: str, test_patch: str, **_) -> dict:
+    import utils
+    from pytest_results import failure_summary, parse_junit_xml
+
+    work = Path(tempfile.mkdtemp(prefix="bench_repro_"))
+    repo_dir = utils.clone_and_checkout(repo, commit, work)
+    utils.apply_test_patch(repo_dir, test_patch)
+    report = repo_dir / ".pytest_report.xml"
+    code, out, err = utils.run_pytest_in_repo(repo_dir, test_patch, junitxml=report)
+    records = parse_junit_xml(report) or []
+    return {
+        "pytest_exit": code,
+        "pytest_stdout": "\n".join(out),
+        "pytest_stderr": "\n".join(err),
+        "test_records": records,
+        "failure_summary": failure_summary(records),
+    }
+
+
+def _percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    k = (len(ordered) - 1) * q
+    lo, hi = int(k), min(int(k) + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def _agent(path: str, use_docker: bool):
+    if path == "basic":
+        import basic_agent
+        import utils
+
+        # the fixture has nothing to install, and pip would need the network
+        utils.install_clone_into_venv = lambda repo_dir: True
+        return basic_agent.test_single_example
+    if path == "langgraph":
+        import langgraph_agent
+
+        if not use_docker:
+            langgraph_agent.run_patch_and_tests_in_docker = local_reproduce
+        return langgraph_agent.test_single_example
+    if path == "rag":
+        import rag_agent
+
+        return rag_agent.test_single_example_rag
+    raise ValueError(f"unknown agent path {path!r}")
+
+
+def run_path(path: str, points: list[dict], workers: int, use_docker: bool) -> dict:
+    import tracing
+    from container_pool import get_container_pool
+    from scheduler import run_instances
+
+    agent = _agent(path, use_docker)
+    pool_before = dict(get_container_pool().stats) if use_docker else None
+    errors = []
+
+    def on_result(index, datapoint, result, error):
+        if error is not None:
+            errors.append(f"{datapoint['instance_id']}: {error!r}")
+
+    def worker(index, datapoint):
+        with tracing.span("instance", "instance", instance_id=datapoint["instance_id"]):
+            return agent(datapoint)
+
+    tracing.reset()
+    start = time.perf_counter()
+    run_instances(points, worker, on_result, max_workers=workers)
+    wall = time.perf_counter() - start
+
+    stages = defaultdict(list)
+    for s in tracing.spans():
+        stages[s.name].append(s.wall)
+
+    result = {
+        "instances": len(points),
+        "errors": errors,
+        "wall_s": round(wall, 3),
+        "instances_per_hour": round(len(points) / wall * 3600, 1) if wall > 0 else 0.0,
+        "peak_rss_mb": round(tracing.peak_rss_mb(), 1),
+        "stages": {
+            name: {
+                "count": len(walls),
+                "p50_s": round(_percentile(walls, 0.50), 4),
+                "p95_s": round(_percentile(walls, 0.95), 4),
+            }
+            for name, walls in sorted(stages.items())
+        },
+        "container_pool": None,
+    }
+    if pool_before is not None:
+        stats = get_container_pool().stats
+        created = stats["created"] - pool_before["created"]
+        reused = stats["reused"] - pool_before["reused"]
+        result["container_pool"] = {
+            "created": created,
+            "reused": reused,
+            "reuse_rate": round(reused / (created + reused), 3) if created + reused else 0.0,
+        }
+    return result
+
+
+"""
+Imports `module` in a fresh interpreter with -X importtime and returns its
+cumulative import time plus the slowest modules it pulled in.
+"""
+def import_time(module: str, cwd: Path, top: int = 5) -> dict:
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=cwd,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    # children are printed before their parent, indented; interpreter startup
+    # (site, encodings, ...) comes first as separate top-level entries
+    block, total = [], None
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cum, name = line.split("|", 2)
+        if not cum.strip().isdigit():
+            continue
+        if name.strip() == module and name[1:2] != " ":
+            total = int(cum) / 1e6
+            break
+        if name[1:2] != " ":
+            block = []
+        else:
+            block.append((name.strip(), int(cum) / 1e6))
+    if proc.returncode != 0 or total is None:
+        return {"seconds": None, "error": proc.stderr.strip().splitlines()[-1:] or ["failed"]}
+    slowest = sorted(block, key=lambda item: -item[1])
+    return {
+        "seconds": round(total, 4),
+        "slowest": [[name, round(seconds, 4)] for name, seconds in slowest[:top]],
+    }
+
+
+"""
+Returns a description of every metric in `current` that is worse than in
+`baseline` by more than `threshold` (relative). Stages faster than min_stage_s in
+both runs are ignored; they are all noise.
+"""
+def compare(current: dict, baseline: dict, threshold: float = 0.2, min_stage_s: float = 0.05) -> list[str]:
+    regressions = []
+    for module, cur in current.get("startup", {}).items():
+        old = baseline.get("startup", {}).get(module)
+        if old and old["seconds"] and cur["seconds"] and max(old["seconds"], cur["seconds"]) >= min_stage_s \
+                and cur["seconds"] > old["seconds"] * (1 + threshold):
+            regressions.append(f"startup: import {module} {old['seconds']}s -> {cur['seconds']}s")
+    for path, cur in current["paths"].items():
+        base = baseline.get("paths", {}).get(path)
+        if base is None:
+            continue
+        if base["instances_per_hour"] and \
+                cur["instances_per_hour"] < base["instances_per_hour"] * (1 - threshold):
+            regressions.append(f"{path}: instances/hour {base['instances_per_hour']} -> {cur['instances_per_hour']}")
+        if base["peak_rss_mb"] and cur["peak_rss_mb"] > base["peak_rss_mb"] * (1 + threshold):
+            regressions.append(f"{path}: peak RSS {base['peak_rss_mb']}MB -> {cur['peak_rss_mb']}MB")
+        for stage, stats in cur["stages"].items():
+            old = base["stages"].get(stage)
+            if old is None or max(old["p95_s"], stats["p95_s"]) < min_stage_s:
+                continue
+            if stats["p95_s"] > old["p95_s"] * (1 + threshold):
+                regressions.append(f"{path}: {stage} p95 {old['p95_s']}s -> {stats['p95_s']}s")
+        base_pool, cur_pool = base.get("container_pool"), cur.get("container_pool")
+        if base_pool and cur_pool and cur_pool["reuse_rate"] < base_pool["reuse_rate"] - threshold:
+            regressions.append(f"{path}: container reuse {base_pool['reuse_rate']} -> {cur_pool['reuse_rate']}")
+    return regressions
+
+
+def _commit() -> str:
+    proc = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    return proc.stdout.strip() or "unknown"
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Offline benchmark of the agent pipeline")
+    parser.add_argument("--paths", default=",".join(PATHS), help="comma-separated agent paths to run")
+    parser.add_argument("--instances", type=int, default=6, help="instances per agent path")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="simulated seconds per LLM call")
+    parser.add_argument("--docker", action="store_true", help="use real containers for the langgraph path")
+    parser.add_argument("--output", help="result file (default runs/bench/<commit>.json)")
+    parser.add_argument("--baseline", help="earlier result to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative change that counts as a regression")
+    parser.add_argument("--import-budget", type=float, default=1.0, help="max seconds to import a startup module")
+    args = parser.parse_args(argv)
+
+    repo_root = Path(__file__).resolve().parent
+    output = Path(args.output).resolve() if args.output else None
+    baseline = Path(args.baseline).resolve() if args.baseline else None
+    workdir = Path(tempfile.mkdtemp(prefix="swebench_bench_"))
+    # the harness modules read it whenever they touch a cache
+    os.environ["SWEBENCH_CACHE_DIR"] = str(workdir / "cache")
+    os.environ["SWEBENCH_OFFLINE"] = "1"
+    os.environ["SWEBENCH_LLM_CACHE"] = "off"
+    os.environ.setdefault("OPENAI_API_KEY", "bench-offline")
+    os.chdir(workdir)
+
+    # before this process imports anything heavy, so the children start from the same state
+    startup = {module: import_time(module, repo_root) for module in STARTUP_MODULES}
+    over_budget = []
+    for module, stats in startup.items():
+        if stats["seconds"] is None:
+            print(f"    • import {module} failed: {stats['error'][0]}")
+        else:
+            print(f"    • import {module}: {stats['seconds']}s")
+            if stats["seconds"] > args.import_budget:
+                over_budget.append(f"startup: import {module} took {stats['seconds']}s "
+                                   f"(budget {args.import_budget}s)")
+
+    import llm_gateway
+    from scheduler import configure_limits
+
+    commit, test_patch = build_fixture(workdir)
+    llm_gateway._gateway = recorded_gateway(recording(), args.llm_latency)
+    configure_limits(max_docker=args.workers if args.docker else 1, max_llm=args.workers)
+
+    result = {
+        "commit": _commit(),
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "baseline")},
+        "startup": startup,
+        "paths": {},
+    }
+    for path in [p.strip() for p in args.paths.split(",") if p.strip()]:
+        # same worker count for every path, as eval runs them; basic_agent serializes
+        # its own instances (they share the host venv), which the numbers should show
+        print(f"▶️  Benchmarking the {path} path ({args.instances} instances, {args.workers} workers)")
+        result["paths"][path] = run_path(path, datapoints(commit, test_patch, args.instances, path),
+                                         args.workers, args.docker)
+        stats = result["paths"][path]
+        print(f"    • {stats['instances_per_hour']} instances/hour, {len(stats['errors'])} errors")
+
+    output = output or repo_root / "runs" / "bench" / f"{result['commit']}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(result, indent=2, sort_keys=True))
+    print(f"Results written to {output}")
+
+    regressions = list(over_budget)
+    if baseline:
+        regressions += compare(result, json.loads(baseline.read_text()), args.threshold)
+    for line in regressions:
+        print(f"REGRESSION {line}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,131 @@
+import io
+import shlex
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+import docker
+
+from create_docker_container import _docker_exec, _put_file, container_run_kwargs
+from container_pool import get_container_pool
+from git_mirror import ensure_mirror
+from image_cache import SRC_ROOT, get_image_cache
+from pytest_results import TestRecord, parse_junit_xml
+from targeted_tests import pytest_args
+from env_specs import EnvSpec, spec_for
+
+
+"""
+Ranks candidate diffs by running the tests instead of asking an LLM.
+
+One warm container is leased for the instance image and every candidate gets its
+own `git clone --shared` of the image's source checkout under /tmp (objects are
+shared, only the working tree is written). test_patch and the candidate are applied there and
+the tests test_patch touches run in all clones at once, with the clone first on
+PYTHONPATH so it shadows the copy installed in the image. Candidates are ordered
+by passing tests, then by fewest failures, then by smallest diff.
+"""
+CANDIDATE_ROOT = "/tmp/candidates"
+TEST_TIMEOUT = 900
+
+
+@dataclass
+class CandidateRun:
+    index: int
+    diff: str
+    applied: bool = False
+    exit_code: int | None = None
+    records: list[TestRecord] = field(default_factory=list)
+    error: str = ""
+
+    @property
+    def passed(self) -> int:
+        return sum(1 for r in self.records if r.outcome == "passed")
+
+    @property
+    def failed(self) -> int:
+        return sum(1 for r in self.records if r.failed)
+
+
+def diff_size(diff: str) -> int:
+    return sum(1 for line in diff.splitlines()
+               if line[:1] in ("+", "-") and not line.startswith(("+++ ", "--- ")))
+
+
+def rank_key(run: CandidateRun):
+    return (not run.applied, -run.passed, run.failed, diff_size(run.diff), run.index)
+
+
+def _run_candidate(container, base_dir: str, commit: str, test_patch: str, spec: EnvSpec,
+                   run: CandidateRun) -> CandidateRun:
+    work = f"{CANDIDATE_ROOT}/{run.index}"
+    code, _, err = _docker_exec(
+        container,
+        f"rm -rf {work} && git clone -q --shared --no-checkout {base_dir} {work} && "
+        f"cd {work} && git checkout -q {commit}",
+        workdir="/",
+    )
+    if code != 0:
+        run.error = f"clone failed: {err.strip()[:500]}"
+        return run
+
+    _put_file(container, f"{work}/.test.patch", test_patch)
+    _put_file(container, f"{work}/.candidate.patch", run.diff)
+    apply_test = "git apply .test.patch && " if test_patch.strip() else ""
+    code, _, err = _docker_exec(container, f"{apply_test}git apply .candidate.patch", workdir=work)
+    if code != 0:
+        run.error = f"apply failed: {err.strip()[:500]}"
+        return run
+    run.applied = True
+
+    report = f"{work}/.report.xml"
+    args = " ".join(shlex.quote(a) for a in pytest_args(test_patch, markers=spec.markers, junitxml=report))
+    cmd = f"PYTHONPATH={work}/src:{work}:$PYTHONPATH {spec.test_prefix()} {args}"
+    run.exit_code, _, err = _docker_exec(container, cmd, workdir=work, timeout=TEST_TIMEOUT, idle_timeout=300)
+
+    code, out, _ = _docker_exec(container, f"cat {report}", workdir="/")
+    run.records = (parse_junit_xml(io.BytesIO(out.encode("utf-8"))) or []) if code == 0 else []
+    if not run.records:
+        run.error = err.strip()[-500:]
+    return run
+
+
+"""
+Returns a CandidateRun per diff, best first. Raises when the instance image or
+container can't be prepared, so callers can fall back to the LLM judge.
+"""
+def rank_candidates(
+    repo: str,
+    commit: str,
+    test_patch: str,
+    diffs: list[str],
+    version: str = "",
+    setup_commit: str = "",
+    python_base_image: str | None = None,
+) -> list[CandidateRun]:
+    spec = spec_for(repo, version, python_base_image)
+    ensure_mirror(repo, commit)
+    image, (code, _, err) = get_image_cache().ensure_instance(
+        repo, commit, version=version, setup_commit=setup_commit, python_base_image=python_base_image,
+    )
+    if image is None:
+        raise RuntimeError(f"no image for {repo}@{commit[:12]}: {err.strip()[:500]}")
+
+    run_kwargs = container_run_kwargs(docker.from_env())
+    base_dir = f"{SRC_ROOT}/{repo.replace('/', '_')}"
+    reset_cmd = f"rm -rf {CANDIDATE_ROOT}"
+    with get_container_pool().lease(image, reset_cmd, **run_kwargs) as lease:
+        container = lease["container"]
+        code, _, err = _docker_exec(container, f"mkdir -p {CANDIDATE_ROOT}", workdir="/")
+        if code != 0:
+            lease["discard"] = True
+            raise RuntimeError(f"could not prepare {CANDIDATE_ROOT}: {err.strip()[:500]}")
+
+        runs = [CandidateRun(i, diff) for i, diff in enumerate(diffs)]
+        with ThreadPoolExecutor(max_workers=max(1, len(runs))) as pool:
+            runs = list(pool.map(lambda run: _run_candidate(container, base_dir, commit, test_patch, spec, run), runs))
+
+    runs.sort(key=rank_key)
+    for run in runs:
+        status = f"{run.passed} passed, {run.failed} failed" if run.applied else run.error
+        print(f"    • Candidate {run.index + 1}: {status} ({diff_size(run.diff)} changed lines)")
+    return runs
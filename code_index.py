@@ -0,0 +1,166 @@
+import json
+import shutil
+import subprocess
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+
+from utils import cache_dir
+from git_mirror import ensure_checkout, ensure_mirror
+from retrieval import BM25Index, Chunk, chunk_repo, encode_chunks, list_source_files
+
+
+"""
+Persistent, commit-aware BM25 index per repo.
+
+Layout under <cache>/index/<owner>_<name>/:
+    vocab.json              term -> id, shared by every commit and append-only
+    <commit>/chunks.json    chunk metadata (path, span, name); text is read lazily
+    <commit>/*.npy          CSR rows and precomputed BM25 weights
+
+A new commit starts from the nearest indexed commit (fewest commits apart in the
+mirror): rows of files `git diff --name-only` says are unchanged are copied over,
+and only changed or added files are re-chunked and re-tokenized. Segments are
+opened with np.load(mmap_mode="r"), so opening an existing index costs a few
+small reads regardless of repo size.
+"""
+ARRAYS = ("indptr", "term_ids", "tfs", "doc_len", "entry_doc", "entry_weight")
+MAX_CANDIDATES = 20
+
+_repo_locks = defaultdict(threading.Lock)
+_open_indexes = {}
+
+
+def _repo_dir(repo: str) -> Path:
+    path = cache_dir("index", repo.replace("/", "_"))
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def _load_vocab(repo: str) -> dict:
+    path = _repo_dir(repo) / "vocab.json"
+    if path.exists():
+        return json.loads(path.read_text())
+    return {}
+
+
+def _save_vocab(repo: str, vocab: dict):
+    path = _repo_dir(repo) / "vocab.json"
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(vocab))
+    tmp_path.replace(path)
+
+
+def _load_segment(repo: str, commit: str, checkout: Path, vocab: dict) -> BM25Index | None:
+    segment = _repo_dir(repo) / commit
+    if not (segment / "chunks.json").exists():
+        return None
+    chunks = [Chunk(**meta) for meta in json.loads((segment / "chunks.json").read_text())]
+    arrays = tuple(np.load(segment / f"{name}.npy", mmap_mode="r") for name in ARRAYS)
+    return BM25Index(chunks, vocab=vocab, arrays=arrays, repo_dir=checkout)
+
+
+def _save_segment(repo: str, commit: str, index: BM25Index):
+    segment = _repo_dir(repo) / commit
+    tmp_segment = segment.with_name(commit + ".partial")
+    shutil.rmtree(tmp_segment, ignore_errors=True)
+    tmp_segment.mkdir()
+    metas = [{"path": c.path, "start": c.start, "end": c.end, "name": c.name} for c in index.chunks]
+    (tmp_segment / "chunks.json").write_text(json.dumps(metas))
+    for name in ARRAYS:
+        np.save(tmp_segment / f"{name}.npy", np.ascontiguousarray(getattr(index, name)))
+    shutil.rmtree(segment, ignore_errors=True)
+    tmp_segment.rename(segment)
+
+
+def _indexed_commits(repo: str) -> list[str]:
+    segments = [p for p in _repo_dir(repo).iterdir() if (p / "chunks.json").exists()]
+    segments.sort(key=lambda p: p.stat().st_mtime, reverse=True)
+    return [p.name for p in segments[:MAX_CANDIDATES]]
+
+
+def _nearest_commit(mirror: Path, commit: str, candidates: list[str]) -> str | None:
+    best, best_distance = None, None
+    for candidate in candidates:
+        proc = subprocess.run(
+            ["git", "--git-dir", str(mirror), "rev-list", "--count", f"{candidate}...{commit}"],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+        )
+        if proc.returncode != 0:
+            continue
+        distance = int(proc.stdout.strip())
+        if best_distance is None or distance < best_distance:
+            best, best_distance = candidate, distance
+    return best
+
+
+def _changed_files(mirror: Path, old: str, new: str) -> set[str] | None:
+    proc = subprocess.run(
+        ["git", "--git-dir", str(mirror), "diff", "--name-only", old, new],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+    )
+    if proc.returncode != 0:
+        return None
+    return {line for line in proc.stdout.splitlines() if line}
+
+
+def _take_rows(base: BM25Index, docs: list[int]):
+    keep = np.zeros(len(base.doc_len), dtype=bool)
+    keep[docs] = True
+    entries = keep[base.entry_doc]
+    lengths = np.diff(base.indptr)[keep]
+    indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    return indptr, np.asarray(base.term_ids[entries]), np.asarray(base.tfs[entries]), np.asarray(base.doc_len[keep])
+
+
+"""
+Builds the index for repo@commit, reusing the nearest indexed commit's rows for
+every file that did not change between the two.
+"""
+def _build(repo: str, commit: str, checkout: Path, vocab: dict) -> BM25Index:
+    files = list_source_files(checkout)
+    mirror = ensure_mirror(repo)
+    base_commit = _nearest_commit(mirror, commit, _indexed_commits(repo))
+    changed = _changed_files(mirror, base_commit, commit) if base_commit else None
+    base = _load_segment(repo, base_commit, checkout, vocab) if changed is not None else None
+
+    if base is None:
+        print(f"    • Indexing {repo}@{commit[:12]} from scratch ({len(files)} files)")
+        return BM25Index(chunk_repo(checkout, files), vocab=vocab, repo_dir=checkout)
+
+    present = set(files)
+    reused_docs = [i for i, c in enumerate(base.chunks) if c.path in present and c.path not in changed]
+    reused_paths = {base.chunks[i].path for i in reused_docs}
+    fresh_chunks = chunk_repo(checkout, [f for f in files if f not in reused_paths])
+    print(f"    • Indexing {repo}@{commit[:12]} from {base_commit[:12]}: "
+          f"{len(reused_paths)} files reused, {len(files) - len(reused_paths)} re-tokenized")
+
+    old_rows = _take_rows(base, reused_docs)
+    new_rows = encode_chunks(fresh_chunks, vocab)
+    indptr = np.concatenate([old_rows[0], new_rows[0][1:] + old_rows[0][-1]])
+    arrays = (indptr, *(np.concatenate([a, b]) for a, b in zip(old_rows[1:], new_rows[1:])))
+    chunks = [Chunk(c.path, c.start, c.end, c.name) for c in (base.chunks[i] for i in reused_docs)] + fresh_chunks
+    return BM25Index(chunks, vocab=vocab, arrays=arrays, repo_dir=checkout)
+
+
+def index_for(repo: str, commit: str) -> BM25Index:
+    key = (repo, commit)
+    if key in _open_indexes:
+        return _open_indexes[key]
+
+    checkout = ensure_checkout(repo, commit)
+    with _repo_locks[repo]:
+        vocab = _load_vocab(repo)
+        index = _load_segment(repo, commit, checkout, vocab)
+        if index is None:
+            start = time.perf_counter()
+            index = _build(repo, commit, checkout, vocab)
+            _save_vocab(repo, vocab)
+            _save_segment(repo, commit, index)
+            print(f"    • Index ready in {time.perf_counter() - start:.1f}s")
+            index = _load_segment(repo, commit, checkout, vocab)
+        _open_indexes[key] = index
+    return index
@@ -0,0 +1,153 @@
+import atexit
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import docker
+
+from tracing import span
+
+
+"""
+Pool of warm containers keyed by image.
+
+Instead of creating a container per run and removing it in a finally block,
+callers lease a container for an image, use it, and hand it back. On release the
+pool runs the lease's reset command so the next lease starts clean; if the reset
+fails the container is destroyed instead of being reused. Checkouts live in
+bind-mounted workspaces that the caller deletes, so resets only deal with state
+left in the container itself: create_docker_container.reset_command clears /tmp
+and ~/.cache, candidate_ranking.py its candidate trees. Anything else a run
+changes in the container's filesystem (packages a test or conftest pip-installs,
+files written elsewhere) carries over to the next lease on that image; a caller
+that may leave such state behind sets discard=True.
+
+At most max_per_image containers exist per image (leases wait for one to come
+back), and at most max_idle containers are kept warm in total, oldest first out.
+"""
+class ContainerPool:
+    def __init__(self, client=None, max_per_image: int = 2, max_idle: int = 8):
+        self.client = client or docker.from_env()
+        self.max_per_image = max_per_image
+        self.max_idle = max_idle
+        self._cond = threading.Condition()
+        self._idle = defaultdict(list)      # image -> [(container, released_at)]
+        self._count = defaultdict(int)      # image -> live containers (idle + leased)
+        self.stats = {"created": 0, "reused": 0, "reset_failed": 0, "destroyed": 0}
+
+    def _create(self, image: str, run_kwargs: dict):
+        with span("container_create", "docker", image=image):
+            container = self.client.containers.run(
+                image=image,
+                command="sleep infinity",
+                detach=True,
+                tty=True,
+                **run_kwargs,
+            )
+        self.stats["created"] += 1
+        return container
+
+    def _destroy(self, image: str, container):
+        try:
+            container.remove(force=True)
+        except Exception:
+            pass
+        with self._cond:
+            self._count[image] -= 1
+            self.stats["destroyed"] += 1
+            self._cond.notify_all()
+
+    def _acquire(self, image: str, run_kwargs: dict):
+        with self._cond:
+            while True:
+                if self._idle[image]:
+                    container, _ = self._idle[image].pop()
+                    self.stats["reused"] += 1
+                    return container
+                if self._count[image] < self.max_per_image:
+                    self._count[image] += 1
+                    break
+                self._cond.wait()
+        try:
+            return self._create(image, run_kwargs)
+        except Exception:
+            with self._cond:
+                self._count[image] -= 1
+                self._cond.notify_all()
+            raise
+
+    def _release(self, image: str, container, reset_cmd: str | None):
+        from create_docker_container import _docker_exec
+
+        if reset_cmd:
+            try:
+                code, _, err = _docker_exec(container, reset_cmd)
+            except Exception as e:
+                code, err = 1, str(e)
+            if code != 0:
+                print(f"Container reset failed, discarding it: {err.strip()[:200]}")
+                self.stats["reset_failed"] += 1
+                self._destroy(image, container)
+                return
+
+        evicted = []
+        with self._cond:
+            self._idle[image].append((container, time.monotonic()))
+            idle = [(released, img, c) for img, entries in self._idle.items() for c, released in entries]
+            for _, img, c in sorted(idle, key=lambda item: item[0])[:max(0, len(idle) - self.max_idle)]:
+                self._idle[img] = [entry for entry in self._idle[img] if entry[0] is not c]
+                evicted.append((img, c))
+            self._cond.notify_all()
+        for img, c in evicted:
+            self._destroy(img, c)
+
+    """
+    Yields a running container for `image`. reset_cmd is run when the lease ends;
+    pass discard=True through the returned lease dict to drop the container instead.
+    """
+    @contextmanager
+    def lease(self, image: str, reset_cmd: str | None = None, **run_kwargs):
+        container = self._acquire(image, run_kwargs)
+        handle = {"container": container, "reset_cmd": reset_cmd, "discard": False}
+        try:
+            yield handle
+        except BaseException:
+            handle["discard"] = True
+            raise
+        finally:
+            if handle["discard"]:
+                self._destroy(image, container)
+            else:
+                self._release(image, container, handle["reset_cmd"])
+
+    """
+    Destroys the idle containers of `image`. Returns False when some are still
+    leased, i.e. the image is in use and must not be removed.
+    """
+    def drain(self, image: str) -> bool:
+        with self._cond:
+            idle = [c for c, _ in self._idle.pop(image, [])]
+            leased = self._count[image] - len(idle)
+        for c in idle:
+            self._destroy(image, c)
+        return leased == 0
+
+    def close(self):
+        with self._cond:
+            idle = [(img, c) for img, entries in self._idle.items() for c, _ in entries]
+            self._idle.clear()
+        for img, c in idle:
+            self._destroy(img, c)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_container_pool() -> ContainerPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ContainerPool()
+            atexit.register(_pool.close)
+        return _pool
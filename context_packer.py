@@ -0,0 +1,196 @@
+import os
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable, Iterable
+
+
+"""
+Token-budgeted prompt context.
+
+Callers hand over candidate snippets (traceback frames, retrieved chunks, the
+enclosing symbol, hints_text, ...) with a relevance score. Snippets are taken
+greedily by score while they fit the model's budget, counted with the model's
+real tokenizer. Snippets that point at line spans of a file are deduplicated: a
+span only pays for the lines no earlier snippet already covered, and overlapping
+or adjacent spans are rendered as one block.
+"""
+DEFAULT_MODEL = "gpt-4o"
+
+MODEL_BUDGETS = {
+    "gpt-4o": 24000,
+    "gpt-4o-mini": 24000,
+    "default": 12000,
+}
+
+
+@dataclass
+class Snippet:
+    score: float
+    text: str = ""
+    path: str | None = None     # set for file spans
+    start: int = 0              # 1-based, inclusive
+    end: int = 0
+    label: str = ""
+
+
+@lru_cache(maxsize=8)
+def _encoding(model: str):
+    import tiktoken
+
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        # tiktoken downloads its BPE files on first use; offline we fall back to an estimate
+        print(f"Tokenizer for {model} unavailable ({type(e).__name__}), estimating tokens from length")
+        return None
+
+
+def count_tokens(text: str, model: str = DEFAULT_MODEL) -> int:
+    if not text:
+        return 0
+    encoding = _encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+"""
+The model's context budget; SWEBENCH_CONTEXT_BUDGET overrides it for every
+model, and agents with a smaller fixed budget of their own use the lower of the two.
+"""
+def budget_for(model: str = DEFAULT_MODEL) -> int:
+    override = os.environ.get("SWEBENCH_CONTEXT_BUDGET")
+    if override:
+        return int(override)
+    return MODEL_BUDGETS.get(model, MODEL_BUDGETS["default"])
+
+
+def _subtract(start: int, end: int, covered: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    remaining = [(start, end)]
+    for c_start, c_end in covered:
+        next_remaining = []
+        for r_start, r_end in remaining:
+            if c_end < r_start or c_start > r_end:
+                next_remaining.append((r_start, r_end))
+                continue
+            if r_start < c_start:
+                next_remaining.append((r_start, c_start - 1))
+            if r_end > c_end:
+                next_remaining.append((c_end + 1, r_end))
+        remaining = next_remaining
+    return remaining
+
+
+def _merge(spans: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    merged = []
+    for start, end in sorted(spans):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def file_reader(root: Path) -> Callable[[str], list[str]]:
+    @lru_cache(maxsize=64)
+    def _read(path: str) -> list[str]:
+        try:
+            return (Path(root) / path).read_text(encoding="utf-8", errors="ignore").splitlines()
+        except OSError:
+            return []
+    return _read
+
+
+_HUNK_HEADER = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+\d+(?:,\d+)? @@")
+
+
+"""
+Line spans (in the pre-image) that each hunk of a unified diff touches, as
+{path: [(start, end), ...]}. Used to show the judge only the code the candidate
+diffs change.
+"""
+def diff_spans(diff: str) -> dict[str, list[tuple[int, int]]]:
+    spans = {}
+    path = None
+    for line in diff.splitlines():
+        if line.startswith("--- "):
+            source = line[4:].strip()
+            path = source[2:] if source.startswith("a/") else source
+            path = None if path == "/dev/null" else path
+            continue
+        match = _HUNK_HEADER.match(line)
+        if match and path is not None:
+            start = int(match.group(1))
+            length = int(match.group(2)) if match.group(2) is not None else 1
+            spans.setdefault(path, []).append((start, start + max(length, 1) - 1))
+    return spans
+
+
+class _SnippetLines:
+    def __init__(self, snippets: Iterable[Snippet]):
+        self._lines = {}
+        for snippet in snippets:
+            if snippet.path is None:
+                continue
+            lines = self._lines.setdefault(snippet.path, {})
+            for offset, line in enumerate(snippet.text.splitlines()):
+                lines.setdefault(snippet.start + offset, line)
+
+    def __call__(self, path: str) -> list[str]:
+        lines = self._lines.get(path, {})
+        if not lines:
+            return []
+        return [lines.get(i, "") for i in range(1, max(lines) + 1)]
+
+
+"""
+Packs snippets into at most `budget` tokens and renders them. File spans read
+their text through read_lines(path) -> lines; without it the snippets' own text
+is used.
+"""
+def pack(
+    snippets: list[Snippet],
+    budget: int | None = None,
+    model: str = DEFAULT_MODEL,
+    read_lines: Callable[[str], list[str]] | None = None,
+) -> str:
+    budget = budget if budget is not None else budget_for(model)
+    read_lines = read_lines or _SnippetLines(snippets)
+
+    used = 0
+    texts = []
+    covered = {}
+    for snippet in sorted(snippets, key=lambda s: -s.score):
+        if snippet.path is None:
+            cost = count_tokens(snippet.text, model)
+            if cost and used + cost <= budget:
+                texts.append(snippet)
+                used += cost
+            continue
+
+        lines = read_lines(snippet.path)
+        start, end = max(1, snippet.start), min(snippet.end, len(lines))
+        if start > end:
+            continue
+        new_spans = _subtract(start, end, covered.get(snippet.path, []))
+        if not new_spans:
+            continue
+        cost = sum(count_tokens("\n".join(lines[a - 1:b]), model) for a, b in new_spans)
+        cost += 0 if snippet.path in covered else count_tokens(f"[start of {snippet.path}]\n[end of {snippet.path}]", model)
+        if used + cost > budget:
+            continue
+        covered[snippet.path] = _merge(covered.get(snippet.path, []) + new_spans)
+        used += cost
+
+    blocks = [s.text if not s.label else f"{s.label}:\n{s.text}" for s in texts]
+    for path, spans in covered.items():
+        lines = read_lines(path)
+        for start, end in spans:
+            body = "\n".join(lines[start - 1:end])
+            blocks.append(f"[start of {path} lines {start}-{end}]\n{body}\n[end of {path}]")
+    return "\n\n".join(blocks)
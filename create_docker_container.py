@@ -1,11 +1,27 @@
+import codecs
+import io
 import os 
+import re
+import shlex
+import tarfile
 import tempfile
+import threading
+import time
 import uuid 
 import docker
 import subprocess 
-from pathlib import Path 
-from typing import Tuple
-from dataset import *
+from pathlib import Path, PurePosixPath
+from typing import Callable, Tuple
+from image_cache import get_image_cache
+from env_specs import EnvSpec, spec_for
+from container_pool import get_container_pool
+from git_mirror import ensure_mirror, mirror_mount
+from targeted_tests import pytest_command
+from pytest_results import parse_junit_xml, failure_summary
+from tracing import span
+from scheduler import cancel_event
+from wheelhouse import install_command, install_package_command, wheelhouse_mount
+from workspaces import chown_command, create_workspace, remove_workspace, workspace_mount
 
 
 """
@@ -17,153 +33,405 @@ def _write_patch_to_file(patch_text: str, target_dir: Path, filename: str) -> Pa
     return path
 
 """
-Creates the container
+Copies text into the container at `path` without going through the bind mount.
+"""
+def _put_file(container, path: str, text: str):
+    data = text.encode("utf-8")
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tar:
+        info = tarfile.TarInfo(name=os.path.basename(path))
+        info.size = len(data)
+        info.mtime = int(time.time())
+        tar.addfile(info, io.BytesIO(data))
+    container.put_archive(os.path.dirname(path), buf.getvalue())
+
+EXIT_TIMEOUT = 124
+
+
+"""
+Streaming exec inside a container.
+
+Iterating an ExecStream yields ("stdout" | "stderr", text) chunks as they arrive.
+The command runs in its own session (setsid) and writes its process-group id to a
+pidfile, so a watchdog thread can kill the whole group when the wall-clock
+`timeout` or the `idle_timeout` (no output) expires, when the on_output hook
+returns True, or when the instance that started it is cancelled by the scheduler
+(scheduler.cancel_event). exit_code and killed_reason are set once the stream is
+exhausted.
+"""
+class ExecStream:
+    def __init__(
+        self,
+        container: docker.models.containers.Container,
+        cmd: str,
+        workdir: str = "/workspace",
+        timeout: float | None = 600,
+        idle_timeout: float | None = None,
+        on_output: Callable[[str, str], bool] | None = None,
+    ):
+        self.container = container
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.on_output = on_output
+        self.exit_code = None
+        self.killed_reason = None
+        self._pidfile = f"/tmp/exec_{uuid.uuid4().hex}.pgid"
+        self._done = threading.Event()
+        self._cancel = cancel_event()
+
+        api = container.client.api
+        full_cmd = ["setsid", "bash", "-c", 'echo $$ > "$0"; exec bash -lc "$1"', self._pidfile, cmd]
+        self._exec_id = api.exec_create(
+            container.id, full_cmd, workdir=workdir, stdout=True, stderr=True, tty=False
+        )["Id"]
+        self._stream = api.exec_start(self._exec_id, stream=True, demux=True)
+        self._started = time.monotonic()
+        self._last_output = self._started
+        threading.Thread(target=self._watchdog, daemon=True).start()
+
+    def _watchdog(self):
+        while not self._done.wait(1.0):
+            now = time.monotonic()
+            if self.timeout is not None and now - self._started > self.timeout:
+                self.kill(f"timed out after {self.timeout}s")
+            elif self.idle_timeout is not None and now - self._last_output > self.idle_timeout:
+                self.kill(f"no output for {self.idle_timeout}s")
+            elif self._cancel is not None and self._cancel.is_set():
+                self.kill("cancelled, the instance timed out")
+
+    def kill(self, reason: str):
+        if self.killed_reason is not None:
+            return
+        self.killed_reason = reason
+        try:
+            self.container.exec_run(
+                ["bash", "-c", f'kill -KILL -- -$(cat {self._pidfile}) 2>/dev/null; rm -f {self._pidfile}']
+            )
+        except Exception as e:
+            print(f"Failed to kill exec: {e}")
+
+    def __iter__(self):
+        decoders = {name: codecs.getincrementaldecoder("utf-8")(errors="ignore") for name in ("stdout", "stderr")}
+        try:
+            for out_bytes, err_bytes in self._stream:
+                self._last_output = time.monotonic()
+                for name, data in (("stdout", out_bytes), ("stderr", err_bytes)):
+                    if not data:
+                        continue
+                    text = decoders[name].decode(data)
+                    if not text:
+                        continue
+                    yield name, text
+                    if self.on_output is not None and self.killed_reason is None and self.on_output(name, text):
+                        self.kill("stopped early by on_output")
+        finally:
+            self._done.set()
+            self.exit_code = self.container.client.api.exec_inspect(self._exec_id).get("ExitCode")
+            if self.killed_reason and self.killed_reason.startswith(("timed out", "no output", "cancelled")):
+                self.exit_code = EXIT_TIMEOUT
+
+
+"""
+Runs cmd in the container and returns (exit_code, stdout, stderr). Output is
+streamed and joined once at the end; a command that hits `timeout` (or
+`idle_timeout`) is killed and reported with exit code 124.
 """
 def _docker_exec(
     container: docker.models.containers.Container,
     cmd: str,
     workdir: str = "/workspace",
-    timeout: int = 600
+    timeout: int = 600,
+    idle_timeout: float | None = None,
+    on_output: Callable[[str, str], bool] | None = None,
 ) -> Tuple[int, str, str]:
-    
-    full_cmd = f"bash -lc \"{cmd}\""
 
-    result = container.exec_run(full_cmd, workdir=workdir, demux=True, stderr=True, stdout=True, tty=False)
-    exit_code = result.exit_code
-    if isinstance(result.output, tuple):
-        out_bytes, err_bytes = result.output
-    else:
-        out_bytes, err_bytes = result.output, b""
-    stdout = out_bytes.decode("utf-8", errors="ignore") if out_bytes else ""
-    stderr = err_bytes.decode("utf-8", errors="ignore") if err_bytes else ""
-    return exit_code, stdout, stderr
+    with span(f"exec:{_command_label(cmd)}", "docker", cmd=cmd[:200]) as step:
+        stream = ExecStream(container, cmd, workdir=workdir, timeout=timeout,
+                            idle_timeout=idle_timeout, on_output=on_output)
+        chunks = {"stdout": [], "stderr": []}
+        for name, text in stream:
+            chunks[name].append(text)
 
+        stdout = "".join(chunks["stdout"])
+        stderr = "".join(chunks["stderr"])
+        if stream.killed_reason:
+            stderr += f"\n[exec {stream.killed_reason}]\n"
+        step.add(bytes_out=len(stdout) + len(stderr))
+        step.attrs["exit_code"] = stream.exit_code
+    return stream.exit_code, stdout, stderr
 
+
+_LEADING_CD = re.compile(r"^(?:cd \S+ && |rm -rf \S+ && |\S+=\S+ )+")
+
+def _command_label(cmd: str) -> str:
+    words = _LEADING_CD.sub("", " ".join(cmd.split())).split()
+    if words[:1] == ["python"] and words[1:2] == ["-m"]:
+        words = words[2:]
+    return " ".join(words[:2]) if words[:1] in (["git"], ["pip"], ["apt-get"]) else " ".join(words[:1])
+
+
+"""
+The docker run arguments every harness container (fresh or pooled) is started
+with. Instances work in their own workspace under the shared workspaces mount
+(workspaces.py), never in the container's /workspace.
+"""
+def container_run_kwargs(client) -> dict:
+    return {
+        "working_dir": "/workspace",
+        "volumes": {**mirror_mount(),
+                    **wheelhouse_mount(),
+                    **workspace_mount(), },
+    }
+
+
+"""
+Run when a pooled container goes back to the pool: clears what a test run leaves
+outside its workspace in the usual scratch places (/tmp, ~/.cache), keeping the
+bind mounts (and the directories leading to them, e.g. when the cache dir itself
+sits under /tmp) and the exec pid files. Packages a test pip-installs into the
+environment are not undone, see container_pool.py.
 """
-Creates the docker container in the mounted at ./container. Installs all dependencies and runs test path + test suite. Records stderr output to find problem files.
+RESET_DIRS = ("/tmp", "$HOME/.cache")
+
+def reset_command(run_kwargs: dict) -> str:
+    keep = set()
+    for volume in run_kwargs.get("volumes", {}).values():
+        path = PurePosixPath(volume["bind"])
+        keep.update(str(p) for p in (path, *path.parents) if p != p.parent)
+    excludes = " ".join(f"! -path {shlex.quote(p)}" for p in sorted(keep))
+    dirs = " ".join(f'"{d}"' for d in RESET_DIRS)
+    return (f'for d in {dirs}; do [ ! -d "$d" ] || find "$d" -mindepth 1 -maxdepth 1 '
+            f"! -name 'exec_*.pgid' {excludes} -exec rm -rf {{}} +; done")
+
+
+"""
+Creates a docker container for the instance, installs all dependencies and runs test path + test suite. Records stderr output to find problem files.
+
+Two modes: setup_only = True/False -> Whether this container persists. With the
+image cache the container is leased from the warm pool (container_pool.py): setup_only
+just warms it up, and after a run it is handed back instead of being destroyed.
+
+The checkout lives in a per-run copy-on-write workspace (workspaces.py) that is
+mounted at the same path in the container and thrown away afterwards, so
+concurrent instances, even of the same repo, never share a working tree.
+
+With use_image_cache the toolchain and repo dependencies come from a prebuilt
+instance image (see image_cache.py), so nothing is installed here.
+
+The python version, system packages, install steps, test command and pytest
+markers come from the repo's env spec (env_specs.py); python_base_image, when
+given, only overrides the spec's base image.
 
-Two modes: setup_only = True/False -> Whether this container persists. Was thinking of allowing iterative changes to docker container. False for now. 
+Only the tests touched by test_patch are run (targeted_tests.py) unless full_suite is set;
+the full suite is spread over the container's cores with pytest-xdist (in every base image).
+stop_at_first_failure runs pytest with -x, so it stops after the first failing test;
+callers that only need one traceback (reproducing the bug) save the rest of the run.
 """
 def run_patch_and_tests_in_docker(
     repo: str,
     commit: str,
     test_patch: str,
     setup_only: bool,
-    python_base_image: str = "python:3.9-slim",
+    python_base_image: str | None = None,
+    version: str = "",
+    setup_commit: str = "",
+    use_image_cache: bool = True,
+    full_suite: bool = False,
+    stop_at_first_failure: bool = False,
 ) -> dict:
     
     client = docker.from_env()
+    results = {}
+    spec = spec_for(repo, version, python_base_image)
 
-    with tempfile.TemporaryDirectory(prefix="swebench_workspace_") as host_tmp_dir:
-        host_tmp = Path("/Users/suryagunukula/Developer/swebench-agent/container")
-        host_tmp.mkdir(parents=True, exist_ok=True) 
+    run_kwargs = container_run_kwargs(client)
 
-        container_workspace = "/workspace"
-        volume_name = "swebench_volume"
-        client.volumes.create(name=volume_name)
+    try:
+        ensure_mirror(repo, commit)
+    except Exception as e:
+        print(f"Could not fetch the repository: {e}. Aborting.")
+        results["clone_exit"] = (1, "", str(e))
+        return results
 
-        print(f"▶️  Launching container from image: {python_base_image}")
+    if use_image_cache:
+        image, build_result = get_image_cache().ensure_instance(
+            repo, commit, version=version, setup_commit=setup_commit,
+            python_base_image=python_base_image,
+        )
+        results["image_build_exit"] = build_result
+        if image is None:
+            print("Failed to build the environment image. Aborting.")
+            return results
+        results["image"] = image
+
+        if setup_only:
+            # nothing runs in a workspace, the lease only warms the pool
+            with get_container_pool().lease(image, reset_command(run_kwargs), **run_kwargs) as lease:
+                results["container_id"] = lease["container"].id
+            results["clone_exit"] = (0, "", "")
+            print("Setup-only mode complete. Container returned to the warm pool")
+            return results
+
+    try:
+        with span("workspace_create", "workspace"):
+            root = create_workspace(repo, commit)
+    except Exception as e:
+        print(f"Could not prepare the workspace: {e}. Aborting.")
+        results["clone_exit"] = (1, "", str(e))
+        return results
+    results["clone_exit"] = (0, "", "")
+    results["workspace"] = str(root)
+
+    try:
+        if not use_image_cache:
+            return _run_in_fresh_container(client, spec, run_kwargs, repo, commit,
+                                           test_patch, setup_only, root, full_suite,
+                                           stop_at_first_failure)
+
+        print(f"▶️  Leasing container for image: {image}")
+        with get_container_pool().lease(image, reset_command(run_kwargs), **run_kwargs) as lease:
+            container = lease["container"]
+            results["container_id"] = container.id
+            try:
+                _apply_and_test(container, root, test_patch, results, spec, full_suite,
+                                stop_at_first_failure)
+                return results
+            finally:
+                _release_workspace(container, root)
+    finally:
+        remove_workspace(root)
+
+
+"""
+Hands files the container wrote into the workspace back to the host user, so the
+workspace can be deleted from the host.
+"""
+def _release_workspace(container, root: Path):
+    cmd = chown_command(root)
+    if cmd:
+        try:
+            _docker_exec(container, cmd, workdir="/")
+        except Exception as e:
+            print(f"Could not chown {root}: {e}")
+
+
+def _run_in_fresh_container(client, spec: EnvSpec, run_kwargs, repo, commit, test_patch,
+                            setup_only, root: Path, full_suite,
+                            stop_at_first_failure) -> dict:
+    image = spec.image
+    print(f"▶️  Launching container from image: {image}")
+    with span("container_create", "docker", image=image):
         container = client.containers.run(
-            image=python_base_image,
+            image=image,
             command="sleep infinity",
-            working_dir="/workspace",
-            volumes={ str(host_tmp): {"bind": "/workspace", "mode": "rw"},
-                    volume_name: {"bind": "/mnt/shared", "mode": "rw"}, },
             detach=True,
             tty=True,  
+            **run_kwargs,
         )
 
-        try:
-            results = {}
-
-            cmd_install_deps = """
-                apt-get update && \
-                DEBIAN_FRONTEND=noninteractive apt-get install -y --no-install-recommends \
-                  git \
-                  build-essential \
-                  libssl-dev \
-                  python3-dev \
-                  python3-pip && \
-                pip install --upgrade pip pytest
-            """
-            print("    • Installing git, pytest, etc. inside container...")
-            code, out, err = _docker_exec(container, cmd_install_deps)
-            results["install_exit"] = (code, out, err)
-            if code != 0:
-                print("Failed to install dependencies. Aborting.")
-                return results
+    try:
+        results = _install_into_container(container, repo, commit, root, spec)
+        results["workspace"] = str(root)
+        if results.get("aborted"):
+            return results
 
+        if setup_only:
+            print("Setup-only mode complete. Skipping patching and testing")
+            return results
 
-            safe_name = repo.replace("/", "_")
-            clone_url = f"https://github.com/{repo}.git"
-            clone_dir = f"/workspace/{safe_name}"
-            cmd_clone = f"git clone {clone_url} {clone_dir} && cd {clone_dir} && git fetch && git checkout {commit}"
-            print(f"    • Cloning {repo}@{commit} …")
-            code, out, err = _docker_exec(container, cmd_clone)
-            results["clone_exit"] = (code, out, err)
-            if code != 0:
-                print("Git clone/checkout failed. Aborting.")
-                return results
+        _apply_and_test(container, root, test_patch, results, spec, full_suite,
+                        stop_at_first_failure)
+        return results
 
-            # 3) pip install the repository so that pytest can pick up the package 
-            cmd_install_repo = f"cd {clone_dir} && pip install simplejson pytz python-dateutil && pip install ."
-            print("    • pip install the repository (so pytest can import it)…")
-            code, out, err = _docker_exec(container, cmd_install_repo)
-            results["install_repo_exit"] = (code, out, err)
-            if code != 0:
-                print("pip install . failed. Aborting.")
-                return results
-            
-            cmd_install_repo = f"cd {clone_dir} && pip install -r requirements.txt && pip install hypothesis"
-            print("    • pip install the requirements repository (so pytest can import it)…")
-            code, out, err = _docker_exec(container, cmd_install_repo)
-            results["install_repo_exit"] = (code, out, err)
-
-            cmd_install_repo = f"cd {clone_dir} && pip install -r requirements-dev.txt"
-            print("    • pip install the dev requirements repository (so pytest can import it)…")
-            code, out, err = _docker_exec(container, cmd_install_repo)
-            results["install_repo_exit"] = (code, out, err)
-
-            if setup_only:
-                print("Setup-only mode complete. Skipping patching and testing")
-                return results
-            
+    finally:
+        _release_workspace(container, root)
+        if not setup_only:
 
+            print("▶️  Stopping and removing container …")
+            try:
+                container.stop(timeout=5)
+            except Exception:
+                pass
+            try:
+                container.remove(force=True)
+            except Exception:
+                pass
 
-            test_patch_file = _write_patch_to_file(test_patch, host_tmp, "tmp_test.patch")
 
-            cmd_apply_test = f"cd {clone_dir} && git apply /workspace/tmp_test.patch"
-            print("Applying test_patch …")
-            code, out, err = _docker_exec(container, cmd_apply_test)
-            results["apply_test_exit"] = (code, out, err)
-            if code != 0:
-                print("Failed to apply test_patch. Aborting.")
-                return results
+def _apply_and_test(container, root: Path, test_patch: str, results: dict,
+                    spec: EnvSpec, full_suite: bool = False, stop_early: bool = False):
+    clone_dir = root / "repo"
+    test_patch_file = _write_patch_to_file(test_patch, root, "test.patch")
 
-            cmd_pytest = f"cd {clone_dir} && pytest -q -m 'not dbt'"
-            print("    • Running pytest -q …")
-            code, out, err = _docker_exec(container, cmd_pytest)
-            results["pytest_exit"]   = code
-            results["pytest_stdout"] = out
-            results["pytest_stderr"] = err
+    cmd_apply_test = f"cd {clone_dir} && git apply {test_patch_file}"
+    print("Applying test_patch …")
+    code, out, err = _docker_exec(container, cmd_apply_test)
+    results["apply_test_exit"] = (code, out, err)
+    if code != 0:
+        print("Failed to apply test_patch. Aborting.")
+        return results
 
-            return results
+    report_name = ".pytest_report.xml"
+    (root / report_name).unlink(missing_ok=True)
+    test_cmd = pytest_command(test_patch, command=spec.test_prefix(), full_suite=full_suite,
+                              exitfirst=stop_early, xdist=full_suite, markers=spec.markers,
+                              junitxml=str(root / report_name))
+    cmd_pytest = f"cd {clone_dir} && {test_cmd}"
+    print(f"    • Running {test_cmd} …")
+    code, out, err = _docker_exec(container, cmd_pytest, timeout=1800, idle_timeout=600)
+    results["pytest_exit"]   = code
+    results["pytest_stdout"] = out
+    results["pytest_stderr"] = err
 
-        finally:
-            if not setup_only:
+    # typed per-test records; a run killed before pytest wrote the report leaves these empty
+    records = parse_junit_xml(root / report_name) or []
+    results["test_records"] = records
+    results["failure_summary"] = failure_summary(records)
 
-                print("▶️  Stopping and removing container …")
-                try:
-                    container.stop(timeout=5)
-                except Exception:
-                    pass
-                try:
-                    container.remove(force=True)
-                except Exception:
-                    pass
+    return results
+
+
+"""
+Uncached setup path: installs the toolchain and pip-installs the workspace's checkout
+inside a fresh python image. Sets results["aborted"] when a required step fails.
+"""
+def _install_into_container(container, repo: str, commit: str, root: Path, spec: EnvSpec) -> dict:
+    results = {}
+    clone_dir = root / "repo"
+
+    print("    • Installing git, pytest, etc. inside container...")
+    code, out, err = _docker_exec(container, spec.base_recipe(), timeout=1800)
+    results["install_exit"] = (code, out, err)
+    if code != 0:
+        print("Failed to install dependencies. Aborting.")
+        results["aborted"] = True
+        return results
+
+    # the workspace already holds the checkout of commit
+    results["clone_exit"] = (0, "", "")
+
+    # 3) pip install the repository so that pytest can pick up the package 
+    cmd_install_repo = f"cd {clone_dir} && {install_package_command(spec)}"
+    print("    • pip install the repository (so pytest can import it)…")
+    code, out, err = _docker_exec(container, cmd_install_repo, timeout=1800)
+    results["install_repo_exit"] = (code, out, err)
+    if code != 0:
+        print("pip install . failed. Aborting.")
+        results["aborted"] = True
+        return results
+
+    # requirements (and dev requirements, best-effort) from the shared wheelhouse
+    cmd_install_repo = f"cd {clone_dir} && {install_command(spec, repo, commit)}"
+    print("    • pip install the requirements from the wheelhouse …")
+    code, out, err = _docker_exec(container, cmd_install_repo, timeout=1800)
+    results["install_repo_exit"] = (code, out, err)
+
+    return results
 
 
 if __name__ == "__main__":
+    from dataset import load_swe_bench_lite
+
     dev_set = load_swe_bench_lite('dev')
 
     example_repo       = dev_set[6]["repo"]
@@ -176,6 +444,7 @@ if __name__ == "__main__":
         commit=example_commit,
         test_patch=example_test_patch,
         setup_only=False,
-        python_base_image="python:3.9-slim"
+        version=dev_set[6]["version"],
+        setup_commit=dev_set[6]["environment_setup_commit"],
     )
 
@@ -1,32 +1,132 @@
-from datasets import load_dataset
+import re
+import shutil
+import threading
+from typing import TYPE_CHECKING
 
-def load_swe_bench_lite(split: str):
+from utils import cache_dir
+from git_mirror import offline
+from tracing import traced
 
-    dataset = load_dataset("princeton-nlp/SWE-bench_Lite")
-    try:
-        subset = dataset[split]
-        print(f"Loaded {len(subset)} examples")
-    except Exception as e: 
-        print(f"Failed to load dataset: {str(e)}")
-        return
-    
-    return subset
+if TYPE_CHECKING:
+    import numpy as np
+    from datasets import Dataset
+
+
+"""
+Lazy, offline dataset access.
+
+Each (dataset, split) is fetched from the hub once and saved under
+<cache>/datasets as Arrow files; after that it is opened with load_from_disk,
+which memory-maps the files instead of reading them, and never touches the
+network. Rows are never materialized here: only the requested columns are kept
+(the oracle `text` column is huge and most callers don't need it), and instances
+are selected by instance_id, repo or a regex over instance_id by computing a mask
+over those columns with pyarrow and handing the matching indices to
+Dataset.select, which is itself lazy. `datasets` and pyarrow are only imported once a split is
+actually opened.
+"""
+LITE = "princeton-nlp/SWE-bench_Lite"
+LITE_ORACLE = "princeton-nlp/SWE-bench_Lite_oracle"
+
+COLUMNS = [
+    "instance_id", "repo", "base_commit", "environment_setup_commit", "version",
+    "problem_statement", "hints_text", "test_patch", "FAIL_TO_PASS", "PASS_TO_PASS",
+]
+
+_open_lock = threading.Lock()
+
+
+def _split_dir(name: str, split: str):
+    return cache_dir("datasets", name.replace("/", "__")) / split
+
+
+def open_split(name: str, split: str) -> "Dataset":
+    from datasets import load_dataset, load_from_disk
+
+    path = _split_dir(name, split)
+    with _open_lock:
+        if not (path / "dataset_info.json").exists():
+            if offline():
+                raise FileNotFoundError(f"{name}[{split}] is not cached under {path} and SWEBENCH_OFFLINE is set")
+            subset = load_dataset(name, split=split)
+            tmp_path = path.with_name(split + ".partial")
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            subset.save_to_disk(str(tmp_path))
+            shutil.rmtree(path, ignore_errors=True)
+            tmp_path.rename(path)
+    return load_from_disk(str(path))
 
-def load_swe_bench_lite_bm25(split: str):
-    dataset = load_dataset("princeton-nlp/SWE-bench_Lite_oracle")
+
+"""
+Indices of the rows matching every given filter, computed on the Arrow columns.
+"""
+def select_indices(
+    subset: "Dataset",
+    instance_ids: list[str] | None = None,
+    repos: list[str] | None = None,
+    pattern: str | None = None,
+) -> "np.ndarray | None":
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    table = subset.data
+    mask = None
+
+    def _and(m):
+        return m if mask is None else pc.and_(mask, m)
+
+    if instance_ids is not None:
+        mask = _and(pc.is_in(table.column("instance_id"), value_set=pa.array(list(instance_ids))))
+    if repos is not None:
+        mask = _and(pc.is_in(table.column("repo"), value_set=pa.array(list(repos))))
+    if pattern is not None:
+        re.compile(pattern)     # fail on a bad pattern with Python's error, not Arrow's
+        mask = _and(pc.match_substring_regex(table.column("instance_id"), pattern))
+    if mask is None:
+        return None
+    return np.flatnonzero(mask.to_numpy(zero_copy_only=False))
+
+
+@traced(category="dataset")
+def load_split(
+    name: str,
+    split: str,
+    columns: list[str] | None = None,
+    instance_ids: list[str] | None = None,
+    repos: list[str] | None = None,
+    pattern: str | None = None,
+) -> "Dataset | None":
     try:
-        subset = dataset[split]
-        print(f"Loaded {len(subset)} examples")
+        subset = open_split(name, split)
     except Exception as e:
         print(f"Failed to load dataset: {str(e)}")
-        return
+        return None
+
+    indices = select_indices(subset, instance_ids, repos, pattern)
+    if indices is not None:
+        subset = subset.select(indices)
+    if columns is not None:
+        subset = subset.select_columns([c for c in columns if c in subset.column_names])
+    print(f"Loaded {len(subset)} examples")
     return subset
-    
+
+
+def load_swe_bench_lite(split: str, columns: list[str] | None = COLUMNS, **filters):
+    return load_split(LITE, split, columns=columns, **filters)
+
+
+"""
+The oracle variant; its `text` column (the oracle-retrieved files) is only
+loaded when asked for in `columns`.
+"""
+def load_swe_bench_lite_bm25(split: str, columns: list[str] | None = COLUMNS, **filters):
+    return load_split(LITE_ORACLE, split, columns=columns, **filters)
+
 
 if __name__ == '__main__':
     dev_set = load_swe_bench_lite('dev')
 
-    test_failure = load_swe_bench_lite('abc')   
-
-    dev_set2 = load_swe_bench_lite_bm25('dev') 
+    test_failure = load_swe_bench_lite('abc')
 
+    dev_set2 = load_swe_bench_lite_bm25('dev', columns=COLUMNS + ["text"], repos=["marshmallow-code/marshmallow"])
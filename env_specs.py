@@ -0,0 +1,98 @@
+import hashlib
+import json
+from dataclasses import asdict, dataclass, field, replace
+
+
+"""
+Declarative test environments, keyed by repo and version.
+
+An EnvSpec says what an instance's container needs: the Python version (and with
+it the base image), apt packages, extra pip packages (pure-python test helpers
+and compiled packages to prebuild into the wheelhouse), which requirements files
+to install, how to install the package itself, and how to run its tests. The
+image cache builds its layers from the spec instead of one recipe for every repo,
+and the harness and candidate ranking take the test command and pytest markers
+from it.
+
+Lookup goes (repo, version) -> repo -> DEFAULT_SPEC. env_hash() identifies the
+env layer by what is actually installed in it (the spec's environment fields plus
+the content of the requirements files at the setup commit), so instances of
+different versions that resolve to the same environment share one image and skip
+the build.
+"""
+@dataclass(frozen=True)
+class EnvSpec:
+    python: str = "3.9"
+    base_image: str = ""                # defaults to python:<python>-slim
+    system_packages: tuple[str, ...] = ("git", "build-essential", "libssl-dev", "python3-dev", "python3-pip")
+    pip_packages: tuple[str, ...] = ("simplejson", "pytz", "python-dateutil")
+    native_packages: tuple[str, ...] = ()
+    requirements: tuple[str, ...] = ("requirements.txt",)
+    dev_requirements: tuple[str, ...] = ("requirements-dev.txt", "requirements_dev.txt")
+    install: tuple[str, ...] = (".",)   # `pip install` targets, run from the checkout
+    test_command: str = "pytest"
+    markers: str | None = None
+    env: dict = field(default_factory=dict, hash=False)     # exported when the tests run
+
+    @property
+    def image(self) -> str:
+        return self.base_image or f"python:{self.python}-slim"
+
+    def base_recipe(self) -> str:
+        return (
+            "apt-get update && "
+            "DEBIAN_FRONTEND=noninteractive apt-get install -y --no-install-recommends "
+            f"{' '.join(self.system_packages)} && "
+            "rm -rf /var/lib/apt/lists/* && "
+            # workspaces are checked out on the host, so they belong to another uid
+            "git config --system --add safe.directory '*' && "
+            "pip install --upgrade pip pytest pytest-xdist"
+        )
+
+    def test_prefix(self) -> str:
+        exports = " ".join(f"{k}={v}" for k, v in sorted(self.env.items()))
+        return f"{exports} {self.test_command}" if exports else self.test_command
+
+
+DEFAULT_SPEC = EnvSpec()
+
+SPECS = {
+    "sqlfluff/sqlfluff": EnvSpec(
+        pip_packages=("hypothesis",),
+        markers="not dbt",
+    ),
+    "pvlib/pvlib-python": EnvSpec(
+        pip_packages=("pytest-mock", "requests-mock"),
+        native_packages=("numpy", "scipy", "pandas"),
+    ),
+    "pydicom/pydicom": EnvSpec(
+        pip_packages=(),
+    ),
+    "pylint-dev/astroid": EnvSpec(
+        pip_packages=(),
+    ),
+    "pyvista/pyvista": EnvSpec(
+        system_packages=DEFAULT_SPEC.system_packages + ("libgl1", "libxrender1", "xvfb"),
+        pip_packages=("pytest-mock",),
+        native_packages=("numpy", "vtk"),
+        env={"PYVISTA_OFF_SCREEN": "true"},
+    ),
+}
+
+
+def spec_for(repo: str, version: str = "", base_image: str | None = None) -> EnvSpec:
+    spec = SPECS.get((repo, version)) or SPECS.get(repo) or DEFAULT_SPEC
+    return replace(spec, base_image=base_image) if base_image else spec
+
+
+"""
+Hash of everything installed in the env layer: the spec's environment fields and
+the requirements files (name and content) the spec installs at that commit.
+"""
+def env_hash(spec: EnvSpec, requirement_files: dict[str, str]) -> str:
+    fields = asdict(spec)
+    for key in ("install", "test_command", "markers", "env"):
+        fields.pop(key)
+    fields["image"] = spec.image
+    payload = json.dumps({"spec": fields, "files": requirement_files}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
@@ -1,40 +1,105 @@
-from langgraph_agent import *
-from rag_agent import *
 import json
-from utils import *
+from pathlib import Path
+from typing import Callable
+from agents import get_agent
+from utils import strip_code_fence
+from scheduler import configure_limits, run_instances
+from journal import ResultJournal
+from dataset import COLUMNS, load_swe_bench_lite_bm25
+import tracing
+import time
 
 
 """
 Runs agent and creates prediction.json for evaluation
+
+Instances are spread over a bounded worker pool. Each finished instance is appended
+to the journal (predictions.jsonl next to output_path) and predictions.json is
+rematerialized from it, so a restarted run skips everything already completed.
+Each docker run works in its own workspace (workspaces.py), so up to max_docker
+containers run side by side. rank_mode="tests" ranks the ensemble's candidate diffs by
+running the tests instead of asking the LLM judge.
+
+instance_ids / repos / pattern (a regex over instance_id) pick the instances to
+run. choose_agent(datapoint) names the agent for each instance (see agents.py);
+by default instances in langgraph_instances go to the LangGraph agent and the
+rest to the RAG agent. Agents come from the lazy registry, so only the ones this
+run actually uses get imported and built. Basic instances share the host venv and
+run one at a time (basic_agent.py).
+
+Every stage is traced (tracing.py); trace.json and profile.txt go to run_dir,
+runs/trace_<timestamp>/ by default.
 """
-def eval():
-    dev_set = load_swe_bench_lite_bm25('dev')
+LANGGRAPH_INSTANCES = {
+    "marshmallow-code__marshmallow-1359",
+    "marshmallow-code__marshmallow-1343",
+}
 
-    final_results = []
+def eval(
+    max_workers: int = 8,
+    max_docker: int = 4,
+    max_llm: int = 4,
+    instance_timeout: float | None = 1800,
+    output_path: str = "predictions.json",
+    rank_mode: str = "judge",
+    journal_path: str | None = None,
+    run_dir: str | None = None,
+    split: str = "dev",
+    instance_ids: list[str] | None = None,
+    repos: list[str] | None = None,
+    pattern: str | None = None,
+    langgraph_instances: set[str] = LANGGRAPH_INSTANCES,
+    choose_agent: Callable[[dict], str] | None = None,
+):
+    if choose_agent is None:
+        choose_agent = lambda datapoint: "langgraph" if datapoint["instance_id"] in langgraph_instances else "rag"
 
+    # rag_agent falls back to the oracle `text` when retrieval is unavailable
+    dev_set = load_swe_bench_lite_bm25(split, columns=COLUMNS + ["text"],
+                                       instance_ids=instance_ids, repos=repos, pattern=pattern)
 
-    for i, datapoint in enumerate(dev_set):
-        if i != 5 and i != 6:
-            result = test_single_example_rag(datapoint)
-        else:
-            result = test_single_example(datapoint)
+    configure_limits(max_docker=max_docker, max_llm=max_llm)
+    journal = ResultJournal(journal_path or Path(output_path).with_suffix(".jsonl"), model_name="gpt-4o")
+    # graph checkpoints are scoped to this run (the journal), see journal.thread_id
+    agent_kwargs = {"langgraph": {"rank_mode": rank_mode, "run_id": journal.run_id},
+                    "rag": {"run_id": journal.run_id}}
+    order = dev_set["instance_id"]
+    completed = journal.completed()
+    if completed:
+        print(f"Resuming: {len(completed)} instances already in the journal")
+    todo = dev_set.select([i for i, instance_id in enumerate(order) if instance_id not in completed])
 
-        cleaned_result = strip_code_fence(result)
+    def worker(_, datapoint):
+        with tracing.span("instance", "instance", instance_id=datapoint["instance_id"]):
+            name = choose_agent(datapoint)
+            result = get_agent(name)(datapoint, **agent_kwargs.get(name, {}))
+        # basic_agent returns its whole result record
+        if isinstance(result, dict):
+            if result.get("error"):
+                raise RuntimeError(result["error"])
+            return result.get("llm_patch")
+        return result
 
-        final_results.append({
-            "instance_id": datapoint["instance_id"],
-            "model_name_or_path": "gpt-4o",
-            "model_patch": cleaned_result
-        })
+    def on_result(_, datapoint, result, error):
+        if error is not None:
+            print(f"{datapoint['instance_id']} failed: {error}")
+        journal.append(datapoint["instance_id"], strip_code_fence(result or ""),
+                       error=None if error is None else repr(error))
+        journal.materialize(output_path, order)
+        print(f"✔ {datapoint['instance_id']} written to {output_path}")
 
-    output_path = "predictions.json"
-    with open(output_path, "w") as f:
-        json.dump(final_results, f, indent=2)    
+    journal.materialize(output_path, order)
+    run_instances(
+        todo,
+        worker,
+        on_result,
+        max_workers=max_workers,
+        instance_timeout=instance_timeout,
+    )
+    journal.close()
+    tracing.write_report(run_dir or Path("runs") / time.strftime("trace_%Y%m%d_%H%M%S"))
 
 
 if __name__ == '__main__':
     eval()
-    
-
-
 
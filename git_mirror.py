@@ -0,0 +1,114 @@
+import os
+import subprocess
+import threading
+from collections import defaultdict
+from pathlib import Path
+
+from utils import cache_dir
+
+
+"""
+Local bare-mirror object store shared by every clone.
+
+Each repo is mirrored once under <cache>/mirrors/<owner>_<name>.git and only
+fetched again when a requested commit is missing from it. Checkouts are
+`git clone --shared` clones of the mirror, so they borrow its objects through
+alternates instead of copying them. Containers get the mirror root bind-mounted
+read-only at the same absolute path, which keeps those alternates valid on both
+sides of the mount.
+
+Set SWEBENCH_OFFLINE=1 to forbid network fetches once the mirrors are seeded.
+"""
+_repo_locks = defaultdict(threading.Lock)
+
+
+class MirrorError(RuntimeError):
+    pass
+
+
+def offline() -> bool:
+    return os.environ.get("SWEBENCH_OFFLINE", "") not in ("", "0")
+
+
+def mirror_root() -> Path:
+    return cache_dir("mirrors")
+
+
+def mirror_path(repo: str) -> Path:
+    return mirror_root() / f"{repo.replace('/', '_')}.git"
+
+
+def mirror_mount() -> dict:
+    root = str(mirror_root())
+    return {root: {"bind": root, "mode": "ro"}}
+
+
+def _git(*args: str, check: bool = True) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        ["git", *args], check=check, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+    )
+
+
+def has_commit(mirror: Path, commit: str) -> bool:
+    proc = _git("--git-dir", str(mirror), "cat-file", "-e", f"{commit}^{{commit}}", check=False)
+    return proc.returncode == 0
+
+
+"""
+Returns the mirror for repo, creating it on first use and fetching only if
+`commit` is not already present.
+"""
+def ensure_mirror(repo: str, commit: str | None = None) -> Path:
+    mirror = mirror_path(repo)
+    with _repo_locks[repo]:
+        if not mirror.exists():
+            if offline():
+                raise MirrorError(f"No mirror for {repo} and SWEBENCH_OFFLINE is set")
+            repo_url = f"https://github.com/{repo}.git"
+            tmp_mirror = mirror.with_name(mirror.name + ".partial")
+            print(f"Mirroring {repo_url} into {mirror}")
+            _git("clone", "--mirror", "--quiet", repo_url, str(tmp_mirror))
+            tmp_mirror.rename(mirror)
+        elif commit and not has_commit(mirror, commit):
+            if offline():
+                raise MirrorError(f"{repo}@{commit} is not in the mirror and SWEBENCH_OFFLINE is set")
+            print(f"Refreshing mirror for {repo} (missing {commit[:12]})")
+            _git("--git-dir", str(mirror), "remote", "update", "--prune")
+
+        if commit and not has_commit(mirror, commit):
+            raise MirrorError(f"{repo}@{commit} not found upstream")
+    return mirror
+
+
+"""
+Checks out repo@commit into dest as a --shared clone of the mirror. An existing
+clone at dest is reused; it sees new mirror objects through its alternates.
+"""
+def clone_from_mirror(repo: str, commit: str, dest: Path) -> Path:
+    mirror = ensure_mirror(repo, commit)
+    if not (dest / ".git").exists():
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        _git("clone", "--quiet", "--shared", "--no-checkout", str(mirror), str(dest))
+    _git("-C", str(dest), "checkout", "--quiet", "--force", commit)
+    return dest
+
+
+"""
+Checkout of repo@commit under <cache>/checkouts, created once and shared by
+everything that only reads the tree at that commit. Don't modify it in place.
+"""
+def checkout_path(repo: str, commit: str) -> Path:
+    return cache_dir("checkouts") / f"{repo.replace('/', '_')}@{commit[:12]}"
+
+
+def ensure_checkout(repo: str, commit: str) -> Path:
+    dest = checkout_path(repo, commit)
+    with _repo_locks[str(dest)]:
+        if not (dest / ".git").exists() or not _is_at(dest, commit):
+            clone_from_mirror(repo, commit, dest)
+    return dest
+
+
+def _is_at(dest: Path, commit: str) -> bool:
+    proc = _git("-C", str(dest), "rev-parse", "HEAD", check=False)
+    return proc.returncode == 0 and proc.stdout.strip() == commit
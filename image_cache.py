@@ -0,0 +1,214 @@
+import hashlib
+import json
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import docker
+
+from utils import cache_dir
+from container_pool import get_container_pool
+from git_mirror import mirror_path, mirror_mount
+from tracing import span
+from wheelhouse import dependency_set, install_command, install_package_command, wheelhouse_mount
+from env_specs import DEFAULT_SPEC, EnvSpec, env_hash, spec_for
+
+
+"""
+Layered image cache for the test containers.
+
+    base      python image + apt toolchain + pytest, per env spec (env_specs.py)
+    env       base + repo clone (at /opt/src/<repo>, from the local mirror) + its
+              requirements, per (repo, env hash)
+    instance  env + checkout of base_commit + the spec's install steps, per base_commit
+
+Requirements are installed from the shared wheelhouse (wheelhouse.py), which is
+mounted into every build container, so rebuilding a layer copies wheels instead
+of downloading and compiling them again.
+
+Each layer is built once by running its recipe in a container started from the
+parent layer and `docker commit`-ing the result. Tags are derived from a hash of the
+parent tag and the recipe, so changing a recipe naturally invalidates everything
+built on top of it. Layers are evicted least-recently-used once the cache grows past
+disk_budget_gb.
+"""
+IMAGE_REPO = "swebench-agent"
+SRC_ROOT = "/opt/src"
+
+def _content_hash(*parts: str) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()[:16]
+
+
+def env_recipe(repo: str, spec: EnvSpec, setup_commit: str = "") -> str:
+    safe_name = repo.replace("/", "_")
+    src_dir = f"{SRC_ROOT}/{safe_name}"
+    checkout = f" && git checkout {setup_commit}" if setup_commit else ""
+    return (
+        f"git clone -q {mirror_path(repo)} {src_dir} && cd {src_dir}{checkout} && "
+        f"{install_command(spec, repo, setup_commit)}"
+    )
+
+
+def instance_recipe(repo: str, commit: str, spec: EnvSpec) -> str:
+    safe_name = repo.replace("/", "_")
+    src_dir = f"{SRC_ROOT}/{safe_name}"
+    return (
+        f"cd {src_dir} && (git cat-file -e {commit}^{{commit}} || git fetch -q origin) && "
+        f"git checkout {commit} && {install_package_command(spec)} && "
+        f"({install_command(spec, repo, commit)} || true)"
+    )
+
+
+class ImageCache:
+    def __init__(self, client=None, root: Path | None = None, disk_budget_gb: float = 60.0):
+        self.client = client or docker.from_env()
+        self.root = root or cache_dir("images")
+        self.index_path = self.root / "index.json"
+        self.disk_budget = int(disk_budget_gb * 1024 ** 3)
+        self._lock = threading.Lock()
+        self._build_locks = defaultdict(threading.Lock)
+        self._index = self._load_index()
+
+    def _load_index(self) -> dict:
+        if self.index_path.exists():
+            try:
+                return json.loads(self.index_path.read_text())
+            except json.JSONDecodeError:
+                pass
+        return {}
+
+    def _save_index(self):
+        tmp_path = self.index_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(self._index, indent=2))
+        tmp_path.replace(self.index_path)
+
+    def _exists(self, tag: str) -> bool:
+        try:
+            self.client.images.get(tag)
+            return True
+        except docker.errors.ImageNotFound:
+            return False
+
+    def _touch(self, tag: str):
+        with self._lock:
+            if tag in self._index:
+                self._index[tag]["last_used"] = time.time()
+                self._save_index()
+
+    """
+    Builds `tag` from `parent` by running `recipe` in a throwaway container and
+    committing it. Returns the (exit_code, stdout, stderr) of the recipe; on
+    failure nothing is committed.
+    """
+    def _build(self, layer: str, parent: str, tag: str, recipe: str):
+        from create_docker_container import _docker_exec
+
+        print(f"    • Building {layer} image {tag} …")
+        container = self.client.containers.run(
+            image=parent, command="sleep infinity", detach=True, tty=True,
+            volumes={**mirror_mount(), **wheelhouse_mount()},
+        )
+        try:
+            code, out, err = _docker_exec(container, recipe, workdir="/", timeout=3600, idle_timeout=900)
+            if code != 0:
+                return code, out, err
+            repository, image_tag = tag.rsplit(":", 1)
+            container.commit(repository=repository, tag=image_tag)
+        finally:
+            try:
+                container.remove(force=True)
+            except Exception:
+                pass
+
+        size = self.client.images.get(tag).attrs.get("Size", 0)
+        parent_size = self._index.get(parent, {}).get("size", 0)
+        with self._lock:
+            self._index[tag] = {
+                "layer": layer,
+                "parent": parent,
+                "size": size,
+                "layer_size": max(0, size - parent_size),
+                "last_used": time.time(),
+            }
+            self._save_index()
+        self.evict()
+        return code, out, err
+
+    def _ensure(self, layer: str, parent: str, recipe: str, key: str | None = None):
+        tag = f"{IMAGE_REPO}/{layer}:{key or _content_hash(parent, recipe)}"
+        with self._build_locks[tag]:
+            if self._exists(tag):
+                self._touch(tag)
+                return tag, (0, "cached", "")
+            with span(f"image_build:{layer}", "docker", tag=tag):
+                code, out, err = self._build(layer, parent, tag, recipe)
+            return (tag if code == 0 else None), (code, out, err)
+
+    def ensure_base(self, spec: EnvSpec = DEFAULT_SPEC):
+        return self._ensure("base", spec.image, spec.base_recipe())
+
+    """
+    The env layer is keyed by the repo and env_hash (the spec's environment plus
+    the content of its requirements files), not by version or setup commit, so
+    every instance that resolves to the same environment shares it.
+    """
+    def ensure_env(self, repo: str, spec: EnvSpec = DEFAULT_SPEC, setup_commit: str = ""):
+        base_tag, result = self.ensure_base(spec)
+        if base_tag is None:
+            return None, result
+        files = dependency_set(spec, repo, setup_commit)["files"]
+        key = _content_hash(base_tag, repo, env_hash(spec, files))
+        return self._ensure("env", base_tag, env_recipe(repo, spec, setup_commit), key=key)
+
+    def ensure_instance(self, repo: str, commit: str, version: str = "", setup_commit: str = "",
+                        python_base_image: str | None = None):
+        spec = spec_for(repo, version, python_base_image)
+        env_tag, result = self.ensure_env(repo, spec, setup_commit)
+        if env_tag is None:
+            return None, result
+        return self._ensure("instance", env_tag, instance_recipe(repo, commit, spec))
+
+    """
+    Removes least-recently-used layers until the cached layers fit the disk budget.
+    Layers that other cached layers are built on are kept until their children go,
+    and so are images the warm pool has leased containers of; the pool's idle
+    containers of an image are destroyed before it is removed.
+    """
+    def evict(self):
+        with self._lock:
+            total = sum(entry.get("layer_size", 0) for entry in self._index.values())
+            if total <= self.disk_budget:
+                return
+            for tag, entry in sorted(self._index.items(), key=lambda kv: kv[1]["last_used"]):
+                if total <= self.disk_budget:
+                    break
+                if any(other.get("parent") == tag for other in self._index.values()):
+                    continue
+                if not get_container_pool().drain(tag):
+                    continue
+                try:
+                    # without force, an image a container was started from since is kept
+                    self.client.images.remove(tag)
+                except docker.errors.APIError as e:
+                    print(f"Failed to evict {tag}: {e}")
+                    continue
+                print(f"    • Evicted {tag}")
+                total -= entry.get("layer_size", 0)
+                del self._index[tag]
+            self._save_index()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_image_cache() -> ImageCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ImageCache()
+        return _cache
@@ -0,0 +1,151 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from utils import cache_dir
+
+
+"""
+Append-only results journal for eval runs.
+
+Every finished instance is appended to a JSONL file as one line and fsync'ed
+before the run moves on, so a crash loses at most the instances still in flight.
+A restarted run reads the journal back, skips the instance_ids that already
+completed and materializes predictions.json from it. Later lines win, so an
+instance that failed and was retried ends up with its latest result. A torn last
+line (crash mid-write) is dropped when the journal is reopened.
+
+Every record carries the journal's run_id, which a reopened journal takes over
+from its records (a new journal gets a fresh one). Agents scope their graph
+checkpoints to it (thread_id), so only a restart of the same run resumes them.
+"""
+class ResultJournal:
+    def __init__(self, path: str | Path, model_name: str = "gpt-4o"):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.model_name = model_name
+        self._lock = threading.Lock()
+        self._records = {}
+        self.run_id = None
+        self._load()
+        self.run_id = self.run_id or uuid.uuid4().hex[:12]
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def _load(self):
+        if not self.path.exists():
+            return
+        data = self.path.read_bytes()
+        if data and not data.endswith(b"\n"):
+            # drop the torn line so the next append starts on a fresh one
+            data = data[:data.rfind(b"\n") + 1]
+            with open(self.path, "r+b") as f:
+                f.truncate(len(data))
+        for line in data.decode("utf-8", errors="ignore").splitlines():
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            self._records[record["instance_id"]] = record
+            self.run_id = record.get("run_id") or self.run_id
+
+    def completed(self) -> set[str]:
+        with self._lock:
+            return {iid for iid, record in self._records.items() if record.get("error") is None}
+
+    def append(self, instance_id: str, model_patch: str, error: str | None = None, **extra):
+        record = {
+            "instance_id": instance_id,
+            "model_name_or_path": self.model_name,
+            "model_patch": model_patch,
+            "error": error,
+            "finished_at": time.time(),
+            "run_id": self.run_id,
+            **extra,
+        }
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._records[instance_id] = record
+
+    """
+    Writes predictions.json (tmp file + os.replace) from the journal, in the order
+    of `order` (instance_ids) when given. Failed instances get an empty patch.
+    """
+    def materialize(self, output_path: str | Path, order: list[str] | None = None):
+        with self._lock:
+            records = dict(self._records)
+        ids = [iid for iid in order if iid in records] if order is not None else list(records)
+        rows = [
+            {
+                "instance_id": iid,
+                "model_name_or_path": records[iid]["model_name_or_path"],
+                "model_patch": records[iid]["model_patch"] or "",
+            }
+            for iid in ids
+        ]
+        output_path = Path(output_path)
+        tmp_path = output_path.with_suffix(output_path.suffix + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(rows, f, indent=2)
+        os.replace(tmp_path, output_path)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+"""
+Shared LangGraph checkpointer: per-node graph state is persisted in SQLite under
+the cache, keyed by thread_id (run id plus instance_id, see thread_id()), so an
+instance interrupted by a crash resumes at the node it was in when its run is
+restarted.
+"""
+_checkpointer = None
+_checkpointer_lock = threading.Lock()
+
+def get_checkpointer():
+    global _checkpointer
+    with _checkpointer_lock:
+        if _checkpointer is None:
+            from langgraph.checkpoint.sqlite import SqliteSaver
+
+            conn = sqlite3.connect(cache_dir("checkpoints") / "graphs.sqlite", check_same_thread=False)
+            _checkpointer = SqliteSaver(conn)
+        return _checkpointer
+
+
+"""
+Checkpoint thread for an instance within a run. Without a run_id (a one-off
+call) every call gets its own thread, so nothing is ever resumed.
+"""
+def thread_id(prefix: str, instance_id: str, run_id: str | None = None) -> str:
+    return f"{prefix}:{run_id or uuid.uuid4().hex[:12]}:{instance_id}"
+
+
+"""
+Invokes a compiled graph under thread_id. If an earlier run of the same thread
+stopped partway (its checkpoint still has nodes to run), it is resumed from there
+instead of starting over with `inputs`. The thread is deleted once the graph
+returns or raises, so only a crash leaves a checkpoint behind and a node that
+fails deterministically is retried from the start next time.
+"""
+def invoke_resumable(graph, inputs: dict, thread_id: str) -> dict:
+    config = {"configurable": {"thread_id": thread_id}}
+    try:
+        snapshot = graph.get_state(config)
+        if snapshot.next:
+            print(f"    • Resuming {thread_id} at {', '.join(snapshot.next)}")
+            return graph.invoke(None, config)
+        return graph.invoke(inputs, config)
+    finally:
+        graph.checkpointer.delete_thread(thread_id)
+
+
+def pending_thread(graph, thread_id: str) -> bool:
+    return bool(graph.get_state({"configurable": {"thread_id": thread_id}}).next)
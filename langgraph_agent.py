@@ -1,21 +1,26 @@
 from typing_extensions import Literal, TypedDict
 from typing import Annotated, List
 import operator
+import threading
 from pydantic import BaseModel, Field
-import os 
-import shutil
-from langchain_openai import ChatOpenAI
 from langgraph.graph import StateGraph, START, END
 from langchain_core.messages import HumanMessage, SystemMessage
 from langgraph.constants import Send
 from pathlib import Path
-import time
 
-from create_docker_container import *
+from agent_settings import ENSEMBLE_SIZE, FILE_CONTEXT_BUDGET, JUDGE_CONTEXT_BUDGET, TEMPERATURE
+from create_docker_container import run_patch_and_tests_in_docker
+from scheduler import docker_slot, llm_slot
+from llm_gateway import get_gateway
+from git_mirror import ensure_checkout
+from symbol_index import symbol_index_for
+from context_packer import Snippet, budget_for, diff_spans, file_reader, pack
+from patch_validation import validate_candidates
+from candidate_ranking import rank_candidates
+from journal import get_checkpointer, invoke_resumable, pending_thread, thread_id as checkpoint_thread
+from tracing import traced
 
-api_key = os.environ.get("OPENAI_API_KEY")
-
-llm = ChatOpenAI(model="gpt-4o", api_key=api_key, temperature=0.8)
+HEADER_LINES = 40
 
 """
 High-level notes (for personal use)
@@ -39,6 +44,12 @@ class FindFile(BaseModel):
 
 class State(TypedDict):
     repo_dir: str
+    commit: str
+    test_patch: str
+    version: str
+    setup_commit: str
+    rank_mode: str      # "judge" (LLM picks) or "tests" (run each candidate's tests)
+    source_file: str
     problem_statement: str
     context: str 
     output: str
@@ -46,49 +57,69 @@ class State(TypedDict):
     error_file: FindFile
 
 
-file_model = llm.with_structured_output(FindFile)
-
+@traced("node:find_file", "graph")
 def find_file(state: State):
-    file = file_model.invoke(
-        [
-            SystemMessage(
-                content="You are an expert software engineer reviewing a test failure."
-                        " Your task is to locate the actual **source code file** (not a test file) "
-                        "that is responsible for the failure. The error message may come from a test file, "
-                        "but your goal is to trace the root cause to the source code being tested. "
-                        "Output the name of the source file (e.g., something in `src/`), the exact line you suspect "
-                        "is causing the issue, and a clear human-readable explanation of the error."
-                        " Do not choose files named like `test_*.py` or located in `tests/`."
-            ),
-            HumanMessage(
-                content=f"Here is the error: {state['error']}"
-            )
-        ]
-    )
+    with llm_slot():
+        file = get_gateway().invoke(
+            [
+                SystemMessage(
+                    content="You are an expert software engineer reviewing a test failure."
+                            " Your task is to locate the actual **source code file** (not a test file) "
+                            "that is responsible for the failure. The error message may come from a test file, "
+                            "but your goal is to trace the root cause to the source code being tested. "
+                            "Output the name of the source file (e.g., something in `src/`), the exact line you suspect "
+                            "is causing the issue, and a clear human-readable explanation of the error."
+                            " Do not choose files named like `test_*.py` or located in `tests/`."
+                ),
+                HumanMessage(
+                    content=f"Here is the error: {state['error']}"
+                )
+            ],
+            temperature=TEMPERATURE,
+            schema=FindFile,
+            namespace="find_file",
+        )
 
     return {"error_file": file}
 
+"""
+Resolves the file named by find_file through the checkout's symbol index, so
+non-`src/` layouts and duplicate basenames land on the right file.
+"""
+@traced("node:load_file", "graph")
 def load_file(state:State):
-    file_to_load = Path(state['error_file'].file_name).name
-    full_repo_name = state['repo_dir']
-    repo_name = full_repo_name.split("/")[1]
-
-    safe_name = full_repo_name.replace("/", "_")
-
-    file_path = Path(f"./container/{safe_name}/src/{repo_name}/{file_to_load}")
-    print(safe_name , "+", file_to_load)
-
-    if not file_path.exists():
-        raise FileNotFoundError(f"File not found: {file_path}")
-
-    with open(file_path, "r", encoding="utf-8") as f:
-        content = f.read()
+    error_file = state['error_file']
+    checkout = ensure_checkout(state['repo_dir'], state['commit'])
+    index = symbol_index_for(str(checkout))
+
+    resolved = index.resolve(error_file.file_name, error_file.file_line)
+    if resolved is None:
+        raise FileNotFoundError(f"File not found in {state['repo_dir']}@{state['commit'][:12]}: {error_file.file_name}")
+    rel_path, symbol = resolved
+    print(state['repo_dir'], "+", rel_path, f"({symbol.qualname} lines {symbol.start}-{symbol.end})")
+
+    # enclosing symbol first, then the lines around the suspect line, the imports and
+    # the rest of the file, for as long as they fit
+    line_no = index.find_line(rel_path, error_file.file_line)
+    snippets = [
+        Snippet(3.0, path=rel_path, start=symbol.start, end=symbol.end),
+        Snippet(1.5, path=rel_path, start=1, end=HEADER_LINES),
+        Snippet(1.0, path=rel_path, start=1, end=len(index.lines(rel_path))),
+    ]
+    if line_no is not None:
+        snippets.append(Snippet(2.5, path=rel_path, start=line_no - 20, end=line_no + 20))
+    model = get_gateway().model
+    content = pack(snippets, budget=min(FILE_CONTEXT_BUDGET, budget_for(model)), model=model,
+                   read_lines=file_reader(checkout))
 
-    return {"context": content}
+    return {"context": content, "source_file": rel_path}
 
-def llm_call(state: State):
-    diff_report = llm.invoke(
-        [
+"""
+The ensemble's diff prompt for the localized file; also what batch.py submits
+for this stage.
+"""
+def ensemble_messages(state: State) -> list:
+    return [
             SystemMessage(content="You are an expert Python developer fixing a bug in a project. "
                                     "You are given a source file and an error that occurred during test execution. "
                                     "Your task is to write a minimal and correct **unified diff (git diff format)** "
@@ -108,89 +139,107 @@ def llm_call(state: State):
                             Do not comment out failing code or alter test files. Output only the diff.
                             """
             )
-        ]
-    )
-    return {"output": [diff_report]}
+    ]
 
+@traced("node:llm_call", "graph")
 def llm_call(state: State):
-    messages = [
-            SystemMessage(content="You are an expert Python developer fixing a bug in a project. "
-                                    "You are given a source file and an error that occurred during test execution. "
-                                    "Your task is to write a minimal and correct **unified diff (git diff format)** "
-                                    "that fixes the root cause of the issue—not the test file itself. "
-                                    "Do not silence or bypass the error unless it leads to a correct fix."
-                                    " You must keep all other behavior unchanged. "
-                                    "Focus on modifying only what’s needed to resolve the specific bug." \
-                                    "You must fix the root cause of the exception. Do not patch unrelated code. The traceback says the failure occurred at:"
-                         ),
-            HumanMessage(
-                content=f"""The following error occurred when running the test suite:
-                            \n\n{state['error_file']}\n
-                            This file appears to be the source of the issue. Below is its full content:
-                            \n\n{state['context']}\n
-                            Please write a **minimal** and **correct** unified diff (git diff format) that resolves the error.
-                            The fix must change only the logic that is **directly responsible** for the failure.
-                            Do not comment out failing code or alter test files. Output only the diff.
-                            """
-            )
-    ]
-    output1 = llm.invoke(messages).content
-    time.sleep(10)
-    output2 = llm.invoke(messages).content
-    time.sleep(10)
-    output3 = llm.invoke(messages).content
-    time.sleep(10)
+    # independent samples, issued concurrently by the gateway
+    with llm_slot():
+        outputs = get_gateway().sample(ensemble_messages(state), n=ENSEMBLE_SIZE, temperature=TEMPERATURE,
+                                       namespace="ensemble")
 
     return {
-        "output": [
-            output1, 
-            output2, 
-            output3
-        ]
+        "output": outputs
     }
 
 class ChosenDiff(BaseModel):
-    best_diff: str = Field(
-        description="The best unified diff (git diff format) among the given options that most directly and correctly resolves the issue"
+    best_diff: int = Field(
+        description="The number of the diff (as in [DIFF n]) among the given options that most directly and correctly resolves the issue"
     )
 
-evaluate_model = llm.with_structured_output(ChosenDiff)
-
-def ensemble_select_best_diff(state: State):
-    diffs = state["output"]  
+"""
+Context for the judge: only the code the candidate diffs touch (plus the module
+header), instead of the whole file llm_call saw.
+"""
+def judge_context(state: State, diffs: list[str]) -> str:
+    checkout = ensure_checkout(state['repo_dir'], state['commit'])
+    snippets = []
+    for diff in diffs:
+        for path, spans in diff_spans(diff).items():
+            snippets += [Snippet(2.0, path=path, start=start - 5, end=end + 5) for start, end in spans]
+    if state.get('source_file'):
+        snippets.append(Snippet(1.0, path=state['source_file'], start=1, end=HEADER_LINES))
+    model = get_gateway().model
+    context = pack(snippets, budget=min(JUDGE_CONTEXT_BUDGET, budget_for(model)), model=model,
+                   read_lines=file_reader(checkout))
+    return context or state['context']
 
-    evaluation = evaluate_model.invoke([
-        SystemMessage(
-            content="You are a senior software engineer. Your job is to evaluate 3 different proposed patches "
-                    "(in unified git diff format) and select the best one. "
-                    "The best patch is the one that: (1) directly fixes the root cause of the error, "
-                    "(2) avoids silencing the error, and (3) changes as little code as necessary."
-        ),
-        HumanMessage(
-            content=f"""The original error was:
-                    {state['error_file']}
+"""
+Picks the candidate that passes the most targeted tests (ties go to the smaller
+diff). Returns None when the tests can't run or no candidate passes any test, in
+which case the judge decides.
+"""
+def rank_by_tests(state: State, diffs: list[str]) -> str | None:
+    try:
+        with docker_slot():
+            runs = rank_candidates(state['repo_dir'], state['commit'], state.get('test_patch', ""), diffs,
+                                   version=state.get('version', ""), setup_commit=state.get('setup_commit', ""))
+    except Exception as e:
+        print(f"Test-based ranking unavailable ({e}), asking the judge")
+        return None
+    if not runs or runs[0].passed == 0:
+        return None
+    return runs[0].diff
 
-                    The context file is:
-                    {state['context']}
+"""
+Drops candidates that don't apply or don't compile (repairing headers and hunk
+counts on the way) before asking the judge, and skips the judge when at most one
+distinct valid candidate is left.
+"""
+@traced("node:ensemble_select_best_diff", "graph")
+def ensemble_select_best_diff(state: State):
+    checks = validate_candidates(state['repo_dir'], state['commit'], state["output"])
+    diffs = list(dict.fromkeys(c.diff for c in checks if c.valid))
+    if not diffs:
+        print("No candidate diff applies cleanly, keeping the first one")
+        return {"output": checks[0].diff if checks else ""}
+    if len(diffs) == 1:
+        return {"output": diffs[0]}
+
+    if state.get('rank_mode') == "tests":
+        best = rank_by_tests(state, diffs)
+        if best is not None:
+            return {"output": best}
+
+    listed = "\n\n".join(f"[DIFF {n}]\n{diff}" for n, diff in enumerate(diffs, start=1))
+    context = judge_context(state, diffs)
+    with llm_slot():
+        evaluation = get_gateway().invoke([
+            SystemMessage(
+                content=f"You are a senior software engineer. Your job is to evaluate {len(diffs)} different proposed patches "
+                        "(in unified git diff format) and select the best one. "
+                        "The best patch is the one that: (1) directly fixes the root cause of the error, "
+                        "(2) avoids silencing the error, and (3) changes as little code as necessary."
+            ),
+            HumanMessage(
+                content=f"""The original error was:
+                        {state['error_file']}
 
-                    Here are three proposed diffs:
+                        The code the diffs change is:
+                        {context}
 
-                    [DIFF 1]
-                    {diffs[0]}
+                        Here are {len(diffs)} proposed diffs:
 
-                    [DIFF 2]
-                    {diffs[1]}
+                        {listed}
 
-                    [DIFF 3]
-                    {diffs[2]}
+                        Which one is the best? Return only its number.
+                        """
+            )
+        ], temperature=TEMPERATURE, schema=ChosenDiff, namespace="judge")
 
-                    Which one is the best and why? Return only the best diff.
-                    """
-        )
-    ])
+    best = evaluation.best_diff
+    return {"output": diffs[best - 1] if 1 <= best <= len(diffs) else diffs[0]}
 
-    return {"output": evaluation.best_diff}
-    
 
 
 
@@ -199,58 +248,88 @@ def ensemble_select_best_diff(state: State):
 
 
 
+"""
+The graph is compiled (and the checkpointer opened) on first use, not at import.
+"""
+_graph_worker = None
+_graph_lock = threading.Lock()
 
-graph_builder = StateGraph(State)
-graph_builder.add_node("find_file", find_file)
-graph_builder.add_node("load_file", load_file)
-graph_builder.add_node("llm_call", llm_call)
-graph_builder.add_node("ensemble_select_best_diff", ensemble_select_best_diff)
+def get_graph_worker():
+    global _graph_worker
+    with _graph_lock:
+        if _graph_worker is None:
+            graph_builder = StateGraph(State)
+            graph_builder.add_node("find_file", find_file)
+            graph_builder.add_node("load_file", load_file)
+            graph_builder.add_node("llm_call", llm_call)
+            graph_builder.add_node("ensemble_select_best_diff", ensemble_select_best_diff)
 
-graph_builder.add_edge(START, "find_file")
-graph_builder.add_edge("find_file", "load_file")
-graph_builder.add_edge("load_file", "llm_call")
-graph_builder.add_edge("llm_call", "ensemble_select_best_diff")
-graph_builder.add_edge("ensemble_select_best_diff", END)
+            graph_builder.add_edge(START, "find_file")
+            graph_builder.add_edge("find_file", "load_file")
+            graph_builder.add_edge("load_file", "llm_call")
+            graph_builder.add_edge("llm_call", "ensemble_select_best_diff")
+            graph_builder.add_edge("ensemble_select_best_diff", END)
 
-graph_worker = graph_builder.compile()
+            _graph_worker = graph_builder.compile(checkpointer=get_checkpointer())
+        return _graph_worker
 
 
-def test_single_example(datapoint):
+"""
+rank_mode="tests" picks among the candidate diffs by running test_patch's tests
+against each of them (candidate_ranking.py) instead of asking the LLM judge.
+run_id (the results journal's) scopes the graph checkpoint, so a restarted run
+resumes its own interrupted instances and nothing else.
+"""
+def test_single_example(datapoint, rank_mode: str = "judge", run_id: str | None = None):
 
     example_repo       = datapoint["repo"]
     example_commit     = datapoint["base_commit"] 
     example_test_patch = datapoint["test_patch"]
     example_llm_patch  = datapoint["test_patch"]
 
-    results = run_patch_and_tests_in_docker(
-        repo=example_repo,
-        commit=example_commit,
-        test_patch=example_test_patch,
-        setup_only=False,
-        python_base_image="python:3.9-slim"
-    )
+    graph_worker = get_graph_worker()
+    thread_id = checkpoint_thread("langgraph", datapoint["instance_id"], run_id)
+    inputs = {}
+    if pending_thread(graph_worker, thread_id):
+        # an earlier run stopped inside the graph; its checkpoint already has the error
+        print(f"    • {thread_id} has a checkpoint, skipping the docker run")
+    else:
+        with docker_slot():
+            results = run_patch_and_tests_in_docker(
+                repo=example_repo,
+                commit=example_commit,
+                test_patch=example_test_patch,
+                setup_only=False,
+                version=datapoint.get("version", ""),
+                setup_commit=datapoint.get("environment_setup_commit", ""),
+                # find_file only needs the first failure
+                stop_at_first_failure=True,
+            )
 
-    print(results["pytest_stdout"])
+        print(results["pytest_stdout"])
 
-    state = graph_worker.invoke({"repo_dir": example_repo, "error": results["pytest_stdout"]})
+        # only the failing tests' frames go to find_file, not the whole pytest log
+        error = results.get("failure_summary") or results["pytest_stdout"]
+        inputs = {
+            "repo_dir": example_repo,
+            "commit": example_commit,
+            "error": error,
+            "test_patch": example_test_patch,
+            "version": datapoint.get("version", ""),
+            "setup_commit": datapoint.get("environment_setup_commit", ""),
+            "rank_mode": rank_mode,
+        }
 
-    print(state['error_file'])
+    # the nodes take their own llm/docker slots around each call
+    state = invoke_resumable(graph_worker, inputs, thread_id)
 
-    container_path = "./container"
-    if os.path.exists(container_path):
-        for filename in os.listdir(container_path):
-            file_path = os.path.join(container_path, filename)
-            try:
-                if os.path.isfile(file_path) or os.path.islink(file_path):
-                    os.unlink(file_path)  # remove file or link
-                elif os.path.isdir(file_path):
-                    shutil.rmtree(file_path)  # remove directory
-            except Exception as e:
-                print(f'Failed to delete {file_path}. Reason: {e}')
+    print(state['error_file'])
 
     return state['output']
 
 if __name__ == '__main__':
+    from dataset import load_swe_bench_lite
+
     dev_set = load_swe_bench_lite('dev')
     datapoint = dev_set[5]
     result = test_single_example(datapoint)
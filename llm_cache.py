@@ -0,0 +1,131 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+
+from utils import cache_dir
+
+
+"""
+Persistent, content-addressed cache of LLM responses.
+
+Entries are keyed by llm_gateway.request_key, i.e. a hash of (model, temperature,
+max_tokens, schema, messages, sample index), and grouped by namespace (find_file,
+ensemble, judge, rag, ...). Each namespace has its own TTL and LRU cap
+(DEFAULT_POLICIES); expired entries are dropped on read, except in replay mode,
+which has to answer old runs exactly.
+
+Modes, picked with SWEBENCH_LLM_CACHE:
+    on      read through the cache and store new responses (default)
+    replay  serve only from the cache; a miss raises CacheMiss instead of calling the API
+    off     bypass the cache entirely
+"""
+DAY = 24 * 3600
+
+DEFAULT_POLICIES = {
+    # namespace: (ttl seconds or None, max entries or None)
+    "default": (None, 50000),
+    # the expensive ones: several long samples per instance, and what batch runs join
+    "ensemble": (None, 60000),
+    "rag": (None, 20000),
+    # one short structured answer per instance
+    "find_file": (None, 20000),
+    # the judge's prompt changes with every candidate set, so old picks are rarely
+    # asked again; keep them for a week
+    "judge": (7 * DAY, 20000),
+    "basic": (30 * DAY, 10000),
+}
+
+
+class CacheMiss(KeyError):
+    pass
+
+
+class LLMCache:
+    def __init__(self, path: Path | None = None, mode: str | None = None, policies: dict | None = None):
+        self.path = path or cache_dir("llm") / "responses.sqlite"
+        self.mode = mode or os.environ.get("SWEBENCH_LLM_CACHE", "on")
+        self.policies = {**DEFAULT_POLICIES, **(policies or {})}
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                   key TEXT PRIMARY KEY,
+                   namespace TEXT NOT NULL,
+                   model TEXT NOT NULL,
+                   response TEXT NOT NULL,
+                   created REAL NOT NULL,
+                   last_used REAL NOT NULL
+               )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_ns_lru ON responses (namespace, last_used)")
+        self._conn.commit()
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+
+    def _policy(self, namespace: str):
+        return self.policies.get(namespace, self.policies["default"])
+
+    def get(self, namespace: str, key: str) -> str | None:
+        if not self.enabled:
+            return None
+        ttl, _ = self._policy(namespace)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and ttl is not None and now - row[1] > ttl and self.mode != "replay":
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                row = None
+            if row is None:
+                self.misses[namespace] += 1
+                if self.mode == "replay":
+                    raise CacheMiss(f"{namespace}:{key[:12]} not in cache (replay mode)")
+                return None
+            self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits[namespace] += 1
+            return row[0]
+
+    def put(self, namespace: str, key: str, model: str, response: str):
+        if self.mode != "on":
+            return
+        _, max_entries = self._policy(namespace)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, namespace, model, response, now, now),
+            )
+            if max_entries is not None:
+                self._conn.execute(
+                    """DELETE FROM responses WHERE namespace = ? AND key NOT IN (
+                           SELECT key FROM responses WHERE namespace = ?
+                           ORDER BY last_used DESC LIMIT ?)""",
+                    (namespace, namespace, max_entries),
+                )
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        namespaces = set(self.hits) | set(self.misses)
+        return {ns: {"hits": self.hits[ns], "misses": self.misses[ns]} for ns in sorted(namespaces)}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_llm_cache() -> LLMCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = LLMCache()
+        return _cache
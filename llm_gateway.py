@@ -0,0 +1,256 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+
+from agent_settings import DEFAULT_MODEL, model_name
+from llm_cache import get_llm_cache
+from context_packer import count_tokens
+from tracing import span
+from scheduler import wait_cancellable
+
+
+"""
+Shared LLM gateway used by every agent.
+
+All requests run on one background event loop, so ensemble samples go out
+concurrently and every worker thread shares the same limits:
+    - a request bucket and a token bucket (requests/tokens per minute)
+    - a cap on requests in flight
+    - backoff on 429s driven by the retry-after / x-ratelimit-reset-* headers
+    - identical requests already in flight are awaited instead of re-sent
+    - responses are read from / written to the persistent cache in llm_cache.py,
+      grouped by the namespace each call site passes; its sqlite I/O runs in a
+      worker thread (asyncio.to_thread), never on the loop itself
+
+Agent code calls the synchronous invoke()/sample() wrappers from graph nodes.
+The shared gateway uses agent_settings.model_name() (SWEBENCH_MODEL).
+"""
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float, capacity: float | None = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, amount: float = 1.0):
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+def _parse_duration(value: str | None) -> float | None:
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION.findall(value)
+    if not parts:
+        return None
+    return sum(float(n) * _UNITS[unit] for n, unit in parts)
+
+
+def retry_delay(error: Exception, attempt: int) -> float:
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        return float(retry_after_ms) / 1000.0
+    for name in ("retry-after", "x-ratelimit-reset-requests", "x-ratelimit-reset-tokens"):
+        delay = _parse_duration(headers.get(name))
+        if delay is not None:
+            return delay
+    return min(60.0, 2 ** attempt) + random.uniform(0, 1)
+
+
+def to_messages(messages) -> list[BaseMessage]:
+    converted = []
+    for message in messages:
+        if isinstance(message, BaseMessage):
+            converted.append(message)
+        elif message["role"] == "system":
+            converted.append(SystemMessage(content=message["content"]))
+        elif message["role"] == "assistant":
+            converted.append(AIMessage(content=message["content"]))
+        else:
+            converted.append(HumanMessage(content=message["content"]))
+    return converted
+
+
+def request_key(model: str, temperature, max_tokens, schema, messages, sample: int = 0) -> str:
+    payload = {
+        "model": model,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "schema": schema.model_json_schema() if schema is not None else None,
+        "messages": [(m.type, m.content) for m in messages],
+        "sample": sample,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class LLMGateway:
+    def __init__(
+        self,
+        model: str = DEFAULT_MODEL,
+        requests_per_minute: float = 500,
+        tokens_per_minute: float = 30000,
+        max_concurrency: int = 8,
+        max_retries: int = 6,
+    ):
+        self.model = model
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.api_key = os.environ.get("OPENAI_API_KEY")
+        self.stats = {"requests": 0, "coalesced": 0, "rate_limited": 0, "retries": 0}
+        self._clients = {}
+        self._inflight = {}
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="llm-gateway", daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._init_limits(), self._loop).result()
+
+    async def _init_limits(self):
+        self._requests = TokenBucket(self.requests_per_minute)
+        self._tokens = TokenBucket(self.tokens_per_minute)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    def _client(self, temperature, max_tokens, schema):
+        key = (temperature, max_tokens, schema)
+        if key not in self._clients:
+            kwargs = {"model": self.model, "api_key": self.api_key, "max_retries": 0}
+            if temperature is not None:
+                kwargs["temperature"] = temperature
+            if max_tokens is not None:
+                kwargs["max_tokens"] = max_tokens
+            from langchain_openai import ChatOpenAI
+
+            client = ChatOpenAI(**kwargs)
+            self._clients[key] = client.with_structured_output(schema) if schema is not None else client
+        return self._clients[key]
+
+    async def _send(self, messages, temperature, max_tokens, schema):
+        import openai
+
+        client = self._client(temperature, max_tokens, schema)
+        estimated_tokens = sum(len(str(m.content)) for m in messages) // 4 + (max_tokens or 1000)
+        for attempt in range(self.max_retries + 1):
+            await self._requests.acquire()
+            await self._tokens.acquire(estimated_tokens)
+            try:
+                async with self._semaphore:
+                    self.stats["requests"] += 1
+                    result = await client.ainvoke(messages)
+                return result if schema is not None else result.content
+            except openai.RateLimitError as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = retry_delay(e, attempt)
+                self.stats["rate_limited"] += 1
+                print(f"Rate limited, backing off {delay:.1f}s")
+                self._requests.pause(delay)
+            except (openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError) as e:
+                if attempt == self.max_retries:
+                    raise
+                self.stats["retries"] += 1
+                await asyncio.sleep(retry_delay(e, attempt))
+
+    async def ainvoke(self, messages, temperature=None, max_tokens=None, schema=None,
+                      sample: int = 0, namespace: str = "default"):
+        messages = to_messages(messages)
+        key = request_key(self.model, temperature, max_tokens, schema, messages, sample)
+
+        cache = await asyncio.to_thread(get_llm_cache)
+        cached = await asyncio.to_thread(cache.get, namespace, key)
+        if cached is not None:
+            return schema.model_validate_json(cached) if schema is not None else json.loads(cached)
+
+        if key in self._inflight:
+            self.stats["coalesced"] += 1
+            return await asyncio.shield(self._inflight[key])
+
+        task = asyncio.ensure_future(self._send(messages, temperature, max_tokens, schema))
+        self._inflight[key] = task
+        try:
+            result = await task
+        finally:
+            self._inflight.pop(key, None)
+
+        encoded = result.model_dump_json() if schema is not None else json.dumps(result)
+        await asyncio.to_thread(cache.put, namespace, key, self.model, encoded)
+        return result
+
+    async def asample(self, messages, n: int, temperature=None, max_tokens=None, schema=None,
+                      namespace: str = "default"):
+        return await asyncio.gather(*[
+            self.ainvoke(messages, temperature, max_tokens, schema, sample=i, namespace=namespace)
+            for i in range(n)
+        ])
+
+    """
+    Synchronous entry points for graph nodes and worker threads. invoke returns the
+    message content (or a `schema` instance); sample returns n independent samples.
+    """
+    def invoke(self, messages, temperature=None, max_tokens=None, schema=None, namespace: str = "default"):
+        with span(f"llm:{namespace}", "llm", model=self.model) as step:
+            coro = self.ainvoke(messages, temperature, max_tokens, schema, namespace=namespace)
+            result = wait_cancellable(asyncio.run_coroutine_threadsafe(coro, self._loop))
+            self._count_tokens(step, messages, [result])
+        return result
+
+    def sample(self, messages, n: int, temperature=None, max_tokens=None, schema=None,
+               namespace: str = "default"):
+        with span(f"llm:{namespace}", "llm", model=self.model, n=n) as step:
+            coro = self.asample(messages, n, temperature, max_tokens, schema, namespace=namespace)
+            results = wait_cancellable(asyncio.run_coroutine_threadsafe(coro, self._loop))
+            self._count_tokens(step, messages, results)
+        return results
+
+    def _count_tokens(self, step, messages, results):
+        prompt = "\n".join(str(m.content) for m in to_messages(messages))
+        outputs = [r.model_dump_json() if hasattr(r, "model_dump_json") else str(r) for r in results]
+        step.add(
+            tokens_in=count_tokens(prompt, self.model) * len(results),
+            tokens_out=sum(count_tokens(o, self.model) for o in outputs),
+        )
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+def get_gateway() -> LLMGateway:
+    global _gateway
+    with _gateway_lock:
+        if _gateway is None:
+            _gateway = LLMGateway(model=model_name())
+        return _gateway
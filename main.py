@@ -1,6 +1,263 @@
-def main():
-    print("Hello from swebench-agent!")
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+
+"""
+Command line entry point.
+
+    python main.py run [filters] [--agent rag] [--agent-for REPO_OR_ID=AGENT ...]
+    python main.py stage STAGE [filters] [--stage-dir runs/stages] [--force]
+    python main.py batch [STEP] [filters] [--agent rag] [--client openai] [--batch-dir runs/batch]
+
+`run` runs whole agents (eval.py) and writes predictions.json. `stage` runs one
+stage of the LangGraph pipeline (stages.py) for every selected instance, reusing
+whatever earlier stages already left in the stage dir; `stage predict` also
+writes predictions.json from the results. `batch` sends the diff prompts of the
+selected instances through the Batch API in one file instead of one request at
+a time (batch.py); its steps (collect, submit, wait, join) can also be run one by
+one against the same --batch-dir.
+
+Instances are picked with --instance / --repo / --pattern. --dry-run loads the
+dataset and prints what would run (the agent per instance, or the stages already
+cached) without touching docker or the LLM. --replay answers every LLM call from
+the response cache and keeps everything offline, so a run can be repeated
+exactly.
+
+Cache and budget options are passed on as environment variables, which the
+harness modules read when they use them (never at import time), so they are set
+right after parsing and the modules are imported only by the command that
+needs them.
+"""
+def _common(parser: argparse.ArgumentParser):
+    select = parser.add_argument_group("instances")
+    select.add_argument("--split", default="dev")
+    select.add_argument("--instance", action="append", dest="instance_ids", metavar="ID",
+                        help="instance_id to run (repeatable)")
+    select.add_argument("--repo", action="append", dest="repos", metavar="OWNER/NAME",
+                        help="run every instance of this repo (repeatable)")
+    select.add_argument("--pattern", help="regex over instance_id")
+
+    limits = parser.add_argument_group("concurrency and budgets")
+    limits.add_argument("--workers", type=int, default=8, help="instances in flight")
+    limits.add_argument("--max-docker", type=int, default=4, help="concurrent docker stages")
+    limits.add_argument("--max-llm", type=int, default=4, help="concurrent LLM stages")
+    limits.add_argument("--timeout", type=float, default=1800, help="seconds per instance (0 for none)")
+    limits.add_argument("--context-budget", type=int, help="max prompt context tokens")
+    limits.add_argument("--model", help="LLM model (default gpt-4o)")
+    limits.add_argument("--rank-mode", choices=("judge", "tests"), default="judge",
+                        help="how the ensemble picks among candidate diffs")
+
+    caches = parser.add_argument_group("caches")
+    caches.add_argument("--cache-dir", help="mirrors, checkouts, images index, LLM cache, datasets")
+    caches.add_argument("--llm-cache", choices=("on", "replay", "off"), help="LLM response cache mode")
+    caches.add_argument("--offline", action="store_true", help="never fetch from GitHub or the hub")
+    caches.add_argument("--replay", action="store_true", help="offline, and LLM answers only from the cache")
+
+    parser.add_argument("--dry-run", action="store_true", help="print what would run and exit")
+    parser.add_argument("--output", default="predictions.json")
+    parser.add_argument("--run-dir", help="trace output (default runs/trace_<timestamp>)")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="swebench-agent", description="Run SWE-bench Lite agents")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="run agents end to end and write predictions")
+    _common(run)
+    run.add_argument("--agent", default="rag", help="default agent: langgraph, rag or basic")
+    run.add_argument("--agent-for", action="append", default=[], metavar="REPO_OR_ID=AGENT",
+                     help="agent for one instance_id or repo (repeatable, instance_id wins)")
+    run.add_argument("--journal", help="results journal (default <output>.jsonl)")
+
+    stage = commands.add_parser("stage", help="run one pipeline stage")
+    _common(stage)
+    stage.add_argument("stage", help="setup, reproduce, localize, generate, validate or predict")
+    stage.add_argument("--stage-dir", default="runs/stages", help="where stage artifacts are kept")
+    stage.add_argument("--force", action="store_true", help="recompute the stage even if cached")
+
+    batch = commands.add_parser("batch", help="generate patches through the Batch API")
+    _common(batch)
+    batch.add_argument("step", nargs="?", default="all", choices=("collect", "submit", "wait", "join", "all"),
+                       help="run one step, or everything still to do (default)")
+    batch.add_argument("--agent", default="rag", help="default agent: rag or langgraph")
+    batch.add_argument("--agent-for", action="append", default=[], metavar="REPO_OR_ID=AGENT",
+                       help="agent for one instance_id or repo (repeatable, instance_id wins)")
+    batch.add_argument("--client", choices=("openai", "local"), default="openai",
+                       help="Batch API, or the in-process stub")
+    batch.add_argument("--batch-dir", default="runs/batch", help="requests, results and the manifest")
+    batch.add_argument("--poll-interval", type=float, default=60, help="seconds between status checks")
+    batch.add_argument("--stage-dir", default="runs/stages", help="where stage artifacts are kept")
+    batch.add_argument("--journal", help="results journal (default <output>.jsonl)")
+    return parser
+
+
+def _configure_env(args):
+    if args.cache_dir:
+        os.environ["SWEBENCH_CACHE_DIR"] = str(Path(args.cache_dir).resolve())
+    if args.offline or args.replay:
+        os.environ["SWEBENCH_OFFLINE"] = "1"
+    if args.replay:
+        os.environ["SWEBENCH_LLM_CACHE"] = "replay"
+    elif args.llm_cache:
+        os.environ["SWEBENCH_LLM_CACHE"] = args.llm_cache
+    if args.context_budget:
+        os.environ["SWEBENCH_CONTEXT_BUDGET"] = str(args.context_budget)
+    if args.model:
+        os.environ["SWEBENCH_MODEL"] = args.model
+
+
+def agent_chooser(default: str, overrides: list[str]):
+    from agents import AGENTS
+
+    by_key = {}
+    for item in overrides:
+        key, sep, name = item.partition("=")
+        if not sep:
+            raise SystemExit(f"--agent-for expects REPO_OR_ID=AGENT, got {item!r}")
+        by_key[key.strip()] = name.strip()
+    for name in [default, *by_key.values()]:
+        if name not in AGENTS:
+            raise SystemExit(f"unknown agent {name!r}, expected one of {', '.join(AGENTS)}")
+
+    def choose(datapoint) -> str:
+        return by_key.get(datapoint["instance_id"]) or by_key.get(datapoint["repo"]) or default
+    return choose
+
+
+def _load(args):
+    from dataset import COLUMNS, load_swe_bench_lite_bm25
+
+    columns = COLUMNS + ["text"] if args.command in ("run", "batch") else COLUMNS
+    dataset = load_swe_bench_lite_bm25(args.split, columns=columns, instance_ids=args.instance_ids,
+                                       repos=args.repos, pattern=args.pattern)
+    if dataset is None:
+        raise SystemExit(f"could not load the {args.split} split")
+    return dataset
+
+
+def run(args) -> int:
+    choose = agent_chooser(args.agent, args.agent_for)
+    if args.dry_run:
+        for datapoint in _load(args).select_columns(["instance_id", "repo"]):
+            print(f"{datapoint['instance_id']:<50} {choose(datapoint)}")
+        return 0
+
+    from eval import eval as run_eval
+
+    run_eval(
+        max_workers=args.workers,
+        max_docker=args.max_docker,
+        max_llm=args.max_llm,
+        instance_timeout=args.timeout or None,
+        output_path=args.output,
+        rank_mode=args.rank_mode,
+        journal_path=args.journal,
+        run_dir=args.run_dir,
+        split=args.split,
+        instance_ids=args.instance_ids,
+        repos=args.repos,
+        pattern=args.pattern,
+        choose_agent=choose,
+    )
+    return 0
+
+
+def stage(args) -> int:
+    from stages import STAGES, cached_stages, run_stage
+
+    if args.stage not in STAGES:
+        raise SystemExit(f"unknown stage {args.stage!r}, expected one of {', '.join(STAGES)}")
+    dataset = _load(args)
+    if args.dry_run:
+        for instance_id in dataset["instance_id"]:
+            cached = cached_stages(args.stage_dir, instance_id, args.rank_mode)
+            todo = [s for s in STAGES[:STAGES.index(args.stage) + 1] if s not in cached]
+            if args.force and args.stage not in todo:
+                todo.append(args.stage)
+            print(f"{instance_id:<50} cached: {','.join(cached) or '-'}  to run: {','.join(todo) or '-'}")
+        return 0
+
+    import tracing
+    from journal import ResultJournal
+    from scheduler import configure_limits, run_instances
+
+    configure_limits(max_docker=args.max_docker, max_llm=args.max_llm)
+    journal = ResultJournal(Path(args.output).with_suffix(".jsonl")) if args.stage == "predict" else None
+    failures = []
+
+    def worker(_, datapoint):
+        with tracing.span(f"stage:{args.stage}", "instance", instance_id=datapoint["instance_id"]):
+            return run_stage(args.stage, datapoint, args.stage_dir, force=args.force, rank_mode=args.rank_mode)
+
+    def on_result(_, datapoint, result, error):
+        if error is not None:
+            failures.append(datapoint["instance_id"])
+            print(f"{datapoint['instance_id']} failed at {args.stage}: {error!r}")
+        else:
+            print(f"✔ {datapoint['instance_id']} {args.stage}")
+        if journal is not None:
+            journal.append(datapoint["instance_id"], (result or {}).get("model_patch", ""),
+                           error=None if error is None else repr(error))
+
+    run_instances(dataset, worker, on_result, max_workers=args.workers,
+                  instance_timeout=args.timeout or None)
+    if journal is not None:
+        journal.materialize(args.output, dataset["instance_id"])
+        journal.close()
+        print(f"Predictions written to {args.output}")
+    tracing.write_report(args.run_dir or Path("runs") / time.strftime("trace_%Y%m%d_%H%M%S"))
+    return 1 if failures else 0
+
+
+def batch(args) -> int:
+    from batch import BATCH_AGENTS, collect, get_client, join, load_manifest, submit, wait
+
+    choose = agent_chooser(args.agent, args.agent_for)
+    dataset = _load(args)
+    if args.dry_run:
+        for datapoint in dataset.select_columns(["instance_id", "repo"]):
+            agent = choose(datapoint)
+            print(f"{datapoint['instance_id']:<50} {agent if agent in BATCH_AGENTS else f'{agent} (not batchable)'}")
+        return 0
+
+    from scheduler import configure_limits
+
+    configure_limits(max_docker=args.max_docker, max_llm=args.max_llm)
+    timeout = args.timeout or None
+    manifest = load_manifest(args.batch_dir)
+    if args.step == "collect" or (args.step == "all" and manifest is None):
+        manifest = collect(dataset, args.batch_dir, choose, stage_dir=args.stage_dir, rank_mode=args.rank_mode,
+                           max_workers=args.workers, instance_timeout=timeout)
+    if manifest is None:
+        raise SystemExit(f"nothing collected in {args.batch_dir}, run `batch collect` first")
+    if args.step == "collect":
+        return 0
+
+    if args.step == "submit" or (args.step == "all" and manifest["status"] == "collected"):
+        manifest = submit(get_client(args.client, args.batch_dir), args.batch_dir, manifest)
+    if args.step == "wait" or (args.step == "all" and manifest["status"] == "submitted"):
+        if manifest["batch_id"] is None:
+            raise SystemExit(f"no batch submitted from {args.batch_dir}, run `batch submit` first")
+        # the batch lives with the client that submitted it
+        client = get_client(manifest["client"], args.batch_dir)
+        manifest = wait(client, args.batch_dir, manifest, poll_interval=args.poll_interval)
+    if args.step in ("submit", "wait"):
+        return 0
+
+    failures = join(dataset, args.batch_dir, manifest, output_path=args.output, journal_path=args.journal,
+                    stage_dir=args.stage_dir, rank_mode=args.rank_mode, max_workers=args.workers,
+                    instance_timeout=timeout)
+    return 1 if failures else 0
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+    _configure_env(args)
+    return {"run": run, "stage": stage, "batch": batch}[args.command](args)
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
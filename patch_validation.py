@@ -0,0 +1,269 @@
+import re
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from utils import check_patch, strip_code_fence
+from git_mirror import ensure_checkout
+
+
+"""
+Cheap local checks on candidate diffs, run before any judge tokens are spent.
+
+Each candidate is normalized first: code fences are stripped, missing `---`/`+++`
+headers are rebuilt from the `diff --git` line, bare paths get their a/ b/
+prefixes and every hunk header is recounted from its body (LLMs rarely get the
+counts right). Hunks are then anchored on the real file: the start line is taken
+from where the hunk's old lines actually are, context lines are copied from the
+file (fixing whitespace drift) and a hunk without trailing context gets some, as
+git otherwise insists it sits at the end of the file. The result must pass
+`git apply --check` against the cached checkout, and every touched .py file must
+still compile once the diff is applied to a scratch copy of just those files.
+"""
+TRAILING_CONTEXT = 3
+_DIFF_GIT = re.compile(r"^diff --git a/(\S+) b/(\S+)")
+_HUNK = re.compile(r"^@@ -(\d+)(?:,\d+)? \+(\d+)(?:,\d+)? @@(.*)$")
+_HUNK_COUNTS = re.compile(r"^@@ -\d+(?:,(\d+))? \+\d+(?:,(\d+))? @@")
+
+
+@dataclass
+class CandidateCheck:
+    index: int
+    diff: str                   # normalized diff, what should be used downstream
+    valid: bool
+    repaired: bool = False      # normalization changed the diff
+    error: str = ""
+    files: list[str] = field(default_factory=list)
+
+
+def _prefixed(path: str, prefix: str) -> str:
+    if path == "/dev/null" or path.startswith(prefix):
+        return path
+    return prefix + path.lstrip("/")
+
+
+def _recount(header: re.Match, body: list[str]) -> str:
+    old = sum(1 for line in body if line[:1] in (" ", "-"))
+    new = sum(1 for line in body if line[:1] in (" ", "+"))
+    return f"@@ -{header.group(1)},{old} +{header.group(2)},{new} @@{header.group(3)}"
+
+
+"""
+Returns the diff with headers rebuilt and hunk counts recomputed. Blank lines
+inside a hunk are treated as blank context lines, which is what a model that
+dropped the leading space meant. Inside a hunk a `--- `/`+++ ` pair only starts
+the next file when a hunk header follows it; otherwise it is a removed and an
+added line (e.g. of `-- ` SQL comments).
+"""
+def normalize_diff(diff: str) -> str:
+    lines = strip_code_fence(diff.strip()).splitlines()
+    out = []
+    hunk = None
+    body = []
+
+    def _flush():
+        nonlocal hunk, body
+        if hunk is not None:
+            out.append(_recount(hunk, body))
+            out.extend(body)
+        hunk, body = None, []
+
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        next_line = lines[i + 1] if i + 1 < len(lines) else ""
+        match = _HUNK.match(line)
+        if match:
+            _flush()
+            hunk = match
+        elif line.startswith("diff --git "):
+            _flush()
+            out.append(line)
+            git_header = _DIFF_GIT.match(line)
+            # headers missing entirely: rebuild them from the diff --git line
+            rest = lines[i + 1:]
+            first_hunk = next((j for j, l in enumerate(rest) if _HUNK.match(l) or l.startswith("diff --git ")), len(rest))
+            if git_header and not any(l.startswith("--- ") for l in rest[:first_hunk]):
+                out += rest[:first_hunk]
+                out += [f"--- a/{git_header.group(1)}", f"+++ b/{git_header.group(2)}"]
+                i += first_hunk
+        elif line.startswith("--- ") and next_line.startswith("+++ ") and (
+                hunk is None or _HUNK.match(lines[i + 2] if i + 2 < len(lines) else "")):
+            _flush()
+            out.append("--- " + _prefixed(line[4:].strip(), "a/"))
+            out.append("+++ " + _prefixed(next_line[4:].strip(), "b/"))
+            i += 1
+        elif hunk is not None and (line == "" or line[0] in " +-\\"):
+            body.append(line if line else " ")
+        elif hunk is not None:
+            _flush()
+            out.append(line)
+        else:
+            out.append(line)
+        i += 1
+    _flush()
+
+    # trailing blank "context" lines are usually just the end of the model's output
+    while out and out[-1] == " ":
+        out.pop()
+    normalized = "\n".join(out) + "\n"
+    return normalized if normalized != "\n" else ""
+
+
+def _find_block(lines: list[str], block: list[str], near: int) -> int | None:
+    if not block:
+        return None
+    wanted = [l.rstrip() for l in block]
+    stripped = [l.rstrip() for l in lines]
+    starts = [i for i in range(len(lines) - len(block) + 1)
+              if stripped[i] == wanted[0] and stripped[i:i + len(block)] == wanted]
+    if not starts:
+        return None
+    return min(starts, key=lambda i: abs(i + 1 - near)) + 1
+
+
+"""
+Re-anchors every hunk on the file it patches (see the module notes). Hunks whose
+old lines can't be found are left untouched for `git apply` to judge. Expects the
+counts normalize_diff recomputed: a hunk's body is exactly as many lines as its
+header says, so body lines that look like file headers are never mistaken for one.
+"""
+def anchor_hunks(diff: str, read_lines) -> str:
+    out = []
+    lines = diff.splitlines()
+    file_lines = None
+    delta = 0
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if line.startswith("--- "):
+            path = line[4:].strip()
+            file_lines = None if path == "/dev/null" else read_lines(path[2:] if path.startswith("a/") else path)
+            delta = 0
+        match = _HUNK.match(line)
+        if not match:
+            out.append(line)
+            i += 1
+            continue
+
+        counts = _HUNK_COUNTS.match(line)
+        old_left, new_left = (int(n) if n is not None else 1 for n in counts.groups())
+        body = []
+        i += 1
+        while i < len(lines) and (old_left > 0 or new_left > 0 or lines[i][:1] == "\\"):
+            tag = lines[i][:1]
+            if tag not in (" ", "+", "-", "\\"):
+                break
+            old_left -= tag in (" ", "-")
+            new_left -= tag in (" ", "+")
+            body.append(lines[i])
+            i += 1
+        old_block = [l[1:] for l in body if l[:1] in (" ", "-")]
+        start = _find_block(file_lines, old_block, int(match.group(1))) if file_lines else None
+        if start is not None:
+            source = iter(file_lines[start - 1:])
+            body = [l[0] + next(source) if l[:1] in (" ", "-") else l for l in body]
+            trailing = 0
+            for l in reversed(body):
+                if l[:1] != " ":
+                    break
+                trailing += 1
+            end = start - 1 + len(old_block)
+            if trailing == 0 and end < len(file_lines) and not body[-1].startswith("\\"):
+                body += [" " + l for l in file_lines[end:end + TRAILING_CONTEXT]]
+            header = _HUNK.match(f"@@ -{start} +{start + delta} @@{match.group(3)}")
+        else:
+            header = match
+        out.append(_recount(header, body))
+        out.extend(body)
+        old = sum(1 for l in body if l[:1] in (" ", "-"))
+        new = sum(1 for l in body if l[:1] in (" ", "+"))
+        delta += new - old
+    return "\n".join(out) + "\n"
+
+
+def touched_files(diff: str) -> list[str]:
+    files = []
+    for line in diff.splitlines():
+        if line.startswith("+++ ") and line[4:].strip() != "/dev/null":
+            path = line[4:].strip()
+            files.append(path[2:] if path.startswith("b/") else path)
+    return list(dict.fromkeys(files))
+
+
+"""
+Applies the diff to a scratch copy of just the files it touches and compiles the
+resulting .py files. Returns an error message, or "" when everything compiles.
+"""
+def compile_touched(repo_dir: Path, diff: str, files: list[str]) -> str:
+    scratch = Path(tempfile.mkdtemp(prefix="candidate_"))
+    try:
+        for rel_path in files:
+            source = repo_dir / rel_path
+            if source.is_file():
+                (scratch / rel_path).parent.mkdir(parents=True, exist_ok=True)
+                shutil.copyfile(source, scratch / rel_path)
+        proc = subprocess.run(
+            ["git", "apply", "-"], input=diff, cwd=scratch,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+        )
+        if proc.returncode != 0:
+            return proc.stderr.strip()
+        for rel_path in files:
+            if not rel_path.endswith(".py") or not (scratch / rel_path).exists():
+                continue
+            try:
+                compile((scratch / rel_path).read_bytes(), rel_path, "exec")
+            except (SyntaxError, ValueError) as e:
+                return f"{rel_path}: {type(e).__name__}: {e}"
+        return ""
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def _reader(repo_dir: Path):
+    def _read(rel_path: str) -> list[str] | None:
+        try:
+            return (repo_dir / rel_path).read_text(encoding="utf-8").splitlines()
+        except (OSError, UnicodeDecodeError):
+            return None
+    return _read
+
+
+def validate_candidate(repo_dir: Path, diff: str, index: int = 0) -> CandidateCheck:
+    normalized = normalize_diff(diff or "")
+    if normalized.strip():
+        normalized = anchor_hunks(normalized, _reader(repo_dir))
+    check = CandidateCheck(index, normalized, valid=False, repaired=normalized.strip() != (diff or "").strip())
+    if not normalized.strip():
+        check.error = "empty diff"
+        return check
+    check.files = touched_files(normalized)
+    if not check.files:
+        check.error = "no file headers"
+        return check
+
+    ok, error = check_patch(repo_dir, normalized)
+    if not ok:
+        check.error = error
+        return check
+    check.error = compile_touched(repo_dir, normalized, check.files)
+    check.valid = not check.error
+    return check
+
+
+"""
+Validates every candidate against the checkout of repo@commit in parallel and
+returns the checks in candidate order.
+"""
+def validate_candidates(repo: str, commit: str, diffs: list[str]) -> list[CandidateCheck]:
+    repo_dir = ensure_checkout(repo, commit)
+    with ThreadPoolExecutor(max_workers=max(1, len(diffs))) as pool:
+        checks = list(pool.map(lambda item: validate_candidate(repo_dir, item[1], item[0]), enumerate(diffs)))
+    for check in checks:
+        status = "ok" if check.valid else f"invalid ({check.error.splitlines()[0] if check.error else '?'})"
+        print(f"    • Candidate {check.index + 1}: {status}{' after repair' if check.valid and check.repaired else ''}")
+    return checks
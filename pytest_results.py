@@ -0,0 +1,160 @@
+import re
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import IO, Iterable, Iterator
+
+from targeted_tests import is_test_file
+
+
+"""
+Typed pytest results read from the JUnit XML report (`pytest --junitxml=...`).
+
+The report is parsed with iterparse and every <testcase> is cleared once turned
+into a TestRecord, so memory stays flat no matter how large the log is. Tracebacks
+are reduced to their `path.py:LINE: ...` frames, which is all the LLM needs to
+locate the failure.
+"""
+_FRAME = re.compile(r"^(\S+\.py):(\d+):(?: (.*))?$")
+_EXCEPTION_LINE = re.compile(r"^E\s+(\w+(?:\.\w+)*(?:Error|Exception|Exit|Interrupt|Warning)|\w+Error)\b")
+_MESSAGE_TYPE = re.compile(r"^(\w+(?:\.\w+)*)(?::|$)")
+
+
+@dataclass
+class Frame:
+    path: str
+    line: int
+    text: str = ""      # what pytest printed after the location, usually the exception name
+    code: str = ""      # the `>` source line pytest marked in this frame
+
+
+@dataclass
+class TestRecord:
+    nodeid: str
+    outcome: str                    # "passed", "failed", "error" or "skipped"
+    duration: float = 0.0
+    exception_type: str | None = None
+    message: str = ""
+    frames: list[Frame] = field(default_factory=list)
+
+    @property
+    def failed(self) -> bool:
+        return self.outcome in ("failed", "error")
+
+
+def _parse_frames(longrepr: str) -> list[Frame]:
+    frames = []
+    code = ""
+    for line in longrepr.splitlines():
+        if line.startswith(">"):
+            code = line[1:].strip()
+            continue
+        match = _FRAME.match(line.strip())
+        if match:
+            frames.append(Frame(match.group(1), int(match.group(2)), match.group(3) or "", code))
+            code = ""
+    return frames
+
+
+def _exception_type(message: str, longrepr: str) -> str | None:
+    for line in reversed(longrepr.splitlines()):
+        match = _EXCEPTION_LINE.match(line)
+        if match:
+            return match.group(1)
+    match = _MESSAGE_TYPE.match(message.strip())
+    return match.group(1) if match else None
+
+
+"""
+The pytest node id (`tests/test_x.py::TestY::test_z`) of a <testcase>. JUnit
+only has the dotted classname (`tests.test_x.TestY`); the `file` attribute
+(junit_family=xunit1, which targeted_tests.pytest_args asks for) says where the
+module ends. Without it, the trailing capitalized components are taken as classes.
+"""
+def _nodeid(classname: str, name: str, file: str | None) -> str:
+    parts = classname.split(".") if classname else []
+    if file:
+        module_parts = len(Path(file).with_suffix("").parts)
+        path = file.replace("\\", "/")
+    else:
+        module_parts = len(parts)
+        while module_parts > 1 and parts[module_parts - 1][:1].isupper():
+            module_parts -= 1
+        path = "/".join(parts[:module_parts]) + ".py" if parts else ""
+    return "::".join([p for p in (path, *parts[module_parts:], name) if p])
+
+
+def _record(testcase: ET.Element) -> TestRecord:
+    record = TestRecord(
+        nodeid=_nodeid(testcase.get("classname", ""), testcase.get("name", ""), testcase.get("file")),
+        outcome="passed",
+        duration=float(testcase.get("time", 0) or 0),
+    )
+    for child in testcase:
+        if child.tag in ("failure", "error"):
+            record.outcome = "failed" if child.tag == "failure" else "error"
+        elif child.tag == "skipped":
+            record.outcome = "skipped"
+        else:
+            continue
+        record.message = child.get("message", "")
+        longrepr = child.text or ""
+        record.frames = _parse_frames(longrepr)
+        record.exception_type = child.get("type") or _exception_type(record.message, longrepr)
+        break
+    return record
+
+
+def iter_junit_records(source: str | Path | IO[bytes]) -> Iterator[TestRecord]:
+    source = source if hasattr(source, "read") else str(source)
+    for _, elem in ET.iterparse(source, events=("end",)):
+        if elem.tag == "testcase":
+            yield _record(elem)
+            elem.clear()
+
+
+def parse_junit_xml(source: str | Path | IO[bytes]) -> list[TestRecord] | None:
+    try:
+        return list(iter_junit_records(source))
+    except (OSError, ET.ParseError):
+        return None
+
+
+"""
+The frame most likely to point at the bug: the deepest non-test frame of the first
+failure, or its deepest frame if every frame is in a test file.
+"""
+def first_source_frame(records: Iterable[TestRecord]) -> Frame | None:
+    for record in records:
+        if not record.failed or not record.frames:
+            continue
+        source_frames = [f for f in record.frames if not is_test_file(f.path)]
+        return (source_frames or record.frames)[-1]
+    return None
+
+
+"""
+Compact description of the failures for the LLM: one block per failing test with
+the exception and only its traceback frames, instead of the whole pytest stdout.
+"""
+def failure_summary(records: Iterable[TestRecord], max_tests: int = 5, max_frames: int = 8,
+                    max_message: int = 1500) -> str:
+    blocks = []
+    failed = [r for r in records if r.failed]
+    for record in failed[:max_tests]:
+        lines = [f"FAILED {record.nodeid}"]
+        message = record.message.strip()
+        if len(message) > max_message:
+            message = message[:max_message] + " …"
+        if record.exception_type and not message.startswith(record.exception_type):
+            message = f"{record.exception_type}: {message}"
+        if message:
+            lines.append(f"  {message}")
+        for frame in record.frames[-max_frames:]:
+            lines.append(f"  {frame.path}:{frame.line}: {frame.text}".rstrip())
+            if frame.code:
+                lines.append(f"      > {frame.code}")
+        blocks.append("\n".join(lines))
+    if len(failed) > max_tests:
+        blocks.append(f"... and {len(failed) - max_tests} more failing tests")
+    return "\n\n".join(blocks)
@@ -1,20 +1,23 @@
 from typing_extensions import Literal, TypedDict
 from typing import Annotated, List
 import operator
+import threading
 from pydantic import BaseModel, Field
 import os 
 import shutil
-from langchain_openai import ChatOpenAI
 from langgraph.graph import StateGraph, START, END
 from langchain_core.messages import HumanMessage, SystemMessage
 from langgraph.constants import Send
 from pathlib import Path
 
-from create_docker_container import *
+from scheduler import llm_slot
+from llm_gateway import get_gateway
+from code_index import index_for
+from context_packer import Snippet, budget_for, pack
+from journal import get_checkpointer, invoke_resumable, thread_id as checkpoint_thread
+from tracing import traced
 
-api_key = os.environ.get("OPENAI_API_KEY")
-
-llm = ChatOpenAI(model="gpt-4o", api_key=api_key)
+RETRIEVAL_TOP_K = 50
 
 """
 High-level notes (for personal use)
@@ -34,9 +37,12 @@ class State(TypedDict):
     problem_statement: str
 
 
-def llm_call(state: State):
-    diff_report = llm.invoke(
-        [
+"""
+The diff prompt for a problem statement and its retrieved context; also what
+batch.py submits for this stage.
+"""
+def rag_messages(state: State) -> list:
+    return [
             SystemMessage(content="You are an expert Python developer fixing a bug in a project. "
                                     "You are given a source file and an error that occurred during test execution. "
                                     "Your task is to write a minimal and correct **unified diff (git diff format)** "
@@ -56,35 +62,79 @@ def llm_call(state: State):
                             """
             )
         ]
-    )
+
+
+@traced("rag:llm_call", "graph")
+def llm_call(state: State):
+    with llm_slot():
+        diff_report = get_gateway().invoke(rag_messages(state), namespace="rag")
     return {"output": [diff_report]}
 
 
 
-graph_builder = StateGraph(State)
-graph_builder.add_node("llm_call", llm_call)
+_graph_worker = None
+_graph_lock = threading.Lock()
+
+def get_graph_worker():
+    global _graph_worker
+    with _graph_lock:
+        if _graph_worker is None:
+            graph_builder = StateGraph(State)
+            graph_builder.add_node("llm_call", llm_call)
 
-graph_builder.add_edge(START, "llm_call")
-graph_builder.add_edge("llm_call", END)
+            graph_builder.add_edge(START, "llm_call")
+            graph_builder.add_edge("llm_call", END)
 
-graph_worker = graph_builder.compile()
+            _graph_worker = graph_builder.compile(checkpointer=get_checkpointer())
+        return _graph_worker
 
 
-def test_single_example_rag(datapoint):
+"""
+Retrieves the chunks of the repo at base_commit that best match the problem
+statement and packs them, together with hints_text, into the model's token budget.
+Falls back to the oracle `text` field when the checkout isn't available (e.g.
+offline without a seeded mirror).
+"""
+@traced("rag:retrieve_context", "graph")
+def retrieve_context(datapoint) -> str:
+    try:
+        index = index_for(datapoint["repo"], datapoint["base_commit"])
+    except Exception as e:
+        print(f"Retrieval unavailable ({e}), using the dataset text instead")
+        return datapoint.get("text", "")[:30000]
+
+    hits = index.search(datapoint["problem_statement"], k=RETRIEVAL_TOP_K)
+    snippets = [
+        Snippet(score, text=index.chunk_text(chunk), path=chunk.path, start=chunk.start, end=chunk.end)
+        for chunk, score in hits
+    ]
+    if datapoint.get("hints_text"):
+        top_score = max((s.score for s in snippets), default=0.0)
+        snippets.append(Snippet(top_score + 1, text=datapoint["hints_text"], label="Hints"))
+    model = get_gateway().model
+    return pack(snippets, budget=budget_for(model), model=model)
+
+
+def test_single_example_rag(datapoint, run_id: str | None = None):
 
     example_repo       = datapoint["repo"]
     example_commit     = datapoint["base_commit"] 
     example_test_patch = datapoint["test_patch"]
     problem_statement = datapoint["problem_statement"]
-    context  = datapoint["text"]
 
-    context = context[:30000]
+    context = retrieve_context(datapoint)
 
-    state = graph_worker.invoke({"repo_dir": example_repo, "context": context, "problem_statement": problem_statement})
+    state = invoke_resumable(
+        get_graph_worker(),
+        {"repo_dir": example_repo, "context": context, "problem_statement": problem_statement},
+        thread_id=checkpoint_thread("rag", datapoint["instance_id"], run_id),
+    )
 
-    return state['output'][0].content
+    return state['output'][0]
 
 if __name__ == '__main__':
+    from dataset import load_swe_bench_lite_bm25
+
     dev_set = load_swe_bench_lite_bm25('dev')
     datapoint = dev_set[5]
     result = test_single_example_rag(datapoint)
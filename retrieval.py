@@ -0,0 +1,240 @@
+import ast
+import re
+import subprocess
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+
+from context_packer import count_tokens
+
+
+"""
+BM25 retrieval over a checked-out repository.
+
+Python files are chunked along the AST (one chunk per top-level function, per
+method, per small class, plus the module-level code in between), so a hit is a
+self-contained unit of code rather than an arbitrary window. Chunks are indexed
+into a CSR-style term matrix and scored with vectorized BM25; file paths that
+mention query terms get a small boost.
+"""
+MAX_CHUNK_LINES = 120
+PATH_BOOST = 0.5
+
+_IDENTIFIER = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+_CAMEL = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+")
+_STOPWORDS = {
+    "the", "and", "for", "self", "def", "return", "import", "from", "none", "true",
+    "false", "not", "this", "that", "with", "class", "if", "else", "in", "is", "of",
+    "to", "a", "an", "be", "it", "as", "or", "on", "at", "by",
+}
+
+
+@dataclass
+class Chunk:
+    path: str
+    start: int      # 1-based, inclusive
+    end: int        # 1-based, inclusive
+    name: str
+    text: str | None = None     # None when loaded from a persisted index; read lazily
+
+
+def tokenize(text: str) -> list[str]:
+    tokens = []
+    for identifier in _IDENTIFIER.findall(text):
+        lowered = identifier.lower()
+        parts = [p.lower() for piece in identifier.split("_") for p in _CAMEL.findall(piece)]
+        for token in [lowered, *parts] if len(parts) > 1 else [lowered]:
+            if len(token) > 1 and token not in _STOPWORDS:
+                tokens.append(token)
+    return tokens
+
+
+def list_source_files(repo_dir: Path) -> list[str]:
+    proc = subprocess.run(
+        ["git", "-C", str(repo_dir), "ls-files", "*.py"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+    )
+    if proc.returncode == 0:
+        return [line for line in proc.stdout.splitlines() if line]
+    return [str(p.relative_to(repo_dir)) for p in repo_dir.rglob("*.py")]
+
+
+def _window_chunks(rel_path: str, lines: list[str], start: int, end: int, name: str) -> list[Chunk]:
+    chunks = []
+    for lo in range(start, end + 1, MAX_CHUNK_LINES):
+        hi = min(end, lo + MAX_CHUNK_LINES - 1)
+        text = "\n".join(lines[lo - 1:hi])
+        if text.strip():
+            chunks.append(Chunk(rel_path, lo, hi, name, text))
+    return chunks
+
+
+def chunk_source(rel_path: str, source: str) -> list[Chunk]:
+    lines = source.splitlines()
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+        return _window_chunks(rel_path, lines, 1, len(lines), rel_path)
+
+    spans = []
+    for node in tree.body:
+        if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            continue
+        start = min([node.lineno] + [d.lineno for d in node.decorator_list])
+        end = node.end_lineno
+        if isinstance(node, ast.ClassDef) and end - start + 1 > MAX_CHUNK_LINES:
+            methods = [n for n in node.body if isinstance(n, (ast.FunctionDef, ast.AsyncFunctionDef))]
+            header_end = (min(m.lineno for m in methods) - 1) if methods else end
+            spans.append((start, header_end, node.name))
+            for method in methods:
+                m_start = min([method.lineno] + [d.lineno for d in method.decorator_list])
+                spans.append((m_start, method.end_lineno, f"{node.name}.{method.name}"))
+        else:
+            spans.append((start, end, node.name))
+
+    chunks = []
+    cursor = 1
+    for start, end, name in sorted(spans):
+        if start > cursor:
+            chunks.extend(_window_chunks(rel_path, lines, cursor, start - 1, "<module>"))
+        chunks.extend(_window_chunks(rel_path, lines, start, end, name))
+        cursor = max(cursor, end + 1)
+    if cursor <= len(lines):
+        chunks.extend(_window_chunks(rel_path, lines, cursor, len(lines), "<module>"))
+    return chunks
+
+
+def chunk_repo(repo_dir: Path, files: list[str] | None = None) -> list[Chunk]:
+    chunks = []
+    for rel_path in files if files is not None else list_source_files(repo_dir):
+        try:
+            source = (repo_dir / rel_path).read_text(encoding="utf-8", errors="ignore")
+        except OSError:
+            continue
+        chunks.extend(chunk_source(rel_path, source))
+    return chunks
+
+
+"""
+Turns chunks into CSR rows (indptr, term_ids, tfs, doc_len), adding any new terms
+to `vocab` in place. Term ids are append-only, so rows built against an older
+version of the vocab stay valid.
+"""
+def encode_chunks(chunks: list[Chunk], vocab: dict):
+    indptr = [0]
+    term_ids = []
+    tfs = []
+    doc_len = []
+    for chunk in chunks:
+        counts = {}
+        tokens = tokenize(chunk.name + "\n" + (chunk.text or ""))
+        for token in tokens:
+            term = vocab.setdefault(token, len(vocab))
+            counts[term] = counts.get(term, 0) + 1
+        term_ids.extend(counts.keys())
+        tfs.extend(counts.values())
+        indptr.append(len(term_ids))
+        doc_len.append(len(tokens))
+    return (
+        np.asarray(indptr, dtype=np.int64),
+        np.asarray(term_ids, dtype=np.int32),
+        np.asarray(tfs, dtype=np.float32),
+        np.asarray(doc_len, dtype=np.float32),
+    )
+
+
+class BM25Index:
+    def __init__(self, chunks: list[Chunk], k1: float = 1.5, b: float = 0.75,
+                 vocab: dict | None = None, arrays=None, repo_dir: Path | None = None):
+        self.chunks = chunks
+        self.k1 = k1
+        self.b = b
+        self.vocab = vocab if vocab is not None else {}
+        self.repo_dir = repo_dir
+
+        if arrays is None:
+            arrays = encode_chunks(chunks, self.vocab)
+        self.indptr, self.term_ids, self.tfs, self.doc_len = arrays[:4]
+        self._path_terms = [set(tokenize(chunk.path)) for chunk in chunks]
+        if len(arrays) > 4:
+            self.entry_doc, self.entry_weight = arrays[4:6]
+        else:
+            self._prepare()
+
+    def _prepare(self):
+        n_docs = len(self.doc_len)
+        self.entry_doc = np.repeat(np.arange(n_docs, dtype=np.int32), np.diff(self.indptr))
+        df = np.bincount(self.term_ids, minlength=len(self.vocab)).astype(np.float32)
+        idf = np.log1p((n_docs - df + 0.5) / (df + 0.5))
+        avgdl = float(self.doc_len.mean()) if n_docs else 1.0
+        # per-entry BM25 term weight, precomputed so a query is one mask + bincount
+        norm = self.k1 * (1 - self.b + self.b * self.doc_len[self.entry_doc] / max(avgdl, 1.0))
+        self.entry_weight = (idf[self.term_ids] * self.tfs * (self.k1 + 1) / (self.tfs + norm)).astype(np.float32)
+
+    def chunk_text(self, chunk: Chunk) -> str:
+        if chunk.text is None:
+            lines = _read_lines(str(self.repo_dir / chunk.path)) if self.repo_dir else []
+            chunk.text = "\n".join(lines[chunk.start - 1:chunk.end])
+        return chunk.text
+
+    def score(self, query: str) -> np.ndarray:
+        query_tokens = set(tokenize(query))
+        query_ids = np.fromiter(
+            (self.vocab[t] for t in query_tokens if t in self.vocab), dtype=np.int32
+        )
+        n_docs = len(self.doc_len)
+        if n_docs == 0:
+            return np.zeros(0, dtype=np.float32)
+        mask = np.isin(self.term_ids, query_ids)
+        scores = np.bincount(self.entry_doc[mask], weights=self.entry_weight[mask], minlength=n_docs)
+        if PATH_BOOST:
+            boost = np.fromiter((len(terms & query_tokens) for terms in self._path_terms),
+                                dtype=np.float32, count=n_docs)
+            scores = scores + PATH_BOOST * boost
+        return scores
+
+    """
+    Returns the best-scoring chunks, highest first, stopping at k chunks. With a
+    token_budget, a chunk that would not fit in what is left is skipped and smaller
+    lower-ranked chunks are still packed.
+    """
+    def search(self, query: str, k: int = 20, token_budget: int | None = None) -> list[tuple[Chunk, float]]:
+        scores = self.score(query)
+        if len(scores) == 0:
+            return []
+        top = min(len(scores), max(k * 4, k))
+        candidates = np.argpartition(-scores, top - 1)[:top]
+        ranked = candidates[np.argsort(-scores[candidates], kind="stable")]
+
+        results = []
+        used = 0
+        for doc in ranked:
+            if len(results) >= k or scores[doc] <= 0:
+                break
+            chunk = self.chunks[doc]
+            if token_budget is not None:
+                cost = count_tokens(self.chunk_text(chunk))
+                if used + cost > token_budget:
+                    continue
+                used += cost
+            results.append((chunk, float(scores[doc])))
+        return results
+
+
+@lru_cache(maxsize=256)
+def _read_lines(path: str) -> list[str]:
+    try:
+        return Path(path).read_text(encoding="utf-8", errors="ignore").splitlines()
+    except OSError:
+        return []
+
+
+def format_chunks(hits: list[tuple[Chunk, float]]) -> str:
+    blocks = []
+    for chunk, _ in hits:
+        blocks.append(
+            f"[start of {chunk.path} lines {chunk.start}-{chunk.end}]\n{chunk.text}\n[end of {chunk.path}]"
+        )
+    return "\n\n".join(blocks)
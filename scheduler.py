@@ -0,0 +1,156 @@
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures import TimeoutError as FutureTimeout
+from contextlib import contextmanager
+from typing import Callable, Iterable
+
+
+"""
+Bounded worker pool for eval runs.
+
+Instances run on a thread pool (the heavy lifting happens in the Docker daemon and
+the OpenAI API, so threads are enough and the stage limits below stay shared).
+Docker-bound and LLM-bound stages each take a slot from their own semaphore so a
+slow container setup can't starve the LLM calls and vice versa.
+"""
+_limits_lock = threading.Lock()
+_docker_slots = threading.BoundedSemaphore(1)
+_llm_slots = threading.BoundedSemaphore(4)
+_local = threading.local()
+
+
+def configure_limits(max_docker: int, max_llm: int):
+    global _docker_slots, _llm_slots
+    with _limits_lock:
+        _docker_slots = threading.BoundedSemaphore(max(1, max_docker))
+        _llm_slots = threading.BoundedSemaphore(max(1, max_llm))
+
+
+class InstanceTimeout(Exception):
+    pass
+
+
+"""
+Cancellation of timed-out instances. Each instance's worker thread gets an
+Event that run_instances sets when the instance exceeds instance_timeout. The
+blocking calls of a stage watch it: waiting for a slot, waiting for the LLM
+gateway (wait_cancellable) and docker execs (the ExecStream watchdog kills the
+command), each of which then raises InstanceTimeout or returns within about a
+second.
+"""
+def cancel_event() -> threading.Event | None:
+    return getattr(_local, "cancel", None)
+
+
+def check_cancelled():
+    event = cancel_event()
+    if event is not None and event.is_set():
+        raise InstanceTimeout("instance cancelled after its timeout")
+
+
+def wait_cancellable(future: Future, poll: float = 1.0):
+    while True:
+        try:
+            return future.result(timeout=poll)
+        except FutureTimeout:
+            if cancel_event() is not None and cancel_event().is_set():
+                future.cancel()
+                check_cancelled()
+
+
+def _acquire(slots: threading.BoundedSemaphore):
+    while not slots.acquire(timeout=1.0):
+        check_cancelled()
+
+
+@contextmanager
+def docker_slot():
+    slots = _docker_slots
+    _acquire(slots)
+    try:
+        yield
+    finally:
+        slots.release()
+
+
+@contextmanager
+def llm_slot():
+    slots = _llm_slots
+    _acquire(slots)
+    try:
+        yield
+    finally:
+        slots.release()
+
+
+"""
+Runs worker(index, datapoint) for every datapoint on a pool of max_workers threads.
+
+on_result(index, datapoint, result, error) is called as soon as each instance
+finishes. An instance running longer than instance_timeout seconds is reported with
+an InstanceTimeout error and cancelled (see cancel_event): its container command
+is killed and its slot and LLM waits give up, so its thread winds down shortly
+after. Python threads can't be killed and the pool's threads are joined at
+interpreter exit, so a call that doesn't watch the cancellation (a git fetch, an
+image commit) still keeps the process alive until it returns.
+"""
+def run_instances(
+    datapoints: Iterable,
+    worker: Callable,
+    on_result: Callable,
+    max_workers: int = os.cpu_count() or 4,
+    instance_timeout: float | None = None,
+):
+    started = {}
+    cancels = {}
+
+    def _run(index, datapoint):
+        _local.cancel = cancels[index] = threading.Event()
+        started[index] = time.monotonic()
+        try:
+            return worker(index, datapoint)
+        finally:
+            _local.cancel = None
+
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="instance")
+    items = enumerate(datapoints)
+    try:
+        pending = {}
+
+        def _top_up():
+            # datapoints are pulled from the iterable only as workers free up, so a
+            # lazily loaded dataset is never read ahead of the pool
+            while len(pending) < max_workers:
+                try:
+                    index, datapoint = next(items)
+                except StopIteration:
+                    return
+                pending[executor.submit(_run, index, datapoint)] = (index, datapoint)
+
+        _top_up()
+        while pending:
+            done, _ = wait(pending, timeout=1.0, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, datapoint = pending.pop(future)
+                try:
+                    on_result(index, datapoint, future.result(), None)
+                except Exception as e:
+                    on_result(index, datapoint, None, e)
+            _top_up()
+
+            if instance_timeout is None:
+                continue
+            now = time.monotonic()
+            for future, (index, datapoint) in list(pending.items()):
+                start = started.get(index)
+                if start is not None and now - start > instance_timeout:
+                    pending.pop(future)
+                    future.cancel()
+                    cancels[index].set()
+                    on_result(index, datapoint, None, InstanceTimeout(
+                        f"{datapoint['instance_id']} exceeded {instance_timeout}s"
+                    ))
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
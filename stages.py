@@ -0,0 +1,230 @@
+import json
+import os
+import time
+from pathlib import Path
+
+from scheduler import docker_slot
+from utils import strip_code_fence
+
+
+"""
+The LangGraph agent's pipeline split into stages that can run on their own.
+
+    setup       git mirror + the instance's environment image
+    reproduce   apply test_patch and run its tests in a container
+    localize    find_file + load_file: the suspect source file and its context
+    generate    the ensemble's candidate diffs
+    validate    repair/filter the candidates and pick one (judge or tests)
+    predict     the final model_patch
+
+Every stage writes its output as JSON to <stage_dir>/<stage>/<instance_id>.json,
+together with the configuration it was computed under (stage_config: the model,
+the context budget for localize, the rank mode for validate). Running a stage
+loads the artifacts of the stages before it, computing only the ones that are
+missing or were made under another configuration, so an expensive stage (an image
+build, a docker run, a batch of samples) is done once and reused by every
+experiment that shares the stage dir and its settings. Whenever a stage is
+recomputed, every stage after it is too, and their old artifacts are dropped.
+`force` recomputes the requested stage.
+"""
+STAGES = ("setup", "reproduce", "localize", "generate", "validate", "predict")
+DEFAULT_STAGE_DIR = Path("runs") / "stages"
+
+
+def artifact_path(stage_dir: str | Path, stage: str, instance_id: str) -> Path:
+    return Path(stage_dir) / stage / f"{instance_id.replace('/', '__')}.json"
+
+
+"""
+The settings a stage's output depends on besides the earlier stages' artifacts.
+An artifact saved under a different config is treated as missing.
+"""
+def stage_config(stage: str, rank_mode: str = "judge") -> dict:
+    if stage not in ("localize", "generate", "validate"):
+        return {}
+    import agent_settings
+    from context_packer import budget_for
+
+    model = agent_settings.model_name()
+    if stage == "localize":
+        return {"model": model, "budget": min(agent_settings.FILE_CONTEXT_BUDGET, budget_for(model))}
+    if stage == "generate":
+        return {"model": model, "temperature": agent_settings.TEMPERATURE,
+                "samples": agent_settings.ENSEMBLE_SIZE}
+    return {"model": model, "rank_mode": rank_mode,
+            "budget": min(agent_settings.JUDGE_CONTEXT_BUDGET, budget_for(model))}
+
+
+def load_artifact(stage_dir: str | Path, stage: str, instance_id: str, config: dict | None = None) -> dict | None:
+    path = artifact_path(stage_dir, stage, instance_id)
+    if not path.exists():
+        return None
+    artifact = json.loads(path.read_text())
+    if artifact.get("config", {}) != (config or {}):
+        return None
+    return artifact["data"]
+
+
+def save_artifact(stage_dir: str | Path, stage: str, instance_id: str, data: dict, config: dict | None = None):
+    path = artifact_path(stage_dir, stage, instance_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".json.tmp")
+    tmp_path.write_text(json.dumps(
+        {"instance_id": instance_id, "stage": stage, "finished_at": time.time(), "config": config or {},
+         "data": data}, indent=2,
+    ))
+    os.replace(tmp_path, path)
+
+
+def drop_artifacts_after(stage_dir: str | Path, stage: str, instance_id: str):
+    for name in STAGES[STAGES.index(stage) + 1:]:
+        artifact_path(stage_dir, name, instance_id).unlink(missing_ok=True)
+
+
+def _state(datapoint, prev: dict, rank_mode: str) -> dict:
+    import langgraph_agent
+
+    state = {
+        "repo_dir": datapoint["repo"],
+        "commit": datapoint["base_commit"],
+        "test_patch": datapoint["test_patch"],
+        "version": datapoint.get("version", ""),
+        "setup_commit": datapoint.get("environment_setup_commit", ""),
+        "rank_mode": rank_mode,
+        **prev,
+    }
+    if isinstance(state.get("error_file"), dict):
+        state["error_file"] = langgraph_agent.FindFile(**state["error_file"])
+    return state
+
+
+def setup(datapoint, prev: dict, rank_mode: str) -> dict:
+    from git_mirror import ensure_mirror
+    from image_cache import get_image_cache
+
+    ensure_mirror(datapoint["repo"], datapoint["base_commit"])
+    with docker_slot():
+        image, (code, _, err) = get_image_cache().ensure_instance(
+            datapoint["repo"], datapoint["base_commit"], version=datapoint.get("version", ""),
+            setup_commit=datapoint.get("environment_setup_commit", ""),
+        )
+    if image is None:
+        raise RuntimeError(f"image build failed ({code}): {err.strip()[-500:]}")
+    return {"image": image}
+
+
+def reproduce(datapoint, prev: dict, rank_mode: str) -> dict:
+    import langgraph_agent
+
+    with docker_slot():
+        results = langgraph_agent.run_patch_and_tests_in_docker(
+            repo=datapoint["repo"],
+            commit=datapoint["base_commit"],
+            test_patch=datapoint["test_patch"],
+            setup_only=False,
+            version=datapoint.get("version", ""),
+            setup_commit=datapoint.get("environment_setup_commit", ""),
+            # localize only needs the first failure
+            stop_at_first_failure=True,
+        )
+    if "pytest_stdout" not in results:
+        raise RuntimeError(f"tests did not run: {results.get('clone_exit') or results.get('image_build_exit')}")
+    return {
+        "error": results.get("failure_summary") or results["pytest_stdout"],
+        "pytest_stdout": results["pytest_stdout"],
+    }
+
+
+def localize(datapoint, prev: dict, rank_mode: str) -> dict:
+    import langgraph_agent
+
+    state = _state(datapoint, prev, rank_mode)
+    state.update(langgraph_agent.find_file(state))
+    state.update(langgraph_agent.load_file(state))
+    return {
+        "error_file": state["error_file"].model_dump(),
+        "context": state["context"],
+        "source_file": state["source_file"],
+    }
+
+
+def generate(datapoint, prev: dict, rank_mode: str) -> dict:
+    import langgraph_agent
+
+    return {"candidates": langgraph_agent.llm_call(_state(datapoint, prev, rank_mode))["output"]}
+
+
+def validate(datapoint, prev: dict, rank_mode: str) -> dict:
+    import langgraph_agent
+
+    state = _state(datapoint, prev, rank_mode)
+    state["output"] = prev["candidates"]
+    return {"output": langgraph_agent.ensemble_select_best_diff(state)["output"]}
+
+
+def predict(datapoint, prev: dict, rank_mode: str) -> dict:
+    return {"model_patch": strip_code_fence(prev.get("output") or "")}
+
+
+RUNNERS = {
+    "setup": setup,
+    "reproduce": reproduce,
+    "localize": localize,
+    "generate": generate,
+    "validate": validate,
+    "predict": predict,
+}
+
+
+def _run(stage: str, datapoint, stage_dir: str | Path, force: bool, rank_mode: str) -> tuple[dict, dict]:
+    if stage not in RUNNERS:
+        raise KeyError(f"unknown stage {stage!r}, expected one of {', '.join(STAGES)}")
+    instance_id = datapoint["instance_id"]
+    prev = {}
+    recomputed = None
+    for name in STAGES[:STAGES.index(stage) + 1]:
+        config = stage_config(name, rank_mode)
+        data = None
+        if recomputed is None and not (force and name == stage):
+            data = load_artifact(stage_dir, name, instance_id, config)
+        if data is None:
+            print(f"    • {instance_id}: running {name}")
+            data = RUNNERS[name](datapoint, prev, rank_mode)
+            save_artifact(stage_dir, name, instance_id, data, config)
+            recomputed = recomputed or name
+        prev.update(data)
+    if recomputed is not None:
+        # later stages were built from the old output
+        drop_artifacts_after(stage_dir, stage, instance_id)
+    return data, prev
+
+
+"""
+Runs `stage` for one instance and returns its artifact, loading (or computing and
+saving) the artifacts of every earlier stage first.
+"""
+def run_stage(stage: str, datapoint, stage_dir: str | Path = DEFAULT_STAGE_DIR,
+              force: bool = False, rank_mode: str = "judge") -> dict:
+    return _run(stage, datapoint, stage_dir, force, rank_mode)[0]
+
+
+"""
+Like run_stage, but returns the merged artifacts of every stage up to and
+including `stage`: the state the stage after it starts from.
+"""
+def stage_inputs(stage: str, datapoint, stage_dir: str | Path = DEFAULT_STAGE_DIR,
+                 rank_mode: str = "judge") -> dict:
+    return _run(stage, datapoint, stage_dir, False, rank_mode)[1]
+
+
+"""
+The stages whose artifacts are reusable under the current settings: a prefix of
+STAGES, since a stage recomputed before them invalidates the rest.
+"""
+def cached_stages(stage_dir: str | Path, instance_id: str, rank_mode: str = "judge") -> list[str]:
+    cached = []
+    for name in STAGES:
+        if load_artifact(stage_dir, name, instance_id, stage_config(name, rank_mode)) is None:
+            break
+        cached.append(name)
+    return cached
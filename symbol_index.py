@@ -0,0 +1,166 @@
+import ast
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path, PurePosixPath
+
+from retrieval import list_source_files
+
+
+"""
+Per-checkout symbol index used to turn the LLM's guess at a file (FindFile.file_name,
+FindFile.file_line) into an exact path and span.
+
+Built once per checkout with `ast`, it maps relative paths, every path suffix,
+dotted module names, basenames and class/function names to their files and line
+spans, so a lookup is a handful of dict hits instead of guessing at a `src/` layout.
+"""
+@dataclass
+class Symbol:
+    qualname: str
+    kind: str       # "module", "class" or "function"
+    path: str
+    start: int
+    end: int
+
+
+def _is_test_path(path: str) -> bool:
+    parts = PurePosixPath(path).parts
+    name = parts[-1]
+    return name.startswith("test_") or name.endswith("_test.py") or name == "conftest.py" \
+        or any(p in ("tests", "test", "testing") for p in parts[:-1])
+
+
+def _module_names(path: str) -> list[str]:
+    parts = list(PurePosixPath(path).with_suffix("").parts)
+    if parts[-1] == "__init__":
+        parts = parts[:-1]
+    names = [".".join(parts)] if parts else []
+    if len(parts) > 1 and parts[0] in ("src", "lib"):
+        names.append(".".join(parts[1:]))
+    return names
+
+
+def _walk_symbols(path: str, tree: ast.AST):
+    stack = [(tree, "")]
+    while stack:
+        node, prefix = stack.pop()
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)):
+                qualname = f"{prefix}{child.name}"
+                kind = "class" if isinstance(child, ast.ClassDef) else "function"
+                start = min([child.lineno] + [d.lineno for d in child.decorator_list])
+                yield Symbol(qualname, kind, path, start, child.end_lineno)
+                stack.append((child, qualname + "."))
+
+
+class SymbolIndex:
+    def __init__(self, repo_dir: Path):
+        self.repo_dir = Path(repo_dir)
+        self.files = {}         # rel path -> module Symbol
+        self.by_suffix = {}     # "pkg/mod.py", "mod.py", ... -> [rel paths]
+        self.by_module = {}     # dotted module -> rel path
+        self.by_name = {}       # "Class", "Class.method", "func" -> [Symbol]
+        self.symbols = {}       # rel path -> [Symbol] sorted by start
+        self._lines = {}
+
+        for rel_path in list_source_files(self.repo_dir):
+            self._add_file(rel_path)
+
+    def _add_file(self, rel_path: str):
+        try:
+            source = (self.repo_dir / rel_path).read_text(encoding="utf-8", errors="ignore")
+        except OSError:
+            return
+        n_lines = source.count("\n") + 1
+        self.files[rel_path] = Symbol(rel_path, "module", rel_path, 1, n_lines)
+
+        parts = PurePosixPath(rel_path).parts
+        for i in range(len(parts)):
+            self.by_suffix.setdefault("/".join(parts[i:]), []).append(rel_path)
+        for name in _module_names(rel_path):
+            self.by_module.setdefault(name, rel_path)
+
+        try:
+            tree = ast.parse(source)
+        except (SyntaxError, ValueError):
+            self.symbols[rel_path] = []
+            return
+        symbols = sorted(_walk_symbols(rel_path, tree), key=lambda s: s.start)
+        self.symbols[rel_path] = symbols
+        for symbol in symbols:
+            self.by_name.setdefault(symbol.qualname, []).append(symbol)
+            short = symbol.qualname.rsplit(".", 1)[-1]
+            if short != symbol.qualname:
+                self.by_name.setdefault(short, []).append(symbol)
+
+    def lines(self, rel_path: str) -> list[str]:
+        if rel_path not in self._lines:
+            text = (self.repo_dir / rel_path).read_text(encoding="utf-8", errors="ignore")
+            self._lines[rel_path] = text.splitlines()
+        return self._lines[rel_path]
+
+    """
+    All files that file_name could refer to: a path (absolute, container or relative),
+    a dotted module (optionally ending in a symbol), a bare basename or a symbol
+    name. Non-test files come first.
+    """
+    def candidates(self, file_name: str) -> list[str]:
+        name = file_name.strip().strip("`'\"").replace("\\", "/")
+        found = []
+        parts = PurePosixPath(name).parts
+        for i in range(len(parts)):
+            found = self.by_suffix.get("/".join(parts[i:]), [])
+            if found:
+                break
+        if not found and name in self.by_module:
+            found = [self.by_module[name]]
+        if not found and not name.endswith(".py") and name.replace(".", "/") + ".py" in self.by_suffix:
+            found = self.by_suffix[name.replace(".", "/") + ".py"]
+        if not found and "." in name and name.rpartition(".")[0] in self.by_module:
+            found = [self.by_module[name.rpartition(".")[0]]]
+        if not found and name in self.by_name:
+            found = list(dict.fromkeys(s.path for s in self.by_name[name]))
+        return sorted(found, key=lambda p: (_is_test_path(p), len(p)))
+
+    def enclosing_symbol(self, rel_path: str, line_no: int) -> Symbol:
+        best = self.files[rel_path]
+        for symbol in self.symbols.get(rel_path, []):
+            if symbol.start > line_no:
+                break
+            if symbol.end >= line_no:
+                best = symbol
+        return best
+
+    def find_line(self, rel_path: str, file_line: str) -> int | None:
+        needle = file_line.strip()
+        if not needle:
+            return None
+        for i, line in enumerate(self.lines(rel_path), start=1):
+            if needle in line:
+                return i
+        return None
+
+    """
+    Resolves (file_name, file_line) to (rel_path, Symbol of the enclosing span). When
+    several files match, the one that actually contains file_line wins. Returns None
+    when nothing in the checkout matches file_name.
+    """
+    def resolve(self, file_name: str, file_line: str = ""):
+        candidates = self.candidates(file_name)
+        if not candidates:
+            return None
+        for rel_path in candidates:
+            line_no = self.find_line(rel_path, file_line)
+            if line_no is not None:
+                return rel_path, self.enclosing_symbol(rel_path, line_no)
+        rel_path = candidates[0]
+        return rel_path, self.files[rel_path]
+
+
+"""
+Cached by path, so repo_dir must be a checkout that never moves to another
+commit: the per-commit checkouts from git_mirror.ensure_checkout.
+"""
+@lru_cache(maxsize=16)
+def symbol_index_for(repo_dir: str) -> SymbolIndex:
+    return SymbolIndex(Path(repo_dir))
@@ -0,0 +1,197 @@
+import re
+import shlex
+from pathlib import PurePosixPath
+
+
+"""
+Works out which tests a test_patch touches so the harness can run just those
+instead of the whole suite.
+
+The test files come from the diff headers. Test names come from the hunks: every
+changed line is attributed to the function it sits in (or, for decorator lines
+such as @pytest.mark.parametrize, the function right below), and the classes
+around it are followed by indentation, so each test becomes a node id
+(path::Class::test_name) that selects exactly it and all of its parametrizations.
+When a test's class can't be told from the hunk (an indented def with no class
+line in view), the run falls back to -k with the test names. When some change
+can't be attributed to a test function at all, the touched files are run whole.
+"""
+_DEF = re.compile(r"^(\s*)(?:async\s+)?def\s+(\w+)")
+_CLASS = re.compile(r"^(\s*)class\s+(\w+)")
+_HUNK = re.compile(r"^@@ -\d+(?:,\d+)? \+\d+(?:,\d+)? @@ ?(.*)$")
+
+
+def is_test_file(path: str) -> bool:
+    p = PurePosixPath(path)
+    if p.suffix != ".py" or p.name == "conftest.py":
+        return False
+    return p.name.startswith("test_") or p.name.endswith("_test.py") \
+        or any(part in ("tests", "test", "testing") for part in p.parts[:-1])
+
+
+def _is_test_name(name: str | None) -> bool:
+    return bool(name) and (name.startswith("test") or name.startswith("Test"))
+
+
+def _indent(text: str) -> int:
+    return len(text.expandtabs())
+
+
+"""
+Returns ({test file: set of (classes, test name)}, fully_attributed). classes is
+the tuple of enclosing class names, or None when the hunk doesn't show them.
+fully_attributed is False when some change in a test file could not be pinned to
+a test function.
+"""
+def parse_test_patch(test_patch: str):
+    tests = {}
+    fully_attributed = True
+    path = None
+    current = None
+    scope = []              # enclosing classes: [(indent, name)]
+    scope_known = True      # False until the hunk shows where its classes start
+    pending_decorator = False
+
+    def _close_hunk():
+        nonlocal fully_attributed, pending_decorator
+        if pending_decorator and path is not None:
+            fully_attributed = False
+        pending_decorator = False
+
+    def _enter(indent: int):
+        while scope and scope[-1][0] >= indent:
+            scope.pop()
+
+    def _node():
+        classes = tuple(name for _, name in scope)
+        return (classes if scope_known or classes else None), current[1]
+
+    def _select(removed: bool):
+        # a test the patch deletes has no node id left to run
+        if not removed:
+            tests[path].add(_node())
+
+    for line in test_patch.splitlines():
+        if line.startswith("diff --git "):
+            _close_hunk()
+            path = None
+            continue
+        if line.startswith("+++ "):
+            target = line[4:].strip()
+            target = target[2:] if target.startswith("b/") else target
+            path = target if target != "/dev/null" and is_test_file(target) else None
+            if path is not None:
+                tests.setdefault(path, set())
+            continue
+        if line.startswith("--- ") or path is None:
+            continue
+
+        hunk = _HUNK.match(line)
+        if hunk:
+            _close_hunk()
+            header = hunk.group(1)
+            current, scope, scope_known = None, [], True
+            match = _DEF.match(header) or _CLASS.match(header)
+            if match and _indent(match.group(1)) > 0:
+                # an indented def or class: the classes around it aren't in view
+                scope_known = False
+            elif match and _CLASS.match(header):
+                scope.append((0, match.group(2)))
+            elif match:
+                current = (0, match.group(2), False)
+            else:
+                scope_known = False
+            continue
+        if not line or line[0] not in " +-":
+            continue
+
+        body = line[1:]
+        match = _DEF.match(body)
+        if match:
+            indent = _indent(match.group(1))
+            _enter(indent)
+            if indent == 0:
+                scope_known = True
+            current = (indent, match.group(2), line[0] == "-")
+            name = current[1]
+            if pending_decorator:
+                if _is_test_name(name):
+                    _select(current[2])
+                else:
+                    fully_attributed = False
+                pending_decorator = False
+            if line[0] != " " and _is_test_name(name):
+                _select(current[2])
+            continue
+        match = _CLASS.match(body)
+        if match:
+            indent = _indent(match.group(1))
+            _enter(indent)
+            if indent == 0:
+                scope_known = True
+            scope.append((indent, match.group(2)))
+            current = None
+            if line[0] != " " and not _is_test_name(match.group(2)):
+                fully_attributed = False
+            continue
+
+        if not body.strip():
+            continue
+        if not body[0].isspace() and not body.startswith("@"):
+            # back at module level
+            current, scope, scope_known = None, [], True
+        if line[0] == " ":
+            continue
+        if body.lstrip().startswith("@"):
+            pending_decorator = True
+        elif current is not None and _is_test_name(current[1]):
+            _select(current[2])
+        else:
+            fully_attributed = False
+
+    _close_hunk()
+    return tests, fully_attributed
+
+
+"""
+Builds the pytest argument list for a test_patch. Falls back to the whole suite
+when full_suite is set or the patch touches no recognisable test file. exitfirst
+adds -x (the harness's stop_at_first_failure); xdist adds -n auto and needs
+pytest-xdist, which the container base images install.
+"""
+def pytest_args(
+    test_patch: str,
+    full_suite: bool = False,
+    exitfirst: bool = False,
+    xdist: bool = False,
+    markers: str | None = None,
+    junitxml: str | None = None,
+) -> list[str]:
+    args = ["-q", "-p", "no:cacheprovider"]
+    if junitxml:
+        # xunit1 reports carry each test's file, needed to rebuild its node id
+        args += [f"--junitxml={junitxml}", "-o", "junit_family=xunit1"]
+    if exitfirst:
+        args.append("-x")
+    if xdist:
+        args += ["-n", "auto"]
+    if markers:
+        args += ["-m", markers]
+    if full_suite or not test_patch:
+        return args
+
+    tests, fully_attributed = parse_test_patch(test_patch)
+    if not tests:
+        return args
+    selected = {(path, node) for path, nodes in tests.items() for node in nodes}
+    if not fully_attributed or not selected:
+        return args + sorted(tests)
+    if any(classes is None for _, (classes, _) in selected):
+        # -k matches substrings of every collected test, so only when it must
+        names = sorted({name for _, (_, name) in selected})
+        return args + ["-k", " or ".join(names)] + sorted(tests)
+    return args + sorted("::".join([path, *classes, name]) for path, (classes, name) in selected)
+
+
+def pytest_command(test_patch: str, command: str = "pytest", **kwargs) -> str:
+    return " ".join([command, *(shlex.quote(arg) for arg in pytest_args(test_patch, **kwargs))])
@@ -0,0 +1,36 @@
+from patch_validation import anchor_hunks, normalize_diff
+
+
+SQL = [
+    "select a",
+    "-- old comment",
+    "from t",
+    "where a > 1",
+]
+
+# the removed `-- ` comment shows up as `--- ` in the diff, like a file header
+DIFF = """--- a/query.sql
++++ b/query.sql
+@@ -1,4 +1,4 @@
+ select a
+--- old comment
++-- new comment
+ from t
+ where a > 1
+"""
+
+
+def test_normalize_keeps_removed_sql_comment_in_the_hunk():
+    assert normalize_diff(DIFF) == DIFF
+
+
+def test_anchor_hunks_keeps_removed_sql_comment_in_the_hunk():
+    read_lines = {"query.sql": SQL}.get
+    anchored = anchor_hunks(normalize_diff(DIFF), read_lines)
+    assert anchored == DIFF
+
+
+def test_anchor_hunks_moves_hunk_with_removed_sql_comment():
+    read_lines = {"query.sql": ["-- header", "", *SQL]}.get
+    anchored = anchor_hunks(normalize_diff(DIFF.replace("@@ -1,4 +1,4 @@", "@@ -9,4 +9,4 @@")), read_lines)
+    assert anchored == DIFF.replace("@@ -1,4 +1,4 @@", "@@ -3,4 +3,4 @@")
@@ -0,0 +1,54 @@
+from targeted_tests import pytest_args
+
+
+BASE = ["-q", "-p", "no:cacheprovider"]
+
+METHOD_AND_FUNCTIONS = """diff --git a/tests/test_x.py b/tests/test_x.py
+--- a/tests/test_x.py
++++ b/tests/test_x.py
+@@ -10,6 +10,10 @@ class TestY:
+     def test_a(self):
+         assert 1
+ 
++    @pytest.mark.parametrize("v", [1, 2])
++    def test_abc(self, v):
++        assert v
++
+@@ -40,3 +44,6 @@ def test_top():
+     x = 1
++    assert x
++
++def test_new():
++    pass
+-def test_gone():
+-    pass
+"""
+
+
+def test_selects_node_ids_not_substrings():
+    assert pytest_args(METHOD_AND_FUNCTIONS) == BASE + [
+        "tests/test_x.py::TestY::test_abc",
+        "tests/test_x.py::test_new",
+        "tests/test_x.py::test_top",
+    ]
+
+
+def test_falls_back_to_k_when_the_class_is_not_in_view():
+    patch = """--- a/tests/test_x.py
++++ b/tests/test_x.py
+@@ -10,6 +10,7 @@
+     def test_m(self):
+-        assert 0
++        assert 1
+"""
+    assert pytest_args(patch) == BASE + ["-k", "test_m", "tests/test_x.py"]
+
+
+def test_runs_the_file_when_a_change_is_outside_any_test():
+    patch = """--- a/tests/test_x.py
++++ b/tests/test_x.py
+@@ -1,3 +1,4 @@
+ import os
++import sys
+"""
+    assert pytest_args(patch) == BASE + ["tests/test_x.py"]
@@ -0,0 +1,215 @@
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+
+"""
+Lightweight per-stage tracing.
+
+`with span("name", category):` (or the @traced decorator) records a stage's wall
+time, the calling thread's CPU time, CPU time of child processes (git, pip, ...),
+the process's peak RSS when it ended, and counters the stage adds while it runs
+(bytes of output, LLM tokens in/out). Spans nest per thread. write_report() dumps
+them as a Chrome trace (open trace.json in chrome://tracing or Perfetto) plus
+profile.txt: a per-stage table and flamegraph-style collapsed stacks
+(`root;child;leaf <self ms>`, the input flamegraph.pl and speedscope expect).
+
+Child CPU comes from RUSAGE_CHILDREN, which is process-wide, so with several
+instances in flight it is only indicative for a single stage.
+"""
+_local = threading.local()
+_lock = threading.Lock()
+_spans = []
+_epoch = time.perf_counter()
+
+
+class Span:
+    def __init__(self, name: str, category: str, parent: "Span | None", attrs: dict):
+        self.name = name
+        self.category = category
+        self.parent = parent
+        self.attrs = attrs
+        self.counters = defaultdict(int)
+        self.children_wall = 0.0
+        self.start = time.perf_counter()
+        self.end = None
+        self.cpu = time.thread_time()
+        self.child_cpu = _children_cpu()
+        self.tid = threading.get_ident()
+
+    @property
+    def stack(self) -> str:
+        names = []
+        node = self
+        while node is not None:
+            names.append(node.name)
+            node = node.parent
+        return ";".join(reversed(names))
+
+    def add(self, **counters):
+        for key, value in counters.items():
+            self.counters[key] += value
+
+    def finish(self):
+        self.end = time.perf_counter()
+        self.wall = self.end - self.start
+        self.cpu = time.thread_time() - self.cpu
+        self.child_cpu = _children_cpu() - self.child_cpu
+        self.peak_rss_mb = peak_rss_mb()
+        if self.parent is not None:
+            self.parent.children_wall += self.wall
+            for key, value in self.counters.items():
+                self.parent.counters[key] += value
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KiB on Linux but in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def _children_cpu() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _stack() -> list:
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def current() -> Span | None:
+    stack = _stack()
+    return stack[-1] if stack else None
+
+
+"""
+Adds to the counters of the innermost open span on this thread (no-op outside one).
+"""
+def add(**counters):
+    span_ = current()
+    if span_ is not None:
+        span_.add(**counters)
+
+
+@contextmanager
+def span(name: str, category: str = "", **attrs):
+    stack = _stack()
+    span_ = Span(name, category, stack[-1] if stack else None, attrs)
+    stack.append(span_)
+    try:
+        yield span_
+    except BaseException as e:
+        span_.attrs["error"] = type(e).__name__
+        raise
+    finally:
+        stack.pop()
+        span_.finish()
+        with _lock:
+            _spans.append(span_)
+
+
+def traced(name: str | None = None, category: str = ""):
+    def decorator(fn):
+        span_name = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(span_name, category):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def reset():
+    global _epoch
+    with _lock:
+        _spans.clear()
+        _epoch = time.perf_counter()
+
+
+def spans() -> list[Span]:
+    with _lock:
+        return list(_spans)
+
+
+def chrome_trace(finished: list[Span]) -> dict:
+    events = []
+    for s in finished:
+        events.append({
+            "name": s.name,
+            "cat": s.category or "stage",
+            "ph": "X",
+            "ts": round((s.start - _epoch) * 1e6),
+            "dur": round(s.wall * 1e6),
+            "pid": os.getpid(),
+            "tid": s.tid,
+            "args": {
+                "cpu_ms": round(s.cpu * 1000, 1),
+                "child_cpu_ms": round(s.child_cpu * 1000, 1),
+                "peak_rss_mb": round(s.peak_rss_mb, 1),
+                **dict(s.counters),
+                **{k: str(v) for k, v in s.attrs.items()},
+            },
+        })
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def summary(finished: list[Span]) -> str:
+    by_name = defaultdict(list)
+    for s in finished:
+        by_name[s.name].append(s)
+
+    header = f"{'stage':<40} {'count':>6} {'wall s':>9} {'max s':>8} {'cpu s':>8} {'child s':>8} " \
+             f"{'rss MB':>8} {'bytes':>11} {'tok in':>9} {'tok out':>8}"
+    rows = [header, "-" * len(header)]
+    totals = sorted(by_name.items(), key=lambda item: -sum(s.wall for s in item[1]))
+    for name, group in totals:
+        # nested spans of the same name are counted once, at the outermost level
+        outer = [s for s in group if not any(p.name == name for p in _ancestors(s))]
+        counters = defaultdict(int)
+        for s in outer:
+            for key, value in s.counters.items():
+                counters[key] += value
+        rows.append(
+            f"{name[:40]:<40} {len(group):>6} {sum(s.wall for s in outer):>9.2f} "
+            f"{max(s.wall for s in group):>8.2f} {sum(s.cpu for s in outer):>8.2f} "
+            f"{sum(s.child_cpu for s in outer):>8.2f} {max(s.peak_rss_mb for s in group):>8.0f} "
+            f"{counters['bytes_out']:>11} {counters['tokens_in']:>9} {counters['tokens_out']:>8}"
+        )
+
+    stacks = defaultdict(float)
+    for s in finished:
+        stacks[s.stack] += max(0.0, s.wall - s.children_wall)
+    collapsed = [f"{stack} {round(ms * 1000)}" for stack, ms in sorted(stacks.items())]
+    return "\n".join(rows) + "\n\n# collapsed stacks (self time, ms)\n" + "\n".join(collapsed) + "\n"
+
+
+def _ancestors(s: Span):
+    node = s.parent
+    while node is not None:
+        yield node
+        node = node.parent
+
+
+"""
+Writes trace.json and profile.txt for everything recorded so far into run_dir and
+returns run_dir.
+"""
+def write_report(run_dir: str | Path) -> Path:
+    run_dir = Path(run_dir)
+    run_dir.mkdir(parents=True, exist_ok=True)
+    finished = spans()
+    with open(run_dir / "trace.json", "w") as f:
+        json.dump(chrome_trace(finished), f)
+    (run_dir / "profile.txt").write_text(summary(finished))
+    print(f"Trace written to {run_dir / 'trace.json'}, profile to {run_dir / 'profile.txt'}")
+    return run_dir
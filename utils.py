@@ -5,19 +5,30 @@ import json
 import shlex
 import os
 
+from tracing import traced
+
+"""
+Root of every on-disk cache, SWEBENCH_CACHE_DIR or ~/.cache/swebench-agent. Read
+on every call and only created when a cache dir is asked for, so importing a
+module never touches the disk and the variable can be set any time before use.
+"""
+def cache_root() -> Path:
+    return Path(os.environ.get("SWEBENCH_CACHE_DIR", Path.home() / ".cache" / "swebench-agent"))
+
+def cache_dir(*parts: str) -> Path:
+    path = cache_root().joinpath(*parts)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+@traced(category="subprocess")
 def clone_and_checkout(repo: str, commit: str, base_dir: Path):
+    from git_mirror import clone_from_mirror
 
     safe_name = repo.replace("/", "_")
     repo_dir = base_dir / safe_name
 
-    if not repo_dir.exists(): 
-        repo_url = f"https://github.com/{repo}.git"
-
-        print(f"Cloning {repo_url} into {repo_dir}")
-        subprocess.run(["git", "clone", repo_url, str(repo_dir)], check=True)
-
-    subprocess.run(["git", "-C", str(repo_dir), "fetch"], check=True)
-    subprocess.run(["git", "-C", str(repo_dir), "checkout", commit], check=True)
+    print(f"Checking out {repo}@{commit} into {repo_dir} from the local mirror")
+    clone_from_mirror(repo, commit, repo_dir)
 
     return repo_dir
 
@@ -40,30 +51,37 @@ def load_relevant_code(repo_dir: Path, failure_path: str, line_no: int, context_
     except Exception:
         return ""
 
-def apply_patch(repo_dir: Path, patch_text: str):
-    patch_file = repo_dir / "candidate.patch"
-    patch_file.write_text(patch_text, encoding="utf-8")
-
+@traced(category="subprocess")
+def check_patch(repo_dir: Path, patch_text: str):
+    """
+    Runs `git apply --check` with the patch on stdin. Returns (ok, stderr).
+    """
     check_proc = subprocess.run(
-        ["git", "-C", str(repo_dir), "apply", "--check", str(patch_file)],
+        ["git", "-C", str(repo_dir), "apply", "--check", "-"],
+        input=patch_text,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
         text=True
     )
-    if check_proc.returncode != 0:
-        patch_file.unlink(missing_ok=True)
+    return check_proc.returncode == 0, check_proc.stderr.strip()
+
+@traced(category="subprocess")
+def apply_patch(repo_dir: Path, patch_text: str):
+    ok, _ = check_patch(repo_dir, patch_text)
+    if not ok:
         return False
 
     apply_proc = subprocess.run(
-        ["git", "-C", str(repo_dir), "apply", str(patch_file)],
+        ["git", "-C", str(repo_dir), "apply", "-"],
+        input=patch_text,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
         text=True
     )
-    patch_file.unlink(missing_ok=True)
     return apply_proc.returncode == 0
 
 
+@traced(category="subprocess")
 def apply_test_patch(repo_dir: Path, test_patch: str) -> bool:
     patch_filename = "tmp_test_to_apply.patch"
     test_file = repo_dir / patch_filename
@@ -106,6 +124,7 @@ def apply_test_patch(repo_dir: Path, test_patch: str) -> bool:
     return True
 
 
+@traced(category="subprocess")
 def run_test_command(repo_dir: Path, test_command: str):
     print(repo_dir, test_command)
     try:
@@ -119,9 +138,13 @@ def run_test_command(repo_dir: Path, test_command: str):
         print(f"Error: {str(e)}")
         return []
 
-def run_pytest_in_repo(repo_dir: Path):
-    cmd = f"pytest -q"
-    parts = shlex.split(cmd)
+@traced(category="subprocess")
+def run_pytest_in_repo(repo_dir: Path, test_patch: str = "", full_suite: bool = False,
+                       junitxml: Path | None = None):
+    from targeted_tests import pytest_args
+
+    parts = ["pytest", *pytest_args(test_patch, full_suite=full_suite,
+                                    junitxml=str(junitxml) if junitxml else None)]
 
     env = os.environ.copy()
     local_src = str(repo_dir / "src")
@@ -139,17 +162,23 @@ def run_pytest_in_repo(repo_dir: Path):
     stderr_lines = proc.stdout.splitlines()
     return proc.returncode, stdout_lines, stderr_lines
 
-def extract_failure_location(stdout_lines: list[str]):
-    pattern = re.compile(r'file\s+"(.+?\.py)",\s*line\s*(\d+)', re.IGNORECASE)
+_FAILURE_LOCATION = re.compile(r'file\s+"(.+?\.py)",\s*line\s*(\d+)', re.IGNORECASE)
 
+"""
+Fallback for when no JUnit report is available; prefer pytest_results.first_source_frame.
+"""
+def extract_failure_location(stdout_lines: list[str]):
     for line in stdout_lines:
-        match = pattern.search(line)
+        if ".py" not in line:
+            continue
+        match = _FAILURE_LOCATION.search(line)
         if match:
             full_path = match.group(1)
             line_no = int(match.group(2))
             return full_path, line_no
     return None
 
+@traced(category="subprocess")
 def install_clone_into_venv(repo_dir: Path) -> bool:
     """
     Inside the cloned repo, run:
@@ -157,8 +186,13 @@ def install_clone_into_venv(repo_dir: Path) -> bool:
       2) pip install -r requirements.txt
       3) pip install -r requirements_dev.txt
 
+    Requirements are wheeled once into the host wheelhouse and installed from
+    there (wheelhouse.py).
+
     Returns True if all three install commands succeed, False otherwise.
     """
+    import wheelhouse
+
     try:
         subprocess.run(
             ["python", "-m", "pip", "install", "--upgrade", "pip"],
@@ -167,31 +201,13 @@ def install_clone_into_venv(repo_dir: Path) -> bool:
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
         )
-        subprocess.run(
-            ["python", "-m", "pip", "install", "-e", "."],
-            cwd=repo_dir,
-            check=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
+        wheelhouse.install_package(repo_dir, editable=True)
         req1 = repo_dir / "requirements.txt"
         if req1.exists():
-            subprocess.run(
-                ["python", "-m", "pip", "install", "-r", "requirements.txt"],
-                cwd=repo_dir,
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
+            wheelhouse.install_requirements(repo_dir, "requirements.txt")
         req_dev = repo_dir / "requirements_dev.txt"
         if req_dev.exists():
-            subprocess.run(
-                ["python", "-m", "pip", "install", "-r", "requirements_dev.txt"],
-                cwd=repo_dir,
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
+            wheelhouse.install_requirements(repo_dir, "requirements_dev.txt")
         return True
     except subprocess.CalledProcessError as e:
         print(f"↳ Failed to install dependencies in {repo_dir}:\n{e.stderr or e}")
@@ -0,0 +1,182 @@
+import hashlib
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import threading
+from collections import defaultdict
+from pathlib import Path
+
+from utils import cache_dir
+from git_mirror import mirror_path, offline
+from env_specs import EnvSpec
+
+
+"""
+Host-level wheelhouse shared by every container and the host venv.
+
+Wheels live under <cache>/wheels/<python>/, one directory per interpreter (the
+python base image, or the host's python), so dependency sets of different repos
+share the wheels they have in common. A dependency set (the env spec's pip and
+native packages plus the repo's requirements files at the setup commit, see
+env_specs.py) is `pip wheel`-ed into it once, recorded by a marker named after the
+set's hash, and from then on installed with
+`--no-index --find-links <wheelhouse>`: a copy, not a download or a compile.
+Packages we compile (numpy, scipy, ...) are therefore only built the first time.
+
+pip's own download/HTTP cache sits next to it (PIP_CACHE_DIR) for whatever still
+goes through the index, e.g. build backends for `pip install .`. Containers get
+<cache>/wheels bind-mounted read-write at the same absolute path, like the git
+mirrors; bind mounts are not part of `docker commit`, so image layers stay small.
+With SWEBENCH_OFFLINE set the index is never used and a set missing from the
+wheelhouse fails to install.
+"""
+_set_locks = defaultdict(threading.Lock)
+
+
+def wheel_root() -> Path:
+    return cache_dir("wheels")
+
+
+def wheelhouse_dir(python: str) -> Path:
+    return cache_dir("wheels", python.replace("/", "_").replace(":", "-"))
+
+
+def host_python() -> str:
+    return f"host-py{sys.version_info.major}{sys.version_info.minor}"
+
+
+def wheelhouse_mount() -> dict:
+    root = str(wheel_root())
+    return {root: {"bind": root, "mode": "rw"}}
+
+
+def pip_env() -> dict:
+    return {"PIP_CACHE_DIR": str(cache_dir("wheels", "pip-cache")), "PIP_DISABLE_PIP_VERSION_CHECK": "1"}
+
+
+def _show(repo: str, commit: str, path: str) -> str | None:
+    proc = subprocess.run(
+        ["git", "--git-dir", str(mirror_path(repo)), "show", f"{commit or 'HEAD'}:{path}"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+    )
+    return proc.stdout if proc.returncode == 0 else None
+
+
+"""
+The requirements files spec installs, as found in repo at commit (read from the
+mirror), and the packages installed besides them.
+"""
+def dependency_set(spec: EnvSpec, repo: str, commit: str = "") -> dict:
+    files = {}
+    for name in (*spec.requirements, *spec.dev_requirements):
+        text = _show(repo, commit, name)
+        if text is not None:
+            files[name] = text
+    return {
+        "packages": [*spec.pip_packages, *spec.native_packages],
+        "files": files,
+        "required": [name for name in spec.requirements if name in files],
+    }
+
+
+def set_key(python: str, deps: dict) -> str:
+    digest = hashlib.sha256(python.encode("utf-8"))
+    for package in deps["packages"]:
+        digest.update(b"\0" + package.encode("utf-8"))
+    for name, text in sorted(deps["files"].items()):
+        digest.update(b"\0" + name.encode("utf-8") + b"\0" + text.encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def _specs(deps: dict) -> tuple[str, list[str]]:
+    required = [shlex.quote(p) for p in deps["packages"]] + [f"-r {name}" for name in deps["required"]]
+    optional = [f"-r {name}" for name in deps["files"] if name not in deps["required"]]
+    return " ".join(required), optional
+
+
+"""
+Shell command, run from the repo's checkout inside a container, that fills the
+wheelhouse for the dependency set once and installs it from there. Containers
+building the same set serialize on a flock next to its marker, the first one
+builds while the others wait and then find the marker. Wheels are built into a
+private mktemp staging dir and renamed in afterwards, so nobody reading the
+wheelhouse sees a half-written file. The dev requirements are best-effort, as before.
+"""
+def install_command(spec: EnvSpec, repo: str, commit: str = "") -> str:
+    wheels = wheelhouse_dir(spec.image)
+    deps = dependency_set(spec, repo, commit)
+    key = set_key(spec.image, deps)
+    required, optional = _specs(deps)
+    if not required and not optional:
+        return "true"
+    marker = wheels / ".sets" / key
+    lock = wheels / ".sets" / f"{key}.lock"
+    index = "--no-index " if offline() else ""
+    build = [f"pip wheel -q {index}-w $staging --find-links {wheels} {required}"] if required else []
+    build += [f"(pip wheel -q {index}-w $staging --find-links {wheels} {opt} || true)" for opt in optional]
+    install = [f"pip install --no-index --find-links {wheels} {required}"] if required else []
+    install += [f"(pip install --no-index --find-links {wheels} {opt} || true)" for opt in optional]
+    env = " ".join(f"{k}={v}" for k, v in pip_env().items())
+    return (
+        f"export {env} && mkdir -p {marker.parent} {wheels}/.staging && "
+        f"(flock 9 && if [ ! -f {marker} ]; then "
+        f"staging=$(mktemp -d {wheels}/.staging/{key}.XXXXXX) && "
+        f"if {' && '.join(build)}; then mv -n $staging/*.whl {wheels}/ 2>/dev/null; rm -rf $staging; touch {marker}; "
+        f"else rm -rf $staging; false; fi; fi) 9>{lock} && "
+        + " && ".join(install)
+    )
+
+
+"""
+`pip install <target> --find-links <wheelhouse>` for each of the spec's install
+targets: the package itself is always built from the checkout, its dependencies
+come from the wheelhouse when they are there.
+"""
+def install_package_command(spec: EnvSpec) -> str:
+    env = " ".join(f"{k}={v}" for k, v in pip_env().items())
+    index = "--no-index " if offline() else ""
+    wheels = wheelhouse_dir(spec.image)
+    return " && ".join(f"{env} pip install {index}--find-links {wheels} {target}" for target in spec.install)
+
+
+def _pip(args: list[str], cwd: Path) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        ["python", "-m", "pip", *args], cwd=cwd, check=True,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, env={**os.environ, **pip_env()},
+    )
+
+
+"""
+Host counterpart of install_command for the basic agent's venv: wheels the
+requirements file once per content into the host wheelhouse and installs it from
+there. Raises CalledProcessError like the pip call it replaces.
+"""
+def install_requirements(repo_dir: Path, requirements: str):
+    python = host_python()
+    wheels = wheelhouse_dir(python)
+    text = (repo_dir / requirements).read_text(errors="ignore")
+    key = set_key(python, {"packages": [], "files": {requirements: text}})
+    marker = wheels / ".sets" / key
+    with _set_locks[key]:
+        if not marker.exists():
+            # private to this process: containers may be building into .staging too
+            staging = wheels / ".staging" / f"{key}.host-{os.getpid()}"
+            shutil.rmtree(staging, ignore_errors=True)
+            index = ["--no-index"] if offline() else []
+            _pip(["wheel", "-q", *index, "-w", str(staging), "--find-links", str(wheels),
+                  "-r", requirements], repo_dir)
+            for wheel in staging.glob("*.whl"):
+                if not (wheels / wheel.name).exists():
+                    wheel.replace(wheels / wheel.name)
+            shutil.rmtree(staging, ignore_errors=True)
+            marker.parent.mkdir(parents=True, exist_ok=True)
+            marker.touch()
+    _pip(["install", "--no-index", "--find-links", str(wheels), "-r", requirements], repo_dir)
+
+
+def install_package(repo_dir: Path, editable: bool = True):
+    index = ["--no-index"] if offline() else []
+    _pip(["install", *index, "--find-links", str(wheelhouse_dir(host_python())),
+          *(["-e", "."] if editable else ["."])], repo_dir)
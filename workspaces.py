@@ -0,0 +1,131 @@
+import os
+import queue
+import shutil
+import subprocess
+import threading
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+from utils import cache_dir
+from git_mirror import clone_from_mirror, ensure_checkout
+
+
+"""
+Per-instance copy-on-write workspaces.
+
+Every run gets its own directory under <cache>/workspaces/<name>/, with the
+checkout in repo/ and room for patches and reports next to it, so instances never
+share a working tree and can run side by side. The checkout is a reflink copy
+(`cp --reflink=always`) of the shared per-commit checkout (git_mirror.ensure_checkout):
+only metadata is written and blocks are shared until someone modifies them. On
+filesystems without reflinks (ext4, most Docker Desktop setups) it falls back to a
+`git clone --shared` of the mirror, which shares the objects and only writes the
+working tree. Both keep the mirror alternates, so the checkout works inside a
+container too.
+
+Containers get <cache>/workspaces bind-mounted read-write at the same absolute
+path (like the mirrors), so a workspace has the same path on both sides and
+pooled containers can be handed any workspace without being recreated.
+
+Teardown renames the workspace into .trash/ on the same filesystem, which is
+O(1), and a background thread deletes it afterwards. Leftovers from a crashed run
+are swept the first time a workspace is removed.
+"""
+_reflink_ok = None
+_reflink_lock = threading.Lock()
+
+_trash = queue.Queue()
+_reaper = None
+_reaper_lock = threading.Lock()
+
+
+def workspace_root() -> Path:
+    return cache_dir("workspaces")
+
+
+def trash_root() -> Path:
+    return cache_dir("workspaces", ".trash")
+
+
+def workspace_mount() -> dict:
+    root = str(workspace_root())
+    return {root: {"bind": root, "mode": "rw"}}
+
+
+def _reflink_copy(src: Path, dest: Path) -> bool:
+    global _reflink_ok
+    if _reflink_ok is False:
+        return False
+    proc = subprocess.run(["cp", "-a", "--reflink=always", str(src), str(dest)],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    with _reflink_lock:
+        if _reflink_ok is None:
+            _reflink_ok = proc.returncode == 0
+            if not _reflink_ok:
+                print(f"    • Reflinks unavailable under {workspace_root()}, using shared clones")
+    if proc.returncode != 0:
+        shutil.rmtree(dest, ignore_errors=True)
+    return proc.returncode == 0
+
+
+"""
+Creates a fresh workspace for repo@commit and returns its root; the checkout is
+root / "repo".
+"""
+def create_workspace(repo: str, commit: str, name: str | None = None) -> Path:
+    root = workspace_root() / f"{(name or repo).replace('/', '_')}-{uuid.uuid4().hex[:8]}"
+    root.mkdir(parents=True)
+    checkout = root / "repo"
+    if not _reflink_copy(ensure_checkout(repo, commit), checkout):
+        clone_from_mirror(repo, commit, checkout)
+    return root
+
+
+def _reap():
+    while True:
+        path = _trash.get()
+        shutil.rmtree(path, ignore_errors=True)
+        if path.exists():
+            print(f"    • Could not fully remove {path} (files owned by another user?)")
+        _trash.task_done()
+
+
+def _start_reaper():
+    global _reaper
+    with _reaper_lock:
+        if _reaper is None:
+            _reaper = threading.Thread(target=_reap, name="workspace-reaper", daemon=True)
+            _reaper.start()
+            for leftover in trash_root().iterdir():
+                _trash.put(leftover)
+
+
+def remove_workspace(root: Path):
+    _start_reaper()
+    trashed = trash_root() / root.name
+    try:
+        os.rename(root, trashed)
+    except FileNotFoundError:
+        return
+    _trash.put(trashed)
+
+
+@contextmanager
+def workspace(repo: str, commit: str, name: str | None = None):
+    root = create_workspace(repo, commit, name)
+    try:
+        yield root
+    finally:
+        remove_workspace(root)
+
+
+"""
+Shell command that gives the workspace back to the host user, for containers
+that write into it as root. Empty when the host user is root anyway (or on
+platforms where docker maps ownership itself).
+"""
+def chown_command(root: Path) -> str:
+    if not hasattr(os, "getuid") or os.getuid() == 0:
+        return ""
+    return f"chown -R {os.getuid()}:{os.getgid()} {root} || true"